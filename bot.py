@@ -1,49 +1,59 @@
 import os
+import sys
 import pytz
 import json
 import logging
 import asyncio
 import aiohttp
 import psycopg2
+import psycopg2.pool
 import time
+import threading
 import uuid
+import re
+import inspect
+import socket
 from asyncpg.pool import Pool
 import signal
-from functools import wraps
+from functools import lru_cache, wraps
+from collections import deque
 from aiohttp import ClientTimeout, web
 from urllib.parse import urlparse
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    PersistenceInput,
     PreCheckoutQueryHandler,
+    SimpleUpdateProcessor,
     filters,
     ContextTypes,
 )
-from telegram.error import BadRequest, TelegramError
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 import asyncpg
 from datetime import datetime, timedelta, timezone
 import random
 import string
 from logging.handlers import RotatingFileHandler
-from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
 from cachetools import TTLCache
 import hmac
 import hashlib
-from contextlib import asynccontextmanager
 import requests
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from io import BytesIO
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from types import MappingProxyType
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
 import bcrypt
 from aiohttp_wsgi import WSGIHandler
-from asyncio import Lock
 
 # Flask application setup
 app_flask = Flask(__name__)
@@ -69,6 +79,38 @@ ERRORS = Counter("bot_errors_total", "Total number of errors",
                  ["type", "endpoint"])
 RESPONSE_TIME = Histogram("bot_response_time_seconds",
                           "Response time of handlers", ["endpoint"])
+DB_QUERY_TIME = Histogram("bot_db_query_seconds",
+                          "Database statement latency", ["statement"])
+DB_ACQUIRE_WAIT = Histogram("bot_db_acquire_wait_seconds",
+                            "Time spent waiting for a pooled connection")
+DB_HOLD_TIME = Histogram("bot_db_connection_hold_seconds",
+                         "Time a pooled connection is held before release")
+
+
+def record_error(endpoint: str, error: BaseException) -> None:
+    ERRORS.labels(type(error).__name__, endpoint).inc()
+
+
+def observe_request(endpoint: str, elapsed: float) -> None:
+    REQUESTS.labels(endpoint).inc()
+    RESPONSE_TIME.labels(endpoint).observe(elapsed)
+
+
+def instrumented(endpoint: str):
+    """Count, time and record uncaught errors of an async handler under endpoint."""
+    def decorate(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                record_error(endpoint, e)
+                raise
+            finally:
+                observe_request(endpoint, time.perf_counter() - started)
+        return wrapper
+    return decorate
 
 # Load environment variables
 load_dotenv()
@@ -89,6 +131,7 @@ PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")
 SPLIT_API_URL = "https://api.split.tg/buy/stars"
 CRYPTOBOT_API_URL = "https://pay.crypt.bot/api"
 TON_SPACE_API_URL = "https://api.ton.space/v1"
+TONAPI_BASE_URL = "https://tonapi.io/v2"
 SUPPORT_CHANNEL = "https://t.me/CheapStarsShop_support"
 REVIEWS_CHANNEL = "https://t.me/CheapStarsShop_support"
 NEWS_CHANNEL = "https://t.me/cheapstarshop_news"
@@ -99,6 +142,66 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", 8080))
 MARKUP_PERCENTAGE = float(os.getenv("MARKUP_PERCENTAGE", 10))
 REFERRAL_BONUS_PERCENTAGE = float(os.getenv("REFERRAL_BONUS_PERCENTAGE", 30))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DB_HEALTH_CHECK_INTERVAL = int(os.getenv("DB_HEALTH_CHECK_INTERVAL", 15))
+DB_HEALTH_CHECK_TIMEOUT = float(os.getenv("DB_HEALTH_CHECK_TIMEOUT", 5))
+DB_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("DB_CIRCUIT_FAILURE_THRESHOLD", 3))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 20))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", 15))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 5))
+PAGE_COUNT_CACHE_TTL = int(os.getenv("PAGE_COUNT_CACHE_TTL", 60))
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 200))
+DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", 100))
+DB_TRACE_MAX_STATEMENTS = int(os.getenv("DB_TRACE_MAX_STATEMENTS", 500))
+ADMIN_DB_POOL_MIN_SIZE = int(os.getenv("ADMIN_DB_POOL_MIN_SIZE", 1))
+ADMIN_DB_POOL_MAX_SIZE = int(os.getenv("ADMIN_DB_POOL_MAX_SIZE", 4))
+ADMIN_DB_ACQUIRE_TIMEOUT = float(os.getenv("ADMIN_DB_ACQUIRE_TIMEOUT", 5))
+ADMIN_DB_STATEMENT_TIMEOUT_MS = int(os.getenv("ADMIN_DB_STATEMENT_TIMEOUT_MS", 5000))
+ADMIN_WSGI_THREADS = int(os.getenv("ADMIN_WSGI_THREADS", 4))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 300))
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 10))
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv("LEADERBOARD_REFRESH_INTERVAL", 300))
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", 10000))
+USERNAME_CACHE_TTL = int(os.getenv("USERNAME_CACHE_TTL", 3600))
+USERNAME_RESOLVE_CONCURRENCY = int(os.getenv("USERNAME_RESOLVE_CONCURRENCY", 5))
+USERNAME_RESOLVE_TIMEOUT = float(os.getenv("USERNAME_RESOLVE_TIMEOUT", 3))
+REFERRALS_BACKFILL_BATCH = int(os.getenv("REFERRALS_BACKFILL_BATCH", 1000))
+REFERRALS_BACKFILL_PAUSE = float(os.getenv("REFERRALS_BACKFILL_PAUSE", 0.1))
+PREFIX_BACKFILL_BATCH = int(os.getenv("PREFIX_BACKFILL_BATCH", 1000))
+PREFIX_BACKFILL_PAUSE = float(os.getenv("PREFIX_BACKFILL_PAUSE", 0.05))
+PAYMENT_AMOUNT_TOLERANCE_NANO = int(os.getenv("PAYMENT_AMOUNT_TOLERANCE_NANO", 100_000_000))
+WALLET_POLL_INTERVAL = int(os.getenv("WALLET_POLL_INTERVAL", 15))
+WALLET_POLL_LIMIT = int(os.getenv("WALLET_POLL_LIMIT", 100))
+INVOICE_TTL = int(os.getenv("INVOICE_TTL", 86400))
+INVOICE_SWEEP_INTERVAL = int(os.getenv("INVOICE_SWEEP_INTERVAL", 600))
+INVOICE_SWEEP_BATCH = int(os.getenv("INVOICE_SWEEP_BATCH", 1000))
+INVOICE_SWEEP_PAUSE = float(os.getenv("INVOICE_SWEEP_PAUSE", 0.05))
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", 10000))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 500))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 2))
+ANALYTICS_SAMPLE_WATERMARK = float(os.getenv("ANALYTICS_SAMPLE_WATERMARK", 0.8))
+ANALYTICS_SAMPLE_RATE = float(os.getenv("ANALYTICS_SAMPLE_RATE", 0.1))
+ANALYTICS_SHUTDOWN_TIMEOUT = float(os.getenv("ANALYTICS_SHUTDOWN_TIMEOUT", 10))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", UPDATE_WORKERS))
+UPDATE_SHUTDOWN_TIMEOUT = float(os.getenv("UPDATE_SHUTDOWN_TIMEOUT", 20))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 5))
+USER_STATE_CACHE_TTL = int(os.getenv("USER_STATE_CACHE_TTL", 30))
 
 # State constants
 STATES = {
@@ -132,23 +235,108 @@ STATES = {
 }
 
 
+# Shared HTTP client
+#
+# One long-lived aiohttp session for all outbound traffic (tonapi.io). It keeps
+# connections alive between calls, caches DNS lookups and caps connections per
+# host. Created in main() and closed on shutdown; every call goes through
+# http_request() so latency and errors are recorded per endpoint.
+_http_session: aiohttp.ClientSession | None = None
+_http_stats = {}
+
+
+def _new_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_MAX_CONNECTIONS,
+        limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        headers={"User-Agent": "TelegramBot/1.0"}
+    )
+
+
+async def init_http_client() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = _new_http_session()
+        logger.info("Shared HTTP client created")
+    return _http_session
+
+
+async def close_http_client() -> None:
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+        logger.info("Shared HTTP client closed")
+    _http_session = None
+
+
+def tonapi_headers() -> dict:
+    return {"Authorization": f"Bearer {API_KEY}"} if API_KEY else {}
+
+
+def _record_http_call(endpoint: str, elapsed: float, error: str | None) -> None:
+    stats = _http_stats.setdefault(endpoint, {
+        "calls": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0, "last_error": None
+    })
+    stats["calls"] += 1
+    stats["total_time"] += elapsed
+    stats["max_time"] = max(stats["max_time"], elapsed)
+    if error:
+        stats["errors"] += 1
+        stats["last_error"] = error
+
+
+@asynccontextmanager
+async def http_request(endpoint: str, method: str, url: str, **kwargs):
+    session = await init_http_client()
+    start_time = time.perf_counter()
+    error = None
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            if response.status >= 400:
+                error = f"HTTP {response.status}"
+            yield response
+    except Exception as e:
+        error = error or f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _record_http_call(endpoint, time.perf_counter() - start_time, error)
+
+
+def get_http_stats() -> dict:
+    return {
+        endpoint: {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "avg_ms": round(stats["total_time"] / stats["calls"] * 1000, 3) if stats["calls"] else 0.0,
+            "max_ms": round(stats["max_time"] * 1000, 3),
+            "last_error": stats["last_error"]
+        }
+        for endpoint, stats in _http_stats.items()
+    }
+
+
 async def fetch_ton_price(context: ContextTypes.DEFAULT_TYPE):
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Bearer {API_KEY}"} if API_KEY else {}
-            async with session.get(API_URL, headers=headers) as response:
-                if response.status != 200:
-                    logger.error(
-                        f"TON API request failed: status={response.status}")
-                    return None
-                data = await response.json()
-                rate_usd = float(data["rates"]["TON"]["prices"]["USD"])
-                context.bot_data["ton_price_info"] = {
-                    "price": rate_usd,
-                    "last_updated": datetime.now(pytz.UTC)
-                }
-                logger.debug(f"Fetched TON price: {rate_usd} USD")
-                return rate_usd
+        async with http_request(
+            "tonapi_rates", "GET", f"{TONAPI_BASE_URL}/rates",
+            params={"tokens": "ton", "currencies": "usd"},
+            headers=tonapi_headers()
+        ) as response:
+            if response.status != 200:
+                logger.error(
+                    f"TON API request failed: status={response.status}")
+                return None
+            data = await response.json()
+            rate_usd = float(data["rates"]["TON"]["prices"]["USD"])
+            set_ton_price(context.bot_data, rate_usd)
+            logger.debug(f"Fetched TON price: {rate_usd} USD")
+            return rate_usd
     except Exception as e:
         logger.error(f"Error fetching TON price: {e}")
         return None
@@ -170,6 +358,7 @@ def login_required(f):
     return decorated
 
 
+@instrumented("tonprice")
 async def ton_price_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     logger.debug(f"Entering ton_price_command: user_id={user_id}")
@@ -192,21 +381,13 @@ async def ton_price_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     price = price_record["price"]
                     updated_at = price_record["updated_at"]
                     diff_24h = 0.0
-                    context.bot_data["ton_price_info"] = {
-                        "price": price,
-                        "diff_24h": diff_24h,
-                        "updated_at": updated_at
-                    }
+                    set_ton_price(context.bot_data, price, updated_at)
                     logger.debug(f"Updated bot_data with database price: {price}")
                 else:
                     price = 3.32
                     diff_24h = 0.0
                     updated_at = datetime.now(pytz.UTC)
-                    context.bot_data["ton_price_info"] = {
-                        "price": price,
-                        "diff_24h": diff_24h,
-                        "updated_at": updated_at
-                    }
+                    set_ton_price(context.bot_data, price, updated_at)
                     logger.warning("No TON price in database, using fallback: 3.32")
 
         # Format response
@@ -228,16 +409,6 @@ async def ton_price_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             parse_mode="HTML"
         )
         await log_analytics(user_id, "ton_price_command_error", {"error": str(e)})
-# Database connection (synchronous for Flask)
-
-
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
-        raise
 
 
 async def pre_checkout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -264,22 +435,19 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     logger.info(
         f"Успешный платеж: user_id={user_id}, invoice_payload={payment.invoice_payload}")
     try:
-        async with (await ensure_db_pool()) as conn:
-            await conn.execute(
-                "UPDATE transactions SET checked_status = $1 WHERE invoice_id = $2",
-                "completed", payment.invoice_payload
-            )
-            await update.message.reply_text(
-                "Платеж успешно обработан! Спасибо за покупку.",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
-            )
-            context.user_data["state"] = STATES["main_menu"]
-            try:
-                await log_analytics(user_id, "successful_payment", {"invoice_payload": payment.invoice_payload})
-            except NameError:
-                logger.warning(
-                    "Функция log_analytics не определена, пропускаем логирование аналитики")
+        if lookup_invoice(payment.invoice_payload):
+            await settle_payment(payment.invoice_payload)
+        await update.message.reply_text(
+            "Платеж успешно обработан! Спасибо за покупку.",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]])
+        )
+        context.user_data["state"] = STATES["main_menu"]
+        try:
+            await log_analytics(user_id, "successful_payment", {"invoice_payload": payment.invoice_payload})
+        except NameError:
+            logger.warning(
+                "Функция log_analytics не определена, пропускаем логирование аналитики")
     except Exception as e:
         logger.error(
             f"Ошибка в successful_payment_callback: {e}", exc_info=True)
@@ -339,10 +507,281 @@ def index():
     return redirect(url_for('transactions'))
 
 
+# Admin dashboard database
+#
+# The web panel runs on its own small thread pool (admin_executor, handed to
+# the WSGI bridge) and its own bounded psycopg2 pool, so a slow report can tie
+# up neither the event loop's default executor nor the bot's asyncpg pool.
+# Connections are reused across requests and carry a server-side
+# statement_timeout; broken ones are discarded on release. Per-route latency
+# and pool usage are exposed through get_admin_db_stats().
+admin_executor = ThreadPoolExecutor(max_workers=ADMIN_WSGI_THREADS, thread_name_prefix="admin-wsgi")
+_admin_db_pool = None
+_admin_db_pool_lock = threading.Lock()
+_admin_db_slots = threading.BoundedSemaphore(ADMIN_DB_POOL_MAX_SIZE)
+_admin_stats_lock = threading.Lock()
+_admin_db_stats = {
+    "acquires": 0,
+    "acquire_timeouts": 0,
+    "in_use": 0,
+    "discarded": 0
+}
+_admin_route_stats = {}
+
+
+def _get_admin_db_pool():
+    global _admin_db_pool
+    with _admin_db_pool_lock:
+        if _admin_db_pool is None or _admin_db_pool.closed:
+            _admin_db_pool = psycopg2.pool.ThreadedConnectionPool(
+                ADMIN_DB_POOL_MIN_SIZE,
+                ADMIN_DB_POOL_MAX_SIZE,
+                POSTGRES_URL,
+                connect_timeout=10,
+                application_name="stars-admin",
+                options=f"-c statement_timeout={ADMIN_DB_STATEMENT_TIMEOUT_MS}"
+            )
+            logger.info(f"Admin DB pool created (max={ADMIN_DB_POOL_MAX_SIZE})")
+        return _admin_db_pool
+
+
+@contextmanager
+def admin_db_connection():
+    if not _admin_db_slots.acquire(timeout=ADMIN_DB_ACQUIRE_TIMEOUT):
+        with _admin_stats_lock:
+            _admin_db_stats["acquire_timeouts"] += 1
+        raise psycopg2.pool.PoolError("Admin DB pool exhausted")
+    pool = None
+    conn = None
+    broken = False
+    try:
+        pool = _get_admin_db_pool()
+        conn = pool.getconn()
+        with _admin_stats_lock:
+            _admin_db_stats["acquires"] += 1
+            _admin_db_stats["in_use"] += 1
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            broken = broken or bool(conn.closed)
+            with _admin_stats_lock:
+                _admin_db_stats["in_use"] -= 1
+                if broken:
+                    _admin_db_stats["discarded"] += 1
+            pool.putconn(conn, close=broken)
+    finally:
+        _admin_db_slots.release()
+
+
+def close_admin_db() -> None:
+    global _admin_db_pool
+    with _admin_db_pool_lock:
+        if _admin_db_pool is not None and not _admin_db_pool.closed:
+            _admin_db_pool.closeall()
+            logger.info("Admin DB pool closed")
+        _admin_db_pool = None
+    admin_executor.shutdown(wait=False)
+
+
+@app_flask.before_request
+def _admin_request_started():
+    g.request_started = time.perf_counter()
+
+
+@app_flask.after_request
+def _admin_request_finished(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        route = request.endpoint or "unknown"
+        with _admin_stats_lock:
+            stats = _admin_route_stats.setdefault(
+                route, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["requests"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            if response.status_code >= 500:
+                stats["errors"] += 1
+        observe_request(f"admin:{route}", elapsed_ms / 1000)
+    return response
+
+
+@app_flask.teardown_request
+def _admin_request_failed(error):
+    if error is not None:
+        record_error(f"admin:{request.endpoint or 'unknown'}", error)
+
+
+def get_admin_db_stats() -> dict:
+    with _admin_stats_lock:
+        routes = {
+            route: {
+                **stats,
+                "avg_ms": round(stats["total_ms"] / stats["requests"], 2) if stats["requests"] else 0.0,
+                "total_ms": round(stats["total_ms"], 2),
+                "max_ms": round(stats["max_ms"], 2)
+            }
+            for route, stats in _admin_route_stats.items()
+        }
+        return {**_admin_db_stats, "max_size": ADMIN_DB_POOL_MAX_SIZE, "routes": routes}
+
+
+# Keyset pagination
+#
+# History screens page on (purchase_time, id) / (created_at, user_id) instead
+# of OFFSET, so every page is an index range scan no matter how deep it is.
+# Rows with no timestamp are listed too, first, where PostgreSQL sorts NULLs
+# in a descending order; keyset_condition() gives them their own cursor terms.
+# A cursor is "<epoch micros>_<id>" of the boundary row ("null_<id>" for an
+# undated one); in the bot it travels in callback_data as
+# "<prefix>_<n|p>_<page>_<cursor>" (next/previous, well under Telegram's
+# 64-byte limit), in the web panel as ?after= / ?before=.
+# Pages fetch one extra row to know whether another page exists; the web
+# panel shows an estimated total instead of running COUNT(*) per view.
+_page_count_cache = TTLCache(maxsize=256, ttl=PAGE_COUNT_CACHE_TTL)
+_page_count_lock = threading.Lock()
+
+
+_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    if ts is None:
+        return f"null_{row_id}"
+    return f"{(ts - _CURSOR_EPOCH) // timedelta(microseconds=1)}_{row_id}"
+
+
+def decode_cursor(token: str):
+    micros, row_id = token.split("_")
+    if micros == "null":
+        return None, int(row_id)
+    return _CURSOR_EPOCH + timedelta(microseconds=int(micros)), int(row_id)
+
+
+def keyset_condition(sort_column: str, id_column: str, cursor: tuple, forward: bool, bind) -> str:
+    """Cursor condition for (sort DESC NULLS FIRST, id DESC); bind(value) returns its placeholder."""
+    ts, row_id = cursor
+    if ts is None:
+        if forward:
+            return f"({sort_column} IS NOT NULL OR {id_column} < {bind(row_id)})"
+        return f"({sort_column} IS NULL AND {id_column} > {bind(row_id)})"
+    row = f"({sort_column}, {id_column}) {'<' if forward else '>'} ({bind(ts)}, {bind(row_id)})"
+    # A row comparison against NULL is NULL, so NULL-dated rows need their own term
+    return row if forward else f"({row} OR {sort_column} IS NULL)"
+
+
+def keyset_order(sort_column: str, id_column: str, forward: bool) -> str:
+    if forward:
+        return f"{sort_column} DESC NULLS FIRST, {id_column} DESC"
+    return f"{sort_column} ASC NULLS LAST, {id_column} ASC"
+
+
+def parse_page_callback(data: str, prefix: str):
+    """Return (page, direction, cursor) for '<prefix>[_0]' or '<prefix>_<n|p>_<page>_<cursor>'."""
+    parts = data[len(prefix):].lstrip("_").split("_", 2)
+    if len(parts) == 3 and parts[0] in ("n", "p"):
+        try:
+            return int(parts[1]), parts[0], decode_cursor(parts[2])
+        except ValueError:
+            logger.warning(f"Malformed page cursor in callback: {data}")
+    return 0, None, None
+
+
+def page_callback(prefix: str, direction: str, page: int, ts: datetime, row_id: int) -> str:
+    return f"{prefix}_{direction}_{page}_{encode_cursor(ts, row_id)}"
+
+
+async def fetch_transactions_page(conn, direction, cursor, per_page, user_id=None):
+    """Fetch one page of transactions newest first; returns (rows, has_prev, has_next)."""
+    conditions = ["TRUE"]
+    args = []
+
+    def bind(value) -> str:
+        args.append(value)
+        return f"${len(args)}"
+
+    if user_id is not None:
+        conditions.append(f"user_id = {bind(user_id)}")
+    forward = direction != "p"
+    if cursor is not None:
+        conditions.append(keyset_condition("purchase_time", "id", cursor, forward, bind))
+    rows = await conn.fetch(
+        "SELECT id, user_id, recipient_username, stars_amount, price_ton, purchase_time, checked_status "
+        f"FROM transactions WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {keyset_order('purchase_time', 'id', forward)} LIMIT {bind(per_page + 1)}",
+        *args
+    )
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == "p":
+        return list(reversed(rows)), has_more, True
+    return rows, cursor is not None, has_more
+
+
+def estimate_total(cur, table: str, count_query: str, params: list) -> int:
+    """Planner estimate for unfiltered listings, cached exact count for filtered ones."""
+    if not params:
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", (table,))
+        row = cur.fetchone()
+        if row and row[0] >= 0:
+            return int(row[0])
+    key = (count_query, tuple(params))
+    with _page_count_lock:
+        total = _page_count_cache.get(key)
+    if total is None:
+        cur.execute(count_query, params)
+        total = cur.fetchone()[0]
+        with _page_count_lock:
+            _page_count_cache[key] = total
+    return total
+
+
+def keyset_sql(sort_column: str, id_column: str, after: str, before: str, per_page: int, params: list):
+    """Return the cursor condition and ORDER/LIMIT tail for a newest-first web listing."""
+    cursor_token = after or before
+    condition = ""
+    forward = not before
+
+    def bind(value) -> str:
+        params.append(value)
+        return "%s"
+
+    if cursor_token:
+        condition = " AND " + keyset_condition(sort_column, id_column, decode_cursor(cursor_token), forward, bind)
+    params.append(per_page + 1)
+    return condition, f" ORDER BY {keyset_order(sort_column, id_column, forward)} LIMIT %s"
+
+
+def keyset_window(rows: list, after: str, before: str, per_page: int, sort_index: int, id_index: int):
+    """Trim the extra row and return (rows, prev_cursor, next_cursor)."""
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows = list(reversed(rows))
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = bool(after), has_more
+    if not rows:
+        return rows, None, None
+    prev_cursor = encode_cursor(rows[0][sort_index], rows[0][id_index]) if has_prev else None
+    next_cursor = encode_cursor(rows[-1][sort_index], rows[-1][id_index]) if has_next else None
+    return rows, prev_cursor, next_cursor
+
+
 @app_flask.route('/transactions')
 @login_required
 def transactions():
-    page = int(request.args.get('page', 1))
+    page = max(int(request.args.get('page', 1)), 1)
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
     per_page = 10
     user_id = request.args.get('user_id', '')
     recipient = request.args.get('recipient', '')
@@ -411,21 +850,28 @@ def transactions():
             flash("Maximum stars must be a number.", "error")
             logger.error(f"Invalid max_stars format: {max_stars}")
 
-    query += " ORDER BY purchase_time DESC LIMIT %s OFFSET %s"
-    params.extend([per_page, (page - 1) * per_page])
+    filter_params = list(params)
+    try:
+        cursor_condition, order_limit = keyset_sql("purchase_time", "id", after, before, per_page, params)
+    except ValueError:
+        logger.error(f"Invalid transactions cursor: after={after}, before={before}")
+        after = before = ''
+        params = list(filter_params)
+        cursor_condition, order_limit = keyset_sql("purchase_time", "id", after, before, per_page, params)
+    query += cursor_condition + order_limit
 
     for attempt in range(3):
         try:
-            conn = psycopg2.connect(POSTGRES_URL)
-            cur = conn.cursor()
-            cur.execute(query, params)
-            transactions = cur.fetchall()
-            cur.execute(count_query, params[:-2])
-            total = cur.fetchone()[0]
-            cur.close()
-            conn.close()
-
-            total_pages = (total + per_page - 1) // per_page
+            with admin_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    transactions = cur.fetchall()
+                    total = estimate_total(cur, "transactions", count_query, filter_params)
+
+            transactions, prev_cursor, next_cursor = keyset_window(transactions, after, before, per_page, 5, 0)
+            if not prev_cursor:
+                page = 1
+            total_pages = max((total + per_page - 1) // per_page, page)
             eest = pytz.timezone("Europe/Tallinn")
             transactions = [
                 {
@@ -434,7 +880,7 @@ def transactions():
                     "recipient_username": t[2],
                     "stars_amount": t[3],
                     "price_ton": t[4],
-                    "purchase_time": t[5].astimezone(eest).strftime("%Y-%m-%d %H:%M:%S EEST"),
+                    "purchase_time": t[5].astimezone(eest).strftime("%Y-%m-%d %H:%M:%S EEST") if t[5] else "—",
                     "checked_status": t[6]
                 }
                 for t in transactions
@@ -447,6 +893,8 @@ def transactions():
                 transactions=transactions,
                 page=page,
                 total_pages=total_pages,
+                prev_cursor=prev_cursor,
+                next_cursor=next_cursor,
                 user_id=user_id,
                 start_date=start_date,
                 end_date=end_date,
@@ -465,6 +913,8 @@ def transactions():
                 transactions=[],
                 page=1,
                 total_pages=1,
+                prev_cursor=None,
+                next_cursor=None,
                 user_id=user_id,
                 start_date=start_date,
                 end_date=end_date,
@@ -477,14 +927,16 @@ def transactions():
 @app_flask.route('/users')
 @login_required
 def users():
-    page = int(request.args.get('page', 1))
+    page = max(int(request.args.get('page', 1)), 1)
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
     per_page = 10
     user_id = request.args.get('user_id', '')
     username = request.args.get('username', '')
     is_admin = request.args.get('is_admin', '')
 
     query = """
-        SELECT user_id, username, stars_bought, ref_bonus_ton, referrals, created_at, is_new, is_admin, prefix
+        SELECT user_id, username, stars_bought, ref_bonus_ton, ref_count, created_at, is_new, is_admin, prefix
         FROM users WHERE 1=1
     """
     count_query = """
@@ -511,29 +963,36 @@ def users():
         count_query += " AND is_admin = %s"
         params.append(is_admin == 'true')
 
-    query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-    params.extend([per_page, (page - 1) * per_page])
+    filter_params = list(params)
+    try:
+        cursor_condition, order_limit = keyset_sql("created_at", "user_id", after, before, per_page, params)
+    except ValueError:
+        logger.error(f"Invalid users cursor: after={after}, before={before}")
+        after = before = ''
+        params = list(filter_params)
+        cursor_condition, order_limit = keyset_sql("created_at", "user_id", after, before, per_page, params)
+    query += cursor_condition + order_limit
 
     for attempt in range(3):
         try:
-            conn = psycopg2.connect(POSTGRES_URL)
-            cur = conn.cursor()
-            cur.execute(query, params)
-            users = cur.fetchall()
-            cur.execute(count_query, params[:-2])
-            total = cur.fetchone()[0]
-            cur.close()
-            conn.close()
-
-            total_pages = (total + per_page - 1) // per_page
+            with admin_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    users = cur.fetchall()
+                    total = estimate_total(cur, "users", count_query, filter_params)
+
+            users, prev_cursor, next_cursor = keyset_window(users, after, before, per_page, 5, 0)
+            if not prev_cursor:
+                page = 1
+            total_pages = max((total + per_page - 1) // per_page, page)
             users = [
                 {
                     "user_id": u[0],
                     "username": u[1],
                     "stars_bought": u[2],
                     "ref_bonus_ton": u[3],
-                    "referrals": u[4] if u[4] is not None else [],
-                    "created_at": u[5].strftime("%Y-%m-%d %H:%M:%S"),
+                    "ref_count": u[4] or 0,
+                    "created_at": u[5].strftime("%Y-%m-%d %H:%M:%S") if u[5] else "—",
                     "is_new": u[6],
                     "is_admin": u[7],
                     "prefix": u[8]
@@ -548,6 +1007,8 @@ def users():
                 users=users,
                 page=page,
                 total_pages=total_pages,
+                prev_cursor=prev_cursor,
+                next_cursor=next_cursor,
                 user_id=user_id,
                 username=username,
                 is_admin=is_admin
@@ -563,6 +1024,8 @@ def users():
                 users=[],
                 page=1,
                 total_pages=1,
+                prev_cursor=None,
+                next_cursor=None,
                 user_id=user_id,
                 username=username,
                 is_admin=is_admin
@@ -578,209 +1041,1078 @@ def update_status():
     user_id = data.get('user_id')
     value = data.get('value')
 
+    if type_ == 'user' and field == 'prefix' and value not in ['Beginner', 'Newbie', 'Buyer', 'Regular Buyer', 'Verified']:
+        logger.error(f"Invalid prefix value: {value}")
+        return jsonify({'message': 'Invalid prefix value'}), 400
+
     try:
-        conn = psycopg2.connect(POSTGRES_URL)
-        cur = conn.cursor()
-        if type_ == 'user' and field in ['is_admin', 'prefix']:
-            if field == 'prefix' and value not in ['Beginner', 'Newbie', 'Buyer', 'Regular Buyer', 'Verified']:
-                logger.error(f"Invalid prefix value: {value}")
-                cur.close()
-                conn.close()
-                return jsonify({'message': 'Invalid prefix value'}), 400
-            cur.execute(f"UPDATE users SET {field} = %s WHERE user_id = %s",
-                        (value if field == 'prefix' else value == 'true', int(user_id)))
-            conn.commit()
-            logger.info(f"Updated {field} for user_id={user_id} to {value}")
-            cur.close()
-            conn.close()
-            return jsonify({'message': f'{field} updated for user {user_id}'})
-        elif type_ == 'transaction' and field == 'checked_status':
-            cur.execute(
-                "UPDATE transactions SET checked_status = %s WHERE id = %s", (value, int(user_id)))
-            conn.commit()
-            logger.info(
-                f"Updated checked_status for transaction_id={user_id} to {value}")
-            cur.close()
-            conn.close()
-            return jsonify({'message': f'Status updated for transaction {user_id}'})
-        else:
-            logger.error(f"Invalid type or field: type={type_}, field={field}")
-            cur.close()
-            conn.close()
-            return jsonify({'message': 'Invalid type or field'}), 400
+        with admin_db_connection() as conn:
+            with conn.cursor() as cur:
+                if type_ == 'user' and field in ['is_admin', 'prefix']:
+                    cur.execute(f"UPDATE users SET {field} = %s WHERE user_id = %s",
+                                (value if field == 'prefix' else value == 'true', int(user_id)))
+                    conn.commit()
+                    invalidate_user_profile(user_id)
+                    invalidate_stats_counters()
+                    logger.info(f"Updated {field} for user_id={user_id} to {value}")
+                    return jsonify({'message': f'{field} updated for user {user_id}'})
+                elif type_ == 'transaction' and field == 'checked_status':
+                    cur.execute(
+                        "UPDATE transactions SET checked_status = %s WHERE id = %s", (value, int(user_id)))
+                    conn.commit()
+                    invalidate_stats_counters()
+                    logger.info(
+                        f"Updated checked_status for transaction_id={user_id} to {value}")
+                    return jsonify({'message': f'Status updated for transaction {user_id}'})
+        logger.error(f"Invalid type or field: type={type_}, field={field}")
+        return jsonify({'message': 'Invalid type or field'}), 400
     except Exception as e:
         logger.error(f"Error updating status: {e}", exc_info=True)
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
         return jsonify({'message': f'Error updating status: {str(e)}'}), 500
 
 
+# Database pool manager
+#
+# The hot path (ensure_db_pool / get_db_connection) never takes a lock and never
+# probes the database: it hands out the current pool or fails fast while the
+# circuit breaker is open. Liveness is checked by check_db_health, which runs
+# from the scheduler, rebuilds the pool when the probe fails and opens the
+# circuit once the database has been unreachable for several probes in a row.
 _db_pool: Pool | None = None
-_db_pool_lock = asyncio.Lock()
+_db_pool_lock = asyncio.Lock()  # serializes pool (re)creation only
+_db_pool_closing = set()  # close tasks of retired pools, referenced until they finish
+_db_circuit = {
+    "open": False,
+    "opened_at": None,
+    "consecutive_failures": 0,
+    "last_check": None,
+    "last_error": None,
+}
+_db_pool_stats = {
+    "acquires": 0,
+    "waiters": 0,
+    "acquire_timeouts": 0,
+    "acquire_wait_total": 0.0,
+    "acquire_wait_max": 0.0,
+    "hold_total": 0.0,
+    "hold_max": 0.0,
+    "rebuilds": 0,
+}
 
 
-async def ensure_db_pool():
-    global _db_pool
-    max_retries = 5
-    retry_delay = 2
-    DATABASE_URL = os.getenv("DATABASE_URL")
+def _db_pool_usable(pool: Pool | None) -> bool:
+    return pool is not None and not pool.is_closing()
 
-    async with _db_pool_lock:
-        if _db_pool is not None and not _db_pool._closed and not _db_pool._closing:
-            try:
-                async with _db_pool.acquire() as conn:
-                    await conn.execute("SELECT 1")
-                logger.debug("Reusing existing database pool")
-                return _db_pool
-            except Exception as e:
-                logger.warning(f"Existing pool is invalid: {e}, will recreate")
 
+async def _close_db_pool(pool: Pool) -> None:
+    try:
+        await asyncio.wait_for(pool.close(), timeout=10.0)
+        logger.debug("Closed replaced database pool")
+    except asyncio.TimeoutError:
+        logger.warning("Timeout closing replaced database pool, terminating")
+        pool.terminate()
+    except Exception as e:
+        logger.warning(f"Error closing replaced database pool: {e}")
+
+
+async def _create_db_pool(stale: Pool | None = None, max_retries: int = 5, retry_delay: float = 2) -> Pool:
+    global _db_pool
+    async with _db_pool_lock:
+        # Another coroutine may have rebuilt the pool while we waited for the lock
+        if _db_pool is not stale and _db_pool_usable(_db_pool):
+            return _db_pool
         for attempt in range(max_retries):
             try:
-                logger.info(f"Creating new database pool (attempt {attempt + 1}/{max_retries})")
-                if _db_pool is not None:
-                    try:
-                        # Use a short timeout to avoid long waits
-                        await asyncio.wait_for(_db_pool.close(), timeout=5.0)
-                        logger.debug("Closed existing pool")
-                    except asyncio.TimeoutError:
-                        logger.warning("Timeout closing existing pool, proceeding anyway")
-                    except Exception as e:
-                        logger.warning(f"Error closing existing pool: {e}")
-                _db_pool = await asyncpg.create_pool(
+                logger.info(
+                    f"Creating new database pool (attempt {attempt + 1}/{max_retries})")
+                pool = await asyncpg.create_pool(
                     dsn=DATABASE_URL,
-                    min_size=2,
-                    max_size=20,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
                     max_inactive_connection_lifetime=300,
                     timeout=30,
-                    command_timeout=10
+                    init=_init_db_connection
                 )
-                async with _db_pool.acquire() as conn:
-                    await conn.execute("SELECT 1")
+                try:
+                    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                        await conn.execute("SELECT 1")
+                except Exception:
+                    await _close_db_pool(pool)
+                    raise
                 logger.debug("Database pool created and validated successfully")
-                return _db_pool
+                old_pool, _db_pool = _db_pool, pool
+                if old_pool is not None:
+                    _db_pool_stats["rebuilds"] += 1
+                    task = asyncio.create_task(_close_db_pool(old_pool))
+                    _db_pool_closing.add(task)
+                    task.add_done_callback(_db_pool_closing.discard)
+                return pool
             except Exception as e:
-                logger.error(f"Failed to create/validate pool (attempt {attempt + 1}/{max_retries}): {e}")
+                logger.warning(
+                    f"Failed to create/validate pool (attempt {attempt + 1}/{max_retries}): {e}")
                 if attempt + 1 < max_retries:
                     await asyncio.sleep(retry_delay)
-                continue
         logger.error(f"Failed to create pool after {max_retries} attempts")
-        raise asyncpg.exceptions.InterfaceError("Failed to establish database connection pool")
+        raise asyncpg.exceptions.InterfaceError(
+            "Failed to establish database connection pool")
+
+
+async def ensure_db_pool() -> Pool:
+    if _db_circuit["open"]:
+        raise asyncpg.exceptions.InterfaceError(
+            "Database circuit breaker is open")
+    pool = _db_pool
+    if _db_pool_usable(pool):
+        return pool
+    return await _create_db_pool(pool)
+
 
 @asynccontextmanager
 async def get_db_connection():
     pool = await ensure_db_pool()
-    async with pool.acquire() as conn:
+    _db_pool_stats["waiters"] += 1
+    wait_start = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _db_pool_stats["acquire_timeouts"] += 1
+        raise
+    finally:
+        _db_pool_stats["waiters"] -= 1
+    wait = time.perf_counter() - wait_start
+    _db_pool_stats["acquires"] += 1
+    _db_pool_stats["acquire_wait_total"] += wait
+    _db_pool_stats["acquire_wait_max"] = max(_db_pool_stats["acquire_wait_max"], wait)
+    DB_ACQUIRE_WAIT.observe(wait)
+    held_since = time.perf_counter()
+    try:
         yield conn
-async def init_db():
+    finally:
+        held = time.perf_counter() - held_since
+        _db_pool_stats["hold_total"] += held
+        _db_pool_stats["hold_max"] = max(_db_pool_stats["hold_max"], held)
+        DB_HOLD_TIME.observe(held)
+        await pool.release(conn)
+
+
+def _record_db_health(error: Exception | None) -> None:
+    _db_circuit["last_check"] = datetime.now(pytz.UTC)
+    if error is None:
+        if _db_circuit["open"]:
+            logger.info("Database is reachable again, closing circuit breaker")
+        _db_circuit.update(open=False, opened_at=None,
+                           consecutive_failures=0, last_error=None)
+        return
+    _db_circuit["consecutive_failures"] += 1
+    _db_circuit["last_error"] = str(error)
+    if not _db_circuit["open"] and _db_circuit["consecutive_failures"] >= DB_CIRCUIT_FAILURE_THRESHOLD:
+        _db_circuit["open"] = True
+        _db_circuit["opened_at"] = datetime.now(pytz.UTC)
+        logger.error(
+            f"Database unreachable for {_db_circuit['consecutive_failures']} checks, opening circuit breaker")
+
+
+@instrumented("job:check_db_health")
+async def check_db_health(context=None) -> None:
+    pool = _db_pool
     try:
-        async with (await ensure_db_pool()) as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    stars_bought INTEGER DEFAULT 0,
-                    ref_bonus_ton FLOAT DEFAULT 0.0,
-                    referrals JSONB DEFAULT '[]',
-                    is_new BOOLEAN DEFAULT TRUE,
-                    is_admin BOOLEAN DEFAULT FALSE,
-                    is_banned BOOLEAN DEFAULT FALSE,
-                    prefix TEXT DEFAULT 'Beginner',
-                    referrer_id BIGINT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            logger.info("Users table created or verified")
-
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    recipient_username TEXT,
-                    stars_amount INTEGER,
-                    price_ton FLOAT,
-                    purchase_time TIMESTAMP WITH TIME ZONE,
-                    checked_status TEXT DEFAULT 'pending',
-                    invoice_id TEXT
-                )
-            """)
-            logger.info("Transactions table created or verified")
+        if not _db_pool_usable(pool):
+            raise asyncpg.exceptions.InterfaceError("Database pool is closed")
+        # A saturated pool is being exercised by handlers right now; probing it
+        # would only queue behind them and report a false failure.
+        if pool.get_idle_size() == 0 and pool.get_size() >= pool.get_max_size():
+            _record_db_health(None)
+            return
+        async with asyncio.timeout(DB_HEALTH_CHECK_TIMEOUT):
+            async with pool.acquire() as conn:
+                await conn.execute("SELECT 1")
+    except Exception as e:
+        logger.warning(f"Database health probe failed: {e}, rebuilding pool")
+        try:
+            await _create_db_pool(pool, max_retries=1)
+        except Exception as rebuild_error:
+            _record_db_health(rebuild_error)
+            return
+    _record_db_health(None)
+    try:
+        await ensure_pg_listener()
+    except Exception as e:
+        logger.warning(f"Failed to (re)start Postgres listener: {e}")
+
+
+def get_db_pool_stats() -> dict:
+    pool = _db_pool
+    acquires = _db_pool_stats["acquires"]
+    stats = {
+        "usable": _db_pool_usable(pool),
+        "size": pool.get_size() if pool else 0,
+        "idle": pool.get_idle_size() if pool else 0,
+        "min_size": pool.get_min_size() if pool else DB_POOL_MIN_SIZE,
+        "max_size": pool.get_max_size() if pool else DB_POOL_MAX_SIZE,
+        "waiters": _db_pool_stats["waiters"],
+        "acquires": acquires,
+        "acquire_timeouts": _db_pool_stats["acquire_timeouts"],
+        "acquire_wait_avg_ms": round(_db_pool_stats["acquire_wait_total"] / acquires * 1000, 3) if acquires else 0.0,
+        "acquire_wait_max_ms": round(_db_pool_stats["acquire_wait_max"] * 1000, 3),
+        "hold_avg_ms": round(_db_pool_stats["hold_total"] / acquires * 1000, 3) if acquires else 0.0,
+        "hold_max_ms": round(_db_pool_stats["hold_max"] * 1000, 3),
+        "rebuilds": _db_pool_stats["rebuilds"],
+        "circuit_open": _db_circuit["open"],
+        "consecutive_failures": _db_circuit["consecutive_failures"],
+        "last_error": _db_circuit["last_error"],
+    }
+    for key in ("opened_at", "last_check"):
+        stats[key] = _db_circuit[key].isoformat() if _db_circuit[key] else None
+    stats["in_use"] = stats["size"] - stats["idle"]
+    return stats
+
+# Query tracing
+#
+# Every pooled connection gets a query logger (asyncpg calls it after each
+# statement) that folds latency into per-statement stats keyed by a
+# fingerprint of the normalized SQL, and into the bot_db_query_seconds
+# histogram labelled with that fingerprint. Statements slower than
+# DB_SLOW_QUERY_MS go to the slow-query log with their arguments kept in
+# memory, so /debug/db?explain=<fingerprint> can show the plan of the slowest
+# sample on demand. Stats for at most DB_TRACE_MAX_STATEMENTS distinct
+# statements are kept; the rest are folded into "other". The reset asyncpg
+# runs when a connection goes back to the pool is pool overhead rather than a
+# bot statement, so it is tallied apart and reported with the pool stats.
+_POOL_RESET_STATEMENTS = frozenset((
+    "SELECT pg_advisory_unlock_all();", "CLOSE ALL;", "UNLISTEN *;", "RESET ALL;"
+))
+_SQL_SPACES = re.compile(r"\s+")
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?\b")
+_statement_stats = {}
+_pool_reset_stats = {"calls": 0, "total_time": 0.0, "max_time": 0.0}
+_slow_queries = deque(maxlen=DB_SLOW_QUERY_LOG_SIZE)
+slow_query_logger = logging.getLogger(f"{__name__}.slow_queries")
+
+
+@lru_cache(maxsize=2048)
+def fingerprint_statement(query: str) -> tuple[str, str]:
+    normalized = _SQL_LITERALS.sub("?", _SQL_SPACES.sub(" ", query).strip())
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+def _trace_query(record) -> None:
+    if set(record.query.split("\n")) <= _POOL_RESET_STATEMENTS:
+        _pool_reset_stats["calls"] += 1
+        _pool_reset_stats["total_time"] += record.elapsed
+        _pool_reset_stats["max_time"] = max(_pool_reset_stats["max_time"], record.elapsed)
+        return
+    fingerprint, normalized = fingerprint_statement(record.query)
+    stats = _statement_stats.get(fingerprint)
+    if stats is None:
+        if len(_statement_stats) >= DB_TRACE_MAX_STATEMENTS:
+            fingerprint, normalized = "other", "(other statements)"
+        stats = _statement_stats.setdefault(fingerprint, {
+            "statement": normalized[:1000], "calls": 0, "errors": 0, "slow": 0,
+            "total_time": 0.0, "max_time": 0.0, "sample": None
+        })
+    elapsed = record.elapsed
+    stats["calls"] += 1
+    stats["total_time"] += elapsed
+    if record.exception is not None:
+        stats["errors"] += 1
+    DB_QUERY_TIME.labels(fingerprint).observe(elapsed)
+    if elapsed * 1000 < DB_SLOW_QUERY_MS:
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        return
+    stats["slow"] += 1
+    if elapsed >= stats["max_time"]:
+        stats["max_time"] = elapsed
+        stats["sample"] = (record.query, record.args)
+    _slow_queries.append({
+        "fingerprint": fingerprint,
+        "elapsed_ms": round(elapsed * 1000, 3),
+        "error": type(record.exception).__name__ if record.exception else None,
+        "at": datetime.now(pytz.UTC).isoformat()
+    })
+    slow_query_logger.warning(f"Slow query {fingerprint} took {elapsed * 1000:.1f}ms: {normalized[:500]}")
+
+
+async def _init_db_connection(conn) -> None:
+    conn.add_query_logger(_trace_query)
+
+
+async def explain_statement(fingerprint: str) -> str:
+    stats = _statement_stats.get(fingerprint)
+    if not stats or not stats["sample"]:
+        raise KeyError(f"No slow sample recorded for statement {fingerprint}")
+    query, args = stats["sample"]
+    async with get_db_connection() as conn:
+        rows = await conn.fetch(f"EXPLAIN {query}", *args)
+    return "\n".join(row[0] for row in rows)
+
+
+def get_pool_reset_stats() -> dict:
+    calls = _pool_reset_stats["calls"]
+    return {
+        "calls": calls,
+        "total_ms": round(_pool_reset_stats["total_time"] * 1000, 3),
+        "avg_ms": round(_pool_reset_stats["total_time"] / calls * 1000, 3) if calls else 0.0,
+        "max_ms": round(_pool_reset_stats["max_time"] * 1000, 3)
+    }
+
+
+def get_statement_stats(limit: int = 20) -> list:
+    top = sorted(_statement_stats.items(), key=lambda item: item[1]["total_time"], reverse=True)[:limit]
+    return [
+        {
+            "fingerprint": fingerprint,
+            "statement": stats["statement"],
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "slow": stats["slow"],
+            "total_ms": round(stats["total_time"] * 1000, 3),
+            "avg_ms": round(stats["total_time"] / stats["calls"] * 1000, 3) if stats["calls"] else 0.0,
+            "max_ms": round(stats["max_time"] * 1000, 3),
+            "explainable": stats["sample"] is not None
+        }
+        for fingerprint, stats in top
+    ]
+
+
+# Postgres LISTEN connection
+#
+# LISTEN is session state, so notifications arrive on one dedicated connection
+# kept outside the pool. Subsystems register a channel with a notify callback
+# and a resync hook; the hook runs after every (re)connect to catch up on
+# anything published while the listener was down. check_db_health() restarts
+# the listener when its connection drops.
+_pg_listener_conn = None
+_pg_listener_lock = asyncio.Lock()
+_pg_channels = {}
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value FLOAT
+
+def register_pg_channel(channel: str, on_notify, on_resync=None) -> None:
+    _pg_channels[channel] = (on_notify, on_resync)
+
+
+def _pg_notify_dispatcher(on_notify):
+    def dispatch(connection, pid, channel, payload):
+        try:
+            on_notify(payload)
+        except Exception as e:
+            logger.error(f"Error handling NOTIFY on {channel}: {e}", exc_info=True)
+    return dispatch
+
+
+async def ensure_pg_listener() -> None:
+    global _pg_listener_conn
+    if not _pg_channels:
+        return
+    async with _pg_listener_lock:
+        if _pg_listener_conn is not None and not _pg_listener_conn.is_closed():
+            return
+        conn = await asyncpg.connect(dsn=DATABASE_URL, timeout=30)
+        try:
+            for channel, (on_notify, _) in _pg_channels.items():
+                await conn.add_listener(channel, _pg_notify_dispatcher(on_notify))
+        except Exception:
+            await conn.close()
+            raise
+        _pg_listener_conn = conn
+        logger.info(f"Listening on Postgres channels: {', '.join(_pg_channels)}")
+    for channel, (_, on_resync) in _pg_channels.items():
+        if on_resync is not None:
+            try:
+                await on_resync()
+            except Exception as e:
+                logger.error(f"Failed to resync {channel} after listener connect: {e}", exc_info=True)
+
+
+async def close_pg_listener() -> None:
+    global _pg_listener_conn
+    if _pg_listener_conn is not None and not _pg_listener_conn.is_closed():
+        await _pg_listener_conn.close()
+        logger.info("Postgres listener connection closed")
+    _pg_listener_conn = None
+
+
+# User profile cache
+#
+# Bounded TTL cache of the identity fields nearly every update needs, keyed by
+# user_id. Write paths call invalidate_user_profile() so handlers can answer
+# from memory; the TTL bounds staleness for writes made elsewhere (the Flask
+# dashboard runs in WSGI worker threads, hence the lock).
+user_profile_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_profile_lock = threading.Lock()
+_user_profile_epoch = 0  # bumped on every invalidation to discard in-flight loads
+
+USER_PROFILE_QUERY = (
+    "SELECT username, is_admin, is_banned, stars_bought, referrer_id, ref_bonus_ton, "
+    "ref_count "
+    "FROM users WHERE user_id = $1"
+)
+
+
+def _build_user_profile(row) -> dict:
+    if row is None:
+        return {
+            "exists": False,
+            "username": None,
+            "is_admin": False,
+            "is_banned": False,
+            "stars_bought": 0,
+            "referrer_id": None,
+            "ref_count": 0,
+            "ref_bonus_ton": 0.0
+        }
+    return {
+        "exists": True,
+        "username": row["username"],
+        "is_admin": bool(row["is_admin"]),
+        "is_banned": bool(row["is_banned"]),
+        "stars_bought": row["stars_bought"] or 0,
+        "referrer_id": row["referrer_id"],
+        "ref_count": row["ref_count"] or 0,
+        "ref_bonus_ton": row["ref_bonus_ton"] or 0.0
+    }
+
+
+async def get_user_profile(user_id: int, conn=None) -> dict:
+    with _user_profile_lock:
+        profile = user_profile_cache.get(user_id)
+        epoch = _user_profile_epoch
+    if profile is not None:
+        return profile
+    if conn is None:
+        async with get_db_connection() as conn:
+            row = await conn.fetchrow(USER_PROFILE_QUERY, user_id)
+    else:
+        row = await conn.fetchrow(USER_PROFILE_QUERY, user_id)
+    profile = _build_user_profile(row)
+    with _user_profile_lock:
+        if epoch == _user_profile_epoch:
+            user_profile_cache[user_id] = profile
+    return profile
+
+
+def invalidate_user_profile(*user_ids) -> None:
+    global _user_profile_epoch
+    with _user_profile_lock:
+        _user_profile_epoch += 1
+        for user_id in user_ids:
+            if user_id is not None:
+                user_profile_cache.pop(int(user_id), None)
+
+
+# Sales counters
+#
+# Totals shown on the welcome and admin screens live in stats_counters and
+# are maintained by row triggers on users and transactions, so every write
+# path (signup, settlement, admin edits in the bot or the web panel) updates
+# them in the same transaction as the data. Reads go through a short-lived
+# in-process cache; reconcile_stats_counters() recomputes them once a day and
+# logs any drift it corrects.
+STATS_COUNTER_KEYS = ("total_users", "total_stars", "total_referrals", "completed_transactions", "completed_ton")
+STATS_AGGREGATE_QUERY = """
+    SELECT
+        (SELECT COUNT(*) FROM users)::float8 AS total_users,
+        (SELECT COALESCE(SUM(stars_bought), 0) FROM users)::float8 AS total_stars,
+        (SELECT COUNT(*) FROM referrals)::float8 AS total_referrals,
+        (SELECT COUNT(*) FROM transactions WHERE checked_status = 'completed')::float8 AS completed_transactions,
+        (SELECT COALESCE(SUM(price_ton), 0) FROM transactions WHERE checked_status = 'completed')::float8 AS completed_ton
+"""
+_stats_cache = {"values": None, "loaded_at": 0.0}
+
+
+async def init_stats_counters(conn) -> None:
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION stats_bump_users() RETURNS trigger AS $$
+        DECLARE
+            d_users float8 := 0;
+            d_stars float8 := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                d_stars := d_stars + COALESCE(NEW.stars_bought, 0);
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                d_stars := d_stars - COALESCE(OLD.stars_bought, 0);
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                d_users := 1;
+            ELSIF TG_OP = 'DELETE' THEN
+                d_users := -1;
+            END IF;
+            UPDATE stats_counters
+            SET value = value + CASE key WHEN 'total_users' THEN d_users ELSE d_stars END
+            WHERE (key = 'total_users' AND d_users <> 0)
+               OR (key = 'total_stars' AND d_stars <> 0);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION stats_bump_transactions() RETURNS trigger AS $$
+        DECLARE
+            d_count float8 := 0;
+            d_ton float8 := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.checked_status = 'completed' THEN
+                d_count := d_count + 1;
+                d_ton := d_ton + COALESCE(NEW.price_ton, 0);
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.checked_status = 'completed' THEN
+                d_count := d_count - 1;
+                d_ton := d_ton - COALESCE(OLD.price_ton, 0);
+            END IF;
+            UPDATE stats_counters
+            SET value = value + CASE key WHEN 'completed_transactions' THEN d_count ELSE d_ton END
+            WHERE (key = 'completed_transactions' AND d_count <> 0)
+               OR (key = 'completed_ton' AND d_ton <> 0);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    async with conn.transaction():
+        # Block writers while the triggers are (re)installed and the counters
+        # seeded, so no row change is counted twice or missed.
+        await conn.execute("LOCK TABLE users, transactions IN SHARE ROW EXCLUSIVE MODE")
+        await conn.execute("DROP TRIGGER IF EXISTS stats_users ON users")
+        await conn.execute("""
+            CREATE TRIGGER stats_users
+            AFTER INSERT OR DELETE OR UPDATE OF stars_bought ON users
+            FOR EACH ROW EXECUTE FUNCTION stats_bump_users()
+        """)
+        await conn.execute("DROP TRIGGER IF EXISTS stats_transactions ON transactions")
+        await conn.execute("""
+            CREATE TRIGGER stats_transactions
+            AFTER INSERT OR DELETE OR UPDATE OF checked_status, price_ton ON transactions
+            FOR EACH ROW EXECUTE FUNCTION stats_bump_transactions()
+        """)
+        seeded = await conn.fetchval("SELECT COUNT(*) FROM stats_counters")
+        if seeded < len(STATS_COUNTER_KEYS):
+            totals = await conn.fetchrow(STATS_AGGREGATE_QUERY)
+            await conn.executemany(
+                "INSERT INTO stats_counters (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+                [(key, totals[key]) for key in STATS_COUNTER_KEYS]
+            )
+            logger.info(f"Stats counters seeded: {dict(totals)}")
+
+
+async def get_stats_counters(conn=None) -> dict:
+    cached = _stats_cache["values"]
+    if cached is not None and time.monotonic() - _stats_cache["loaded_at"] < STATS_CACHE_TTL:
+        return cached
+    if conn is None:
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("SELECT key, value FROM stats_counters")
+    else:
+        rows = await conn.fetch("SELECT key, value FROM stats_counters")
+    values = dict.fromkeys(STATS_COUNTER_KEYS, 0)
+    values.update({r["key"]: r["value"] for r in rows})
+    for key in ("total_users", "total_stars", "total_referrals", "completed_transactions"):
+        values[key] = int(values[key])
+    _stats_cache["values"] = values
+    _stats_cache["loaded_at"] = time.monotonic()
+    return values
+
+
+def invalidate_stats_counters() -> None:
+    _stats_cache["values"] = None
+
+
+@instrumented("job:reconcile_stats_counters")
+async def reconcile_stats_counters(context=None) -> None:
+    try:
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                await conn.execute("LOCK TABLE users, transactions IN SHARE MODE")
+                totals = await conn.fetchrow(STATS_AGGREGATE_QUERY)
+                current = {r["key"]: r["value"] for r in await conn.fetch("SELECT key, value FROM stats_counters")}
+                drift = {
+                    key: totals[key] - current.get(key, 0)
+                    for key in STATS_COUNTER_KEYS
+                    if abs(totals[key] - current.get(key, 0)) > 1e-6
+                }
+                if drift:
+                    await conn.executemany(
+                        "INSERT INTO stats_counters (key, value) VALUES ($1, $2) "
+                        "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                        [(key, totals[key]) for key in drift]
+                    )
+        if drift:
+            logger.warning(f"Stats counters drift corrected: {drift}")
+            invalidate_stats_counters()
+        else:
+            logger.info("Stats counters reconciled, no drift")
+    except Exception as e:
+        logger.error(f"Failed to reconcile stats counters: {e}", exc_info=True)
+
+
+# Referrals
+#
+# Referral links are rows in referrals (one per referred user), not elements
+# of users.referrals JSONB. A trigger keeps users.ref_count and the
+# total_referrals counter in step with the table, so counts and the referral
+# leaderboard are plain index reads. Existing JSONB arrays are copied over by
+# backfill_referrals(), an online batched migration that records its progress
+# in data_migrations and can be resumed by any replica; users.referrals is no
+# longer written and is kept only until that migration has completed.
+REFERRALS_BACKFILL = "referrals_from_jsonb"
+_referrals_backfill_task = None
+
+
+async def init_referrals(conn) -> None:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referrals (
+            referred_id BIGINT PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ref_count INTEGER NOT NULL DEFAULT 0")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_migrations (
+            name TEXT PRIMARY KEY,
+            cursor BIGINT NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION referrals_bump() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE users SET ref_count = ref_count - 1 WHERE user_id = OLD.referrer_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE users SET ref_count = ref_count + 1 WHERE user_id = NEW.referrer_id;
+            END IF;
+            IF TG_OP <> 'UPDATE' THEN
+                UPDATE stats_counters
+                SET value = value + CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END
+                WHERE key = 'total_referrals';
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    async with conn.transaction():
+        await conn.execute("DROP TRIGGER IF EXISTS referrals_counts ON referrals")
+        await conn.execute("""
+            CREATE TRIGGER referrals_counts
+            AFTER INSERT OR DELETE OR UPDATE OF referrer_id ON referrals
+            FOR EACH ROW EXECUTE FUNCTION referrals_bump()
+        """)
+        # From here on total_referrals counts referrals rows; starting it at
+        # the table's size lets the backfill's inserts bring it up to date.
+        inserted = await conn.fetchval(
+            "INSERT INTO data_migrations (name) VALUES ($1) ON CONFLICT (name) DO NOTHING RETURNING name",
+            REFERRALS_BACKFILL
+        )
+        if inserted:
+            await conn.execute(
+                "UPDATE stats_counters SET value = (SELECT COUNT(*) FROM referrals) WHERE key = 'total_referrals'"
+            )
+
+
+async def backfill_referrals() -> None:
+    total = 0
+    while True:
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                state = await conn.fetchrow(
+                    "SELECT cursor, completed_at FROM data_migrations WHERE name = $1 FOR UPDATE",
+                    REFERRALS_BACKFILL
                 )
-            """)
-            logger.info("Settings table created or verified")
-
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS analytics (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    action TEXT,
-                    timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    data JSONB
+                if state is None or state["completed_at"] is not None:
+                    break
+                last_user_id = await conn.fetchval(
+                    "SELECT MAX(user_id) FROM (SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2) b",
+                    state["cursor"], REFERRALS_BACKFILL_BATCH
                 )
-            """)
-            logger.info("Analytics table created or verified")
-
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    reminder_date DATE,
-                    reminder_type TEXT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                if last_user_id is None:
+                    await conn.execute(
+                        "UPDATE data_migrations SET completed_at = NOW(), updated_at = NOW() WHERE name = $1",
+                        REFERRALS_BACKFILL
+                    )
+                    logger.info(f"Referrals backfill completed, {total} referral(s) copied by this process")
+                    break
+                copied = await conn.fetchval("""
+                    WITH copied AS (
+                        INSERT INTO referrals (referred_id, referrer_id)
+                        SELECT DISTINCT ON (r.referred_id) r.referred_id, u.user_id
+                        FROM users u
+                        CROSS JOIN LATERAL (
+                            SELECT value::bigint AS referred_id
+                            FROM jsonb_array_elements_text(
+                                CASE WHEN jsonb_typeof(u.referrals) = 'array' THEN u.referrals ELSE '[]'::jsonb END
+                            )
+                            WHERE value ~ '^[0-9]{1,18}$'
+                        ) r
+                        WHERE u.user_id > $1 AND u.user_id <= $2 AND r.referred_id <> u.user_id
+                        ORDER BY r.referred_id, u.user_id
+                        ON CONFLICT (referred_id) DO NOTHING
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM copied
+                """, state["cursor"], last_user_id)
+                await conn.execute(
+                    "UPDATE data_migrations SET cursor = $2, updated_at = NOW() WHERE name = $1",
+                    REFERRALS_BACKFILL, last_user_id
                 )
-            """)
-            logger.info("Reminders table created or verified")
+                total += copied
+        await asyncio.sleep(REFERRALS_BACKFILL_PAUSE)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS ton_price (
-                    price FLOAT,
-                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            logger.info("Ton_price table created or verified")
 
-            default_settings = [
-                ("price_usd", 0.81),
-                ("markup", 10.0),
-                ("ref_bonus", 30.0)
-            ]
-            for key, value in default_settings:
-                await conn.execute(
-                    """
-                    INSERT INTO settings (key, value)
-                    VALUES ($1, $2)
-                    ON CONFLICT (key) DO NOTHING
-                    """,
-                    key, value
+def start_referrals_backfill() -> None:
+    global _referrals_backfill_task
+    if _referrals_backfill_task and not _referrals_backfill_task.done():
+        return
+
+    async def run():
+        try:
+            await backfill_referrals()
+        except Exception as e:
+            logger.error(f"Referrals backfill interrupted, will resume on next start: {e}", exc_info=True)
+        invalidate_stats_counters()
+
+    _referrals_backfill_task = asyncio.create_task(run(), name="referrals-backfill")
+
+
+async def stop_referrals_backfill() -> None:
+    # Progress is checkpointed per batch, so the next start resumes from here
+    task = _referrals_backfill_task
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        logger.info("Stopped referrals backfill")
+
+
+# Schema migrations
+#
+# The schema is built by the ordered steps in MIGRATIONS; schema_version
+# records which have been applied, so a normal boot costs one query. Pending
+# steps run under a session advisory lock so replicas starting together do
+# not race; the lock is polled, since a replica blocked in pg_advisory_lock()
+# would stall the other's concurrent index builds. Ordinary steps run in a
+# transaction together with their schema_version row. Index steps use CREATE
+# INDEX CONCURRENTLY, which cannot run in a transaction and does not block
+# writes; an invalid index left by an interrupted build is dropped and
+# rebuilt. Never edit an applied step - add a new one.
+MIGRATION_LOCK_ID = 7451002301
+MIGRATION_LOCK_POLL = 1.0  # seconds between pg_try_advisory_lock attempts
+
+
+def concurrent_index(name: str, definition: str, unique: bool = False):
+    async def step(conn) -> None:
+        valid = await conn.fetchval(
+            "SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass($1)", name
+        )
+        if valid is False:
+            logger.warning(f"Dropping invalid index {name} left by an interrupted build")
+            await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        await conn.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"
+        )
+    step.concurrent = True
+    return step
+
+
+async def _migrate_baseline(conn) -> None:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            stars_bought INTEGER DEFAULT 0,
+            ref_bonus_ton FLOAT DEFAULT 0.0,
+            referrals JSONB DEFAULT '[]',
+            is_new BOOLEAN DEFAULT TRUE,
+            is_admin BOOLEAN DEFAULT FALSE,
+            is_banned BOOLEAN DEFAULT FALSE,
+            prefix TEXT DEFAULT 'Beginner',
+            referrer_id BIGINT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("Users table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            recipient_username TEXT,
+            stars_amount INTEGER,
+            price_ton FLOAT,
+            purchase_time TIMESTAMP WITH TIME ZONE,
+            checked_status TEXT DEFAULT 'pending',
+            invoice_id TEXT
+        )
+    """)
+    logger.info("Transactions table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value FLOAT
+        )
+    """)
+    logger.info("Settings table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            action TEXT,
+            timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            data JSONB
+        )
+    """)
+    logger.info("Analytics table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            reminder_date DATE,
+            reminder_type TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("Reminders table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ton_price (
+            price FLOAT,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("Ton_price table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            created_by BIGINT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            cursor_user_id BIGINT NOT NULL DEFAULT 0,
+            total_users INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            blocked_count INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until TIMESTAMP WITH TIME ZONE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP WITH TIME ZONE,
+            finished_at TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("Broadcast_jobs table created or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
+            board TEXT PRIMARY KEY,
+            entries JSONB NOT NULL DEFAULT '[]',
+            refreshed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("Leaderboard_snapshots table created or verified")
+
+    for key, value in DEFAULT_SETTINGS.items():
+        await conn.execute(
+            """
+            INSERT INTO settings (key, value)
+            VALUES ($1, $2)
+            ON CONFLICT (key) DO NOTHING
+            """,
+            key, value
+        )
+    logger.info("Default settings inserted or verified")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            key TEXT PRIMARY KEY,
+            value DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+    """)
+    logger.info("Stats_counters table created or verified")
+
+
+async def _migrate_tx_hash(conn) -> None:
+    await conn.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS tx_hash TEXT")
+
+
+async def _migrate_wallet_cursors(conn) -> None:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS wallet_cursors (
+            account TEXT PRIMARY KEY,
+            last_lt BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+async def _migrate_user_state(conn) -> None:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+async def _migrate_cluster_state(conn) -> None:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_state (
+            key TEXT PRIMARY KEY,
+            value JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+async def _migrate_prefix_trigger(conn) -> None:
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION user_prefix(stars INTEGER, admin BOOLEAN) RETURNS TEXT AS $$
+            SELECT CASE
+                WHEN admin THEN 'Verified'
+                WHEN stars >= 50000 THEN 'Verified'
+                WHEN stars >= 10000 THEN 'Regular Buyer'
+                WHEN stars >= 5000 THEN 'Buyer'
+                WHEN stars >= 1000 THEN 'Newbie'
+                ELSE 'Beginner'
+            END
+        $$ LANGUAGE sql IMMUTABLE
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION users_set_prefix() RETURNS trigger AS $$
+        BEGIN
+            NEW.prefix := user_prefix(COALESCE(NEW.stars_bought, 0), COALESCE(NEW.is_admin, FALSE));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS users_prefix ON users")
+    await conn.execute("""
+        CREATE TRIGGER users_prefix
+        BEFORE INSERT OR UPDATE OF stars_bought, is_admin ON users
+        FOR EACH ROW EXECUTE FUNCTION users_set_prefix()
+    """)
+
+
+async def backfill_prefixes() -> int:
+    """Bring users.prefix in line with user_prefix() for existing rows, in batches."""
+    cursor = -(2 ** 63)
+    updated_total = 0
+    while True:
+        async with get_db_connection() as conn:
+            last_user_id, updated = await conn.fetchrow("""
+                WITH batch AS (
+                    SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2
+                ), updated AS (
+                    UPDATE users u SET prefix = user_prefix(COALESCE(u.stars_bought, 0), COALESCE(u.is_admin, FALSE))
+                    FROM batch b
+                    WHERE u.user_id = b.user_id
+                      AND u.prefix IS DISTINCT FROM user_prefix(COALESCE(u.stars_bought, 0), COALESCE(u.is_admin, FALSE))
+                    RETURNING 1
                 )
-            logger.info("Default settings inserted or verified")
-
-            await conn.execute("""
-                UPDATE users SET prefix = CASE
-                    WHEN is_admin THEN 'Verified'
-                    WHEN stars_bought >= 50000 THEN 'Verified'
-                    WHEN stars_bought >= 10000 THEN 'Regular Buyer'
-                    WHEN stars_bought >= 5000 THEN 'Buyer'
-                    WHEN stars_bought >= 1000 THEN 'Newbie'
-                    ELSE 'Beginner'
-                END
-            """)
-            logger.info("User prefixes updated based on stars_bought")
+                SELECT (SELECT MAX(user_id) FROM batch), (SELECT COUNT(*) FROM updated)
+            """, cursor, PREFIX_BACKFILL_BATCH)
+        if last_user_id is None:
+            break
+        cursor = last_user_id
+        updated_total += updated
+        logger.info(f"Prefix backfill: up to user_id={cursor}, {updated_total} row(s) updated")
+        await asyncio.sleep(PREFIX_BACKFILL_PAUSE)
+    logger.info(f"Prefix backfill finished, {updated_total} row(s) updated")
+    return updated_total
+
+
+MIGRATIONS = [
+    (1, "baseline tables and default settings", _migrate_baseline),
+    (2, "referrals table and ref_count", init_referrals),
+    (3, "stats counter triggers", init_stats_counters),
+    (4, "transactions.invoice_id index",
+     concurrent_index("idx_transactions_invoice_id", "transactions (invoice_id)")),
+    (5, "transactions (purchase_time, id) index",
+     concurrent_index("idx_transactions_purchase_time_id", "transactions (purchase_time, id)")),
+    (6, "transactions (user_id, purchase_time, id) index",
+     concurrent_index("idx_transactions_user_purchase_time_id", "transactions (user_id, purchase_time, id)")),
+    (7, "users (created_at, user_id) index",
+     concurrent_index("idx_users_created_at_user_id", "users (created_at, user_id)")),
+    (8, "analytics.timestamp index",
+     concurrent_index("idx_analytics_timestamp", "analytics (timestamp)")),
+    (9, "ton_price.updated_at index",
+     concurrent_index("idx_ton_price_updated_at", "ton_price (updated_at DESC)")),
+    (10, "referrals.referrer_id index",
+     concurrent_index("idx_referrals_referrer", "referrals (referrer_id, created_at)")),
+    (11, "users.ref_count leaderboard index",
+     concurrent_index("idx_users_ref_count", "users (ref_count DESC, user_id) INCLUDE (username) WHERE ref_count > 0")),
+    (12, "prefix trigger on stars_bought / is_admin", _migrate_prefix_trigger),
+    (13, "transactions.tx_hash column", _migrate_tx_hash),
+    (14, "unique transactions.tx_hash index",
+     concurrent_index("idx_transactions_tx_hash", "transactions (tx_hash) WHERE tx_hash IS NOT NULL", unique=True)),
+    (15, "wallet_cursors table", _migrate_wallet_cursors),
+    (16, "pending transactions index",
+     concurrent_index("idx_transactions_pending", "transactions (purchase_time) WHERE checked_status = 'pending'")),
+    (17, "user_state table", _migrate_user_state),
+    (18, "cluster_state table", _migrate_cluster_state),
+]
+
+
+async def _pending_migrations(conn) -> list:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            duration_ms INTEGER
+        )
+    """)
+    applied = {r["version"] for r in await conn.fetch("SELECT version FROM schema_version")}
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+async def run_migrations() -> None:
+    async with get_db_connection() as conn:
+        if not await _pending_migrations(conn):
+            logger.info(f"Database schema is up to date (version {MIGRATIONS[-1][0]})")
+            return
+        # Poll rather than block in pg_advisory_lock(): a waiting statement
+        # holds a snapshot, and CREATE INDEX CONCURRENTLY on the replica that
+        # holds the lock would wait on it
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+            await asyncio.sleep(MIGRATION_LOCK_POLL)
+        try:
+            for version, name, step in await _pending_migrations(conn):
+                started = time.monotonic()
+                logger.info(f"Applying migration {version}: {name}")
+                if getattr(step, "concurrent", False):
+                    await step(conn)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, name, duration_ms) VALUES ($1, $2, $3)",
+                        version, name, int((time.monotonic() - started) * 1000)
+                    )
+                else:
+                    async with conn.transaction():
+                        await step(conn)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, name, duration_ms) VALUES ($1, $2, $3)",
+                            version, name, int((time.monotonic() - started) * 1000)
+                        )
+                logger.info(f"Migration {version} applied in {time.monotonic() - started:.2f}s")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
 
+async def init_db():
+    try:
+        await run_migrations()
+        async with get_db_connection() as conn:
             admin_user_id = 6956377285
             await conn.execute(
                 """
                 INSERT INTO users (user_id, username, is_admin, prefix, created_at)
                 VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
                 ON CONFLICT (user_id) DO UPDATE
-                SET is_admin = EXCLUDED.is_admin, prefix = EXCLUDED.prefix
+                SET is_admin = EXCLUDED.is_admin
+                WHERE users.is_admin IS DISTINCT FROM EXCLUDED.is_admin
                 """,
                 admin_user_id, "Admin", True, "Verified"
             )
@@ -814,96 +2146,831 @@ async def get_text(key: str, **kwargs) -> str:
     return texts.get(key, "Неизвестный текст").format(**kwargs)
 
 
+# Analytics pipeline
+#
+# log_analytics() only enqueues. analytics_flusher() drains the bounded queue
+# and writes batches with COPY once ANALYTICS_BATCH_SIZE events are waiting or
+# ANALYTICS_FLUSH_INTERVAL seconds have passed since the first one arrived.
+# Above the sampling watermark routine events are sampled; when the queue is
+# full they are dropped. Error events are never sampled out.
+ANALYTICS_COLUMNS = ("user_id", "action", "timestamp", "data")
+_analytics_queue: asyncio.Queue = asyncio.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+_analytics_task: asyncio.Task | None = None
+_analytics_stats = {
+    "enqueued": 0,
+    "dropped": 0,
+    "sampled_out": 0,
+    "flushed": 0,
+    "failed": 0,
+    "batches": 0,
+    "last_flush": None,
+}
+
+
 async def log_analytics(user_id: int, action: str, data: dict = None):
     try:
-        async with (await ensure_db_pool()) as conn:
-            await conn.execute(
-                "INSERT INTO analytics (user_id, action, timestamp, data) VALUES ($1, $2, $3, $4)",
-                user_id, action, datetime.now(
-                    pytz.UTC), json.dumps(data) if data else None
-            )
-    except Exception as e:
+        record = (user_id, action, datetime.now(pytz.UTC), json.dumps(data) if data else None)
+    except (TypeError, ValueError) as e:
         logger.error(f"Ошибка логирования аналитики: {e}", exc_info=True)
+        return
+    if (_analytics_queue.qsize() >= ANALYTICS_QUEUE_SIZE * ANALYTICS_SAMPLE_WATERMARK
+            and "error" not in action and random.random() >= ANALYTICS_SAMPLE_RATE):
+        _analytics_stats["sampled_out"] += 1
+        return
+    try:
+        _analytics_queue.put_nowait(record)
+        _analytics_stats["enqueued"] += 1
+    except asyncio.QueueFull:
+        _analytics_stats["dropped"] += 1
+        if _analytics_stats["dropped"] % 1000 == 1:
+            logger.warning(f"Analytics queue full, dropped {_analytics_stats['dropped']} events so far")
 
-logger = logging.getLogger(__name__)
-_db_pool = None
-_db_pool_lock = Lock()
 
+async def _write_analytics_batch(batch: list) -> None:
+    try:
+        async with get_db_connection() as conn:
+            await conn.copy_records_to_table("analytics", records=batch, columns=ANALYTICS_COLUMNS)
+        _analytics_stats["flushed"] += len(batch)
+        _analytics_stats["batches"] += 1
+        _analytics_stats["last_flush"] = datetime.now(pytz.UTC)
+        logger.debug(f"Flushed {len(batch)} analytics events")
+    except Exception as e:
+        _analytics_stats["failed"] += len(batch)
+        logger.error(f"Failed to flush {len(batch)} analytics events: {e}", exc_info=True)
 
-async def ensure_db_pool():
-    global _db_pool
-    max_retries = 5
-    retry_delay = 2
-    async with _db_pool_lock:
-        if _db_pool is not None and not (_db_pool._closed or _db_pool._closing):
-            try:
-                async with _db_pool.acquire() as conn:
-                    await conn.execute("SELECT 1")
-                    logger.debug("Existing database pool is valid")
-                    return _db_pool
-            except Exception as e:
-                logger.warning(f"Existing pool is invalid: {e}, will recreate")
-        for attempt in range(max_retries):
+
+async def analytics_flusher() -> None:
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not (stopping and _analytics_queue.empty()):
+        batch = []
+        deadline = None
+        while len(batch) < ANALYTICS_BATCH_SIZE:
             try:
-                logger.info(
-                    f"Creating new database pool (attempt {attempt + 1}/{max_retries})")
-                if _db_pool:
-                    try:
-                        await _db_pool.close()
-                        logger.debug("Closed existing pool")
-                    except Exception as e:
-                        logger.warning(f"Error closing existing pool: {e}")
-                _db_pool = await asyncpg.create_pool(
-                    dsn=DATABASE_URL,
-                    min_size=1,
-                    max_size=10,
-                    max_inactive_connection_lifetime=300,
-                    timeout=30
-                )
-                async with _db_pool.acquire() as conn:
-                    await conn.execute("SELECT 1")
-                    logger.debug("Database pool validated successfully")
-                return _db_pool
-            except Exception as e:
-                logger.warning(
-                    f"Failed to create/validate pool (attempt {attempt + 1}/{max_retries}): {e}")
-                if attempt + 1 < max_retries:
-                    await asyncio.sleep(retry_delay)
-                continue
-        logger.error(f"Failed to create pool after {max_retries} attempts")
-        raise asyncpg.exceptions.InterfaceError(
-            "Failed to establish database connection pool")
+                if stopping:
+                    record = _analytics_queue.get_nowait()
+                elif deadline is None:
+                    record = await _analytics_queue.get()
+                    deadline = loop.time() + ANALYTICS_FLUSH_INTERVAL
+                else:
+                    record = await asyncio.wait_for(_analytics_queue.get(), deadline - loop.time())
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if record is None:  # shutdown sentinel from flush_analytics()
+                stopping = True
+            else:
+                batch.append(record)
+        if batch:
+            await _write_analytics_batch(batch)
 
 
-async def health_check(request: web.Request) -> web.Response:
-    logger.info("Health check called: %s %s", request.method, request.path)
-    try:
-        pool = await ensure_db_pool()
-        async with pool.acquire() as conn:
-            active_conns = await conn.fetchval("SELECT COUNT(*) FROM pg_stat_activity WHERE state = 'active' AND datname = current_database()")
-            await conn.execute("SELECT 1")
-        logger.debug(
-            f"Health check successful, active connections: {active_conns}")
-        return web.json_response({"status": "healthy", "database": "connected", "active_connections": active_conns})
-    except Exception as e:
-        logger.error(f"Health check failed: {e}", exc_info=True)
-        return web.json_response(
-            {"status": "running", "database": "unavailable", "error": str(e)},
-            status=200
-        )
+def start_analytics_writer() -> None:
+    global _analytics_task
+    if _analytics_task is None or _analytics_task.done():
+        _analytics_task = asyncio.create_task(analytics_flusher())
+        logger.info("Analytics writer started")
+
+
+async def flush_analytics() -> None:
+    global _analytics_task
+    if _analytics_task is None or _analytics_task.done():
+        return
+    await _analytics_queue.put(None)
+    try:
+        await asyncio.wait_for(_analytics_task, timeout=ANALYTICS_SHUTDOWN_TIMEOUT)
+        logger.info(f"Analytics writer flushed and stopped, {_analytics_stats['flushed']} events written")
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout flushing analytics, {_analytics_queue.qsize()} events lost")
+    _analytics_task = None
+
+
+def get_analytics_stats() -> dict:
+    stats = dict(_analytics_stats)
+    stats["queue_depth"] = _analytics_queue.qsize()
+    stats["queue_size"] = ANALYTICS_QUEUE_SIZE
+    stats["last_flush"] = stats["last_flush"].isoformat() if stats["last_flush"] else None
+    return stats
+
+
+# Update ingestion
+#
+# The webhook only validates and enqueues; a pool of UPDATE_WORKERS tasks
+# drains the bounded queue into telegram_app.process_update(). A slow handler
+# therefore never holds Telegram's HTTP request open. When the queue is full
+# the webhook answers 503 and Telegram redelivers later. On shutdown the
+# workers finish what is already queued, up to UPDATE_SHUTDOWN_TIMEOUT.
+_update_queue: asyncio.Queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+_update_workers: list[asyncio.Task] = []
+_update_stats = {
+    "enqueued": 0,
+    "rejected": 0,
+    "processed": 0,
+    "failed": 0,
+    "wait_time": 0.0,
+    "max_wait_time": 0.0,
+    "process_time": 0.0,
+    "max_process_time": 0.0,
+}
+
+
+def enqueue_update(update: Update) -> bool:
+    try:
+        # Parked updates count against the limit, or one user could grow a
+        # backlog past it
+        if _update_queue.qsize() + _ordering_stats["backlog"] >= UPDATE_QUEUE_SIZE:
+            raise asyncio.QueueFull
+        _update_queue.put_nowait((update, time.perf_counter()))
+    except asyncio.QueueFull:
+        _update_stats["rejected"] += 1
+        if _update_stats["rejected"] % 100 == 1:
+            logger.warning(f"Update queue full, rejected {_update_stats['rejected']} updates so far")
+        return False
+    _update_stats["enqueued"] += 1
+    return True
+
+
+async def _run_update(app: Application, update: Update, enqueued_at: float) -> None:
+    started = time.perf_counter()
+    waited = started - enqueued_at
+    _update_stats["wait_time"] += waited
+    _update_stats["max_wait_time"] = max(_update_stats["max_wait_time"], waited)
+    try:
+        await app.update_processor.process_update(update, app.process_update(update))
+        _update_stats["processed"] += 1
+    except Exception as e:
+        _update_stats["failed"] += 1
+        record_error("update_worker", e)
+        logger.error(f"Failed to process update {update.update_id}: {e}", exc_info=True)
+    elapsed = time.perf_counter() - started
+    _update_stats["process_time"] += elapsed
+    _update_stats["max_process_time"] = max(_update_stats["max_process_time"], elapsed)
+
+
+async def _update_worker(app: Application) -> None:
+    while True:
+        item = await _update_queue.get()
+        if item is None:  # shutdown sentinel from drain_update_queue()
+            return
+        user = getattr(item[0], "effective_user", None)
+        if user is None:
+            await _run_update(app, *item)
+            continue
+        backlog = _user_backlogs.get(user.id)
+        if backlog is not None:
+            # Another worker owns this user; park the update behind it
+            backlog.append(item)
+            _ordering_stats["deferred"] += 1
+            _ordering_stats["backlog"] += 1
+            _ordering_stats["max_backlog"] = max(_ordering_stats["max_backlog"], len(backlog))
+            continue
+        backlog = _user_backlogs[user.id] = deque()
+        try:
+            await _run_update(app, *item)
+            while backlog:
+                _ordering_stats["backlog"] -= 1
+                await _run_update(app, *backlog.popleft())
+        finally:
+            _ordering_stats["backlog"] -= len(backlog)
+            del _user_backlogs[user.id]
+
+
+def start_update_workers(app: Application) -> None:
+    _update_workers[:] = [task for task in _update_workers if not task.done()]
+    while len(_update_workers) < UPDATE_WORKERS:
+        _update_workers.append(asyncio.create_task(_update_worker(app)))
+    logger.info(f"Started {UPDATE_WORKERS} update workers")
+
+
+async def drain_update_queue() -> None:
+    workers = [task for task in _update_workers if not task.done()]
+    if not workers:
+        return
+    for _ in workers:
+        await _update_queue.put(None)
+    done, pending = await asyncio.wait(workers, timeout=UPDATE_SHUTDOWN_TIMEOUT)
+    lost = _update_queue.qsize() + _ordering_stats["backlog"]
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.error(f"Timeout draining update queue, {lost} updates lost")
+    else:
+        logger.info(f"Update queue drained, {_update_stats['processed']} updates processed")
+    _update_workers.clear()
+
+
+def get_update_queue_stats() -> dict:
+    finished = _update_stats["processed"] + _update_stats["failed"]
+    return {
+        "enqueued": _update_stats["enqueued"],
+        "rejected": _update_stats["rejected"],
+        "processed": _update_stats["processed"],
+        "failed": _update_stats["failed"],
+        "queue_depth": _update_queue.qsize(),
+        "queue_size": UPDATE_QUEUE_SIZE,
+        "workers": sum(not task.done() for task in _update_workers),
+        "ordering": {
+            "max_concurrent_updates": update_processor.max_concurrent_updates,
+            "users_in_flight": len(_user_backlogs),
+            "deferred": _ordering_stats["deferred"],
+            "backlog": _ordering_stats["backlog"],
+            "max_backlog": _ordering_stats["max_backlog"]
+        },
+        "avg_wait_ms": round(_update_stats["wait_time"] / finished * 1000, 3) if finished else 0.0,
+        "max_wait_ms": round(_update_stats["max_wait_time"] * 1000, 3),
+        "avg_process_ms": round(_update_stats["process_time"] / finished * 1000, 3) if finished else 0.0,
+        "max_process_ms": round(_update_stats["max_process_time"] * 1000, 3)
+    }
+
+
+# Per-user update ordering
+#
+# Updates from different users run concurrently, up to UPDATE_CONCURRENCY at
+# a time, but each user's updates are serialized: the state machine kept in
+# context.user_data must never interleave with itself. Ordering is settled
+# before an update takes a processing slot. The worker that picks up a user's
+# update owns that user until its backlog is empty; a later update from the
+# same user is parked in the backlog instead of waiting, so a burst from one
+# user ties up one worker rather than all of them. The backlog table holds
+# only users with updates in flight.
+_user_backlogs = {}  # user_id -> deque of (update, enqueued_at) behind the one in flight
+_ordering_stats = {"deferred": 0, "backlog": 0, "max_backlog": 0}
+
+update_processor = SimpleUpdateProcessor(UPDATE_CONCURRENCY)
+
+
+# Conversation state persistence
+#
+# context.user_data (the purchase and admin state machines) survives restarts
+# in user_state. PTB hands over changed users every PERSISTENCE_UPDATE_INTERVAL
+# seconds; update_user_data() only buffers, and one flush task writes the whole
+# round with a single unnest() upsert. refresh_user_data() reads a user's row
+# when this process has not seen it for USER_STATE_CACHE_TTL seconds, so a
+# change made on another replica shows up here. Each write carries the
+# updated_at it was based on, and the upsert skips rows that another replica
+# has written since; the skipped user is reloaded on the next refresh.
+class PostgresPersistence(BasePersistence):
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._versions = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_STATE_CACHE_TTL)  # user_id -> updated_at
+        self._pending = {}  # user_id -> (data, updated_at it was based on)
+        self._flush_task = None
+        self._stats = {
+            "loads": 0, "load_time": 0.0, "flushes": 0, "rows_written": 0, "failed": 0, "conflicts": 0,
+            "flush_time": 0.0, "max_flush_time": 0.0, "last_flush": None
+        }
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # A buffered write is newer than the row; the flush settles any conflict
+        if user_id in self._versions or user_id in self._pending:
+            return
+        started = time.perf_counter()
+        async with get_db_connection() as conn:
+            row = await conn.fetchrow("SELECT data, updated_at FROM user_state WHERE user_id = $1", user_id)
+        if row:
+            user_data.clear()
+            user_data.update(json.loads(row["data"]))
+        self._versions[user_id] = row["updated_at"] if row else None
+        self._stats["loads"] += 1
+        self._stats["load_time"] += time.perf_counter() - started
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        based_on = self._pending[user_id][1] if user_id in self._pending else self._versions.get(user_id)
+        self._pending[user_id] = (json.dumps(data, default=str), based_on)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._versions.pop(user_id, None)
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM user_state WHERE user_id = $1", user_id)
+
+    async def _flush_pending(self) -> None:
+        await asyncio.sleep(0)  # let the rest of this persistence round buffer first
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            started = time.perf_counter()
+            try:
+                async with get_db_connection() as conn:
+                    written = await conn.fetch(
+                        """
+                        WITH u AS (
+                            SELECT * FROM unnest($1::bigint[], $2::jsonb[], $3::timestamptz[])
+                                AS u(user_id, data, based_on)
+                        )
+                        INSERT INTO user_state (user_id, data, updated_at)
+                        SELECT u.user_id, u.data, NOW() FROM u
+                        ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                        WHERE user_state.updated_at <= (SELECT u.based_on FROM u WHERE u.user_id = EXCLUDED.user_id)
+                        RETURNING user_id, updated_at
+                        """,
+                        list(batch.keys()),
+                        [data for data, _ in batch.values()],
+                        [based_on for _, based_on in batch.values()]
+                    )
+            except Exception as e:
+                self._stats["failed"] += len(batch)
+                # Keep the batch unless a newer snapshot arrived meanwhile; PTB retries next round
+                self._pending = {**batch, **self._pending}
+                logger.error(f"Failed to persist state for {len(batch)} users: {e}", exc_info=True)
+                return
+            for row in written:
+                user_id = row["user_id"]
+                self._versions[user_id] = row["updated_at"]
+                # A snapshot buffered during this write was based on it
+                if user_id in self._pending and self._pending[user_id][1] == batch[user_id][1]:
+                    self._pending[user_id] = (self._pending[user_id][0], row["updated_at"])
+            stale = batch.keys() - {row["user_id"] for row in written}
+            if stale:
+                # Another replica wrote these users first; keep its row and reload it
+                for user_id in stale:
+                    self._versions.pop(user_id, None)
+                self._stats["conflicts"] += len(stale)
+                logger.warning(f"Skipped stale state for {len(stale)} users written elsewhere")
+            elapsed = time.perf_counter() - started
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(written)
+            self._stats["flush_time"] += elapsed
+            self._stats["max_flush_time"] = max(self._stats["max_flush_time"], elapsed)
+            self._stats["last_flush"] = datetime.now(pytz.UTC).isoformat()
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_pending()
+        logger.info(f"Conversation state flushed, {self._stats['rows_written']} rows written")
+
+    def get_stats(self) -> dict:
+        stats = self._stats
+        return {
+            "loaded_users": len(self._versions),
+            "pending": len(self._pending),
+            "loads": stats["loads"],
+            "avg_load_ms": round(stats["load_time"] / stats["loads"] * 1000, 3) if stats["loads"] else 0.0,
+            "flushes": stats["flushes"],
+            "rows_written": stats["rows_written"],
+            "failed": stats["failed"],
+            "conflicts": stats["conflicts"],
+            "avg_flush_ms": round(stats["flush_time"] / stats["flushes"] * 1000, 3) if stats["flushes"] else 0.0,
+            "max_flush_ms": round(stats["max_flush_time"] * 1000, 3),
+            "last_flush": stats["last_flush"]
+        }
+
+    # Only user_data is persisted; the remaining hooks are no-ops
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+
+state_persistence = PostgresPersistence(PERSISTENCE_UPDATE_INTERVAL)
+
+
+# Broadcast jobs
+#
+# A broadcast is a row in broadcast_jobs, not a loop inside a callback. The
+# job walks users in user_id order, BROADCAST_BATCH_SIZE at a time, sending
+# each batch concurrently through a process-wide token bucket that keeps the
+# bot under Telegram's global send limit; RetryAfter pauses every sender, not
+# just the one that hit it. After each batch the cursor and counters are
+# persisted and the job's lease renewed, so a restart (or another replica,
+# once the lease lapses) resumes where it stopped. Delivery is at-least-once:
+# a crash mid-batch may resend up to one batch.
+BROADCAST_ACTIVE_STATUSES = ("pending", "running")
+_broadcast_tasks = {}
+_broadcast_bucket = {
+    "tokens": float(BROADCAST_RATE),
+    "updated": time.monotonic(),
+    "paused_until": 0.0
+}
+_broadcast_bucket_lock = asyncio.Lock()
+
+
+async def _broadcast_take_token() -> None:
+    while True:
+        async with _broadcast_bucket_lock:
+            now = time.monotonic()
+            if now < _broadcast_bucket["paused_until"]:
+                wait = _broadcast_bucket["paused_until"] - now
+            else:
+                elapsed = now - _broadcast_bucket["updated"]
+                _broadcast_bucket["tokens"] = min(float(BROADCAST_RATE), _broadcast_bucket["tokens"] + elapsed * BROADCAST_RATE)
+                _broadcast_bucket["updated"] = now
+                if _broadcast_bucket["tokens"] >= 1:
+                    _broadcast_bucket["tokens"] -= 1
+                    return
+                wait = (1 - _broadcast_bucket["tokens"]) / BROADCAST_RATE
+        await asyncio.sleep(wait)
+
+
+def _broadcast_pause(seconds: float) -> None:
+    _broadcast_bucket["paused_until"] = max(_broadcast_bucket["paused_until"], time.monotonic() + seconds)
+    _broadcast_bucket["tokens"] = 0.0
+
+
+async def _deliver_broadcast(bot, chat_id: int, text: str) -> str:
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        await _broadcast_take_token()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+            return "sent"
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logger.warning(f"Broadcast rate limited, pausing all senders for {retry_after}s")
+            _broadcast_pause(retry_after)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            logger.debug(f"Broadcast to {chat_id} rejected: {e}")
+            return "failed"
+        except TelegramError as e:
+            logger.warning(f"Broadcast to {chat_id} failed (attempt {attempt + 1}/{BROADCAST_MAX_RETRIES}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    return "failed"
+
+
+async def _claim_broadcast_job(job_id: int):
+    async with get_db_connection() as conn:
+        return await conn.fetchrow(
+            "UPDATE broadcast_jobs SET status = 'running', lease_owner = $2, "
+            "lease_until = NOW() + make_interval(secs => $3), started_at = COALESCE(started_at, NOW()), updated_at = NOW() "
+            "WHERE id = $1 AND status = ANY($4::text[]) "
+            "AND (lease_owner IS NULL OR lease_owner = $2 OR lease_until < NOW()) "
+            "RETURNING id, text, cursor_user_id",
+            job_id, INSTANCE_ID, BROADCAST_LEASE_SECONDS, list(BROADCAST_ACTIVE_STATUSES)
+        )
+
+
+async def run_broadcast_job(bot, job_id: int) -> None:
+    job = await _claim_broadcast_job(job_id)
+    if not job:
+        return
+    cursor = job["cursor_user_id"]
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    logger.info(f"Broadcast #{job_id} running from user_id>{cursor}")
+
+    async def send_one(chat_id: int) -> str:
+        async with semaphore:
+            return await _deliver_broadcast(bot, chat_id, job["text"])
+
+    try:
+        while True:
+            async with get_db_connection() as conn:
+                batch = await conn.fetch(
+                    "SELECT user_id FROM users WHERE user_id > $1 AND is_banned IS NOT TRUE "
+                    "ORDER BY user_id LIMIT $2",
+                    cursor, BROADCAST_BATCH_SIZE
+                )
+            if not batch:
+                async with get_db_connection() as conn:
+                    await conn.execute(
+                        "UPDATE broadcast_jobs SET status = 'completed', finished_at = NOW(), updated_at = NOW(), "
+                        "lease_owner = NULL, lease_until = NULL WHERE id = $1 AND lease_owner = $2",
+                        job_id, INSTANCE_ID
+                    )
+                logger.info(f"Broadcast #{job_id} completed")
+                await log_analytics(None, "broadcast_completed", {"job_id": job_id})
+                return
+            results = await asyncio.gather(*(send_one(row["user_id"]) for row in batch))
+            cursor = batch[-1]["user_id"]
+            async with get_db_connection() as conn:
+                status = await conn.fetchval(
+                    "UPDATE broadcast_jobs SET cursor_user_id = $2, sent_count = sent_count + $3, "
+                    "failed_count = failed_count + $4, blocked_count = blocked_count + $5, updated_at = NOW(), "
+                    "lease_until = NOW() + make_interval(secs => $6) "
+                    "WHERE id = $1 AND lease_owner = $7 RETURNING status",
+                    job_id, cursor, results.count("sent"), results.count("failed"), results.count("blocked"),
+                    BROADCAST_LEASE_SECONDS, INSTANCE_ID
+                )
+            if status != "running":
+                logger.info(f"Broadcast #{job_id} stopped at user_id={cursor} (status={status})")
+                return
+    except asyncio.CancelledError:
+        # Hand the job back so the next start picks it up without waiting for the lease.
+        try:
+            async with get_db_connection() as conn:
+                await conn.execute(
+                    "UPDATE broadcast_jobs SET lease_owner = NULL, lease_until = NULL WHERE id = $1 AND lease_owner = $2",
+                    job_id, INSTANCE_ID
+                )
+        except Exception as e:
+            logger.warning(f"Failed to release broadcast #{job_id} lease: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast #{job_id} interrupted at user_id={cursor}: {e}", exc_info=True)
+
+
+def start_broadcast_job(bot, job_id: int) -> None:
+    task = _broadcast_tasks.get(job_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(run_broadcast_job(bot, job_id), name=f"broadcast-{job_id}")
+    _broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda t: _broadcast_tasks.pop(job_id, None))
+
+
+@instrumented("job:resume_broadcast_jobs")
+async def resume_broadcast_jobs(bot) -> None:
+    try:
+        async with get_db_connection() as conn:
+            job_ids = await conn.fetch(
+                "SELECT id FROM broadcast_jobs WHERE status = ANY($1::text[]) "
+                "AND (lease_owner IS NULL OR lease_owner = $2 OR lease_until < NOW()) ORDER BY id",
+                list(BROADCAST_ACTIVE_STATUSES), INSTANCE_ID
+            )
+    except Exception as e:
+        logger.error(f"Failed to look up broadcast jobs to resume: {e}")
+        return
+    for row in job_ids:
+        if row["id"] not in _broadcast_tasks:
+            logger.info(f"Resuming broadcast #{row['id']}")
+            start_broadcast_job(bot, row["id"])
+
+
+async def stop_broadcast_jobs() -> None:
+    tasks = list(_broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Stopped {len(tasks)} broadcast job(s)")
+
+
+def format_broadcast_status(job) -> str:
+    done = job["sent_count"] + job["failed_count"] + job["blocked_count"]
+    total = max(job["total_users"], done)
+    progress = done / total * 100 if total else 100.0
+    text = (
+        f"Рассылка #{job['id']}: {job['status']}\n"
+        f"Прогресс: {done}/{total} ({progress:.1f}%)\n"
+        f"Доставлено: {job['sent_count']}\n"
+        f"Заблокировали бота: {job['blocked_count']}\n"
+        f"Ошибки: {job['failed_count']}"
+    )
+    if job["started_at"]:
+        elapsed = ((job["finished_at"] or job["updated_at"]) - job["started_at"]).total_seconds()
+        if elapsed > 0 and done:
+            rate = done / elapsed
+            text += f"\nСкорость: {rate:.1f} сообщ./с"
+            if job["status"] == "running" and total > done:
+                text += f"\nОсталось: ~{int((total - done) / rate)} с"
+    return text
+
+
+# Username resolution
+#
+# Screens that show other users' @handles go through resolve_usernames():
+# cached handles are answered from memory, misses are fetched with get_chat
+# concurrently (at most USERNAME_RESOLVE_CONCURRENCY in flight, each with a
+# timeout) and a slow or failing lookup falls back to the stored
+# users.username. Handles that changed are written back in one statement.
+_username_cache = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+_username_semaphore = asyncio.Semaphore(USERNAME_RESOLVE_CONCURRENCY)
+_username_stats = {
+    "hits": 0,
+    "misses": 0,
+    "fallbacks": 0,
+    "written_back": 0
+}
+
+
+def format_user_handle(user_id: int, username: Optional[str]) -> str:
+    return f"@{username}" if username else f"ID <code>{user_id}</code>"
+
+
+def remember_username(user_id: int, username: Optional[str]) -> None:
+    _username_cache[user_id] = username
+
+
+async def _fetch_username(bot, user_id: int) -> Optional[str]:
+    async with _username_semaphore:
+        async with asyncio.timeout(USERNAME_RESOLVE_TIMEOUT):
+            chat = await bot.get_chat(user_id)
+    return chat.username
+
+
+async def save_usernames(changed: list) -> None:
+    if not changed:
+        return
+    user_ids = [user_id for user_id, _ in changed]
+    async with get_db_connection() as conn:
+        await conn.execute(
+            "UPDATE users u SET username = v.username "
+            "FROM unnest($1::bigint[], $2::text[]) AS v(user_id, username) "
+            "WHERE u.user_id = v.user_id AND u.username IS DISTINCT FROM v.username",
+            user_ids, [username for _, username in changed]
+        )
+    invalidate_user_profile(*user_ids)
+    _username_stats["written_back"] += len(changed)
+    logger.info(f"Updated {len(changed)} username(s) from Telegram")
+
+
+async def resolve_usernames(bot, users) -> dict:
+    """Map user_id -> current @handle (without '@') for (user_id, stored_username) pairs."""
+    resolved = {}
+    misses = []
+    for user_id, stored in users:
+        if user_id in _username_cache:
+            resolved[user_id] = _username_cache[user_id]
+            _username_stats["hits"] += 1
+        else:
+            misses.append((user_id, stored))
+    if not misses:
+        return resolved
+    _username_stats["misses"] += len(misses)
+    results = await asyncio.gather(
+        *(_fetch_username(bot, user_id) for user_id, _ in misses),
+        return_exceptions=True
+    )
+    changed = []
+    for (user_id, stored), result in zip(misses, results):
+        if isinstance(result, (TelegramError, asyncio.TimeoutError)):
+            resolved[user_id] = stored
+            _username_stats["fallbacks"] += 1
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        _username_cache[user_id] = result
+        resolved[user_id] = result
+        if result and result != stored:
+            changed.append((user_id, result))
+    try:
+        await save_usernames(changed)
+    except Exception as e:
+        logger.warning(f"Failed to write back {len(changed)} username(s): {e}")
+    return resolved
+
+
+def get_username_stats() -> dict:
+    return {**_username_stats, "cached": len(_username_cache)}
+
+
+# Leaderboards
+#
+# Rankings are computed by refresh_leaderboards() on a schedule, with display
+# names already resolved, and stored both in leaderboard_snapshots (so a fresh
+# process has something to show before its first refresh) and in
+# _leaderboard_cache, which is all the leaderboard screens read.
+LEADERBOARD_QUERIES = {
+    "referrals": (
+        "SELECT user_id, username, ref_count AS value "
+        "FROM users WHERE ref_count > 0 ORDER BY ref_count DESC, user_id LIMIT $1"
+    ),
+    "stars": (
+        "SELECT user_id, username, stars_bought AS value "
+        "FROM users WHERE stars_bought > 0 ORDER BY stars_bought DESC, user_id LIMIT $1"
+    )
+}
+_leaderboard_cache = {}
+
+
+@instrumented("job:refresh_leaderboards")
+async def refresh_leaderboards(bot) -> None:
+    try:
+        async with get_db_connection() as conn:
+            boards = {
+                board: await conn.fetch(sql, LEADERBOARD_SIZE)
+                for board, sql in LEADERBOARD_QUERIES.items()
+            }
+        refreshed_at = datetime.now(pytz.UTC)
+        snapshots = {}
+        names = await resolve_usernames(
+            bot, {(row["user_id"], row["username"]) for rows in boards.values() for row in rows}
+        )
+        for board, rows in boards.items():
+            snapshots[board] = {
+                "entries": [
+                    {
+                        "user_id": row["user_id"],
+                        "display": format_user_handle(row["user_id"], names.get(row["user_id"])),
+                        "value": row["value"]
+                    }
+                    for row in rows
+                ],
+                "refreshed_at": refreshed_at
+            }
+        async with get_db_connection() as conn:
+            await conn.executemany(
+                "INSERT INTO leaderboard_snapshots (board, entries, refreshed_at) VALUES ($1, $2, $3) "
+                "ON CONFLICT (board) DO UPDATE SET entries = EXCLUDED.entries, refreshed_at = EXCLUDED.refreshed_at",
+                [(board, json.dumps(s["entries"]), refreshed_at) for board, s in snapshots.items()]
+            )
+        _leaderboard_cache.update(snapshots)
+        logger.debug(f"Leaderboards refreshed: { {board: len(s['entries']) for board, s in snapshots.items()} }")
+    except Exception as e:
+        logger.error(f"Failed to refresh leaderboards: {e}", exc_info=True)
+
+
+async def load_leaderboards() -> None:
+    try:
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("SELECT board, entries, refreshed_at FROM leaderboard_snapshots")
+    except Exception as e:
+        logger.warning(f"Failed to load leaderboard snapshots: {e}")
+        return
+    for row in rows:
+        _leaderboard_cache[row["board"]] = {
+            "entries": json.loads(row["entries"]),
+            "refreshed_at": row["refreshed_at"]
+        }
+    logger.info(f"Loaded {len(rows)} leaderboard snapshot(s)")
+
+
+def leaderboard_lines(board: str, label: str) -> list:
+    snapshot = _leaderboard_cache.get(board)
+    if not snapshot:
+        return []
+    return [f"{entry['display']}, {label}: {entry['value']}" for entry in snapshot["entries"]]
 
 
 async def debug_pool(request: web.Request) -> web.Response:
     logger.info("Debug pool called: %s %s", request.method, request.path)
+    stats = {
+        "pool_stats": get_db_pool_stats(),
+        "http_stats": get_http_stats(),
+        "analytics_stats": get_analytics_stats(),
+        "admin_db_stats": get_admin_db_stats(),
+        "username_stats": get_username_stats(),
+        "wallet_watch_stats": get_wallet_watch_stats(),
+        "invoice_stats": get_invoice_stats(),
+        "update_queue_stats": get_update_queue_stats(),
+        "persistence_stats": state_persistence.get_stats(),
+        "callback_route_stats": get_callback_route_stats()
+    }
     try:
-        pool = await ensure_db_pool()
-        async with pool.acquire() as conn:
+        async with get_db_connection() as conn:
             active_conns = await conn.fetchval("SELECT COUNT(*) FROM pg_stat_activity WHERE state = 'active' AND datname = current_database()")
-            await conn.execute("SELECT 1")
-        return web.json_response({"status": "ok", "pool": "connected", "active_connections": active_conns})
+        return web.json_response({"status": "ok", "pool": "connected", "active_connections": active_conns, **stats})
     except Exception as e:
         logger.error(f"Debug pool failed: {e}", exc_info=True)
-        return web.json_response({"status": "error", "error": str(e), "pool": "unavailable"}, status=500)
+        return web.json_response({"status": "error", "error": str(e), "pool": "unavailable", **stats}, status=500)
+
+
+async def debug_db(request: web.Request) -> web.Response:
+    logger.info("Debug db called: %s %s", request.method, request.path)
+    try:
+        limit = int(request.query.get("limit", 20))
+    except ValueError:
+        return web.json_response({"error": "Invalid limit"}, status=400)
+    pool_stats = get_db_pool_stats()
+    report = {
+        "slow_query_ms": DB_SLOW_QUERY_MS,
+        "pool": {key: pool_stats[key] for key in (
+            "size", "idle", "waiters", "acquires", "acquire_timeouts",
+            "acquire_wait_avg_ms", "acquire_wait_max_ms", "hold_avg_ms", "hold_max_ms"
+        )},
+        "pool_reset": get_pool_reset_stats(),
+        "top_statements": get_statement_stats(limit),
+        "slow_queries": list(_slow_queries)
+    }
+    fingerprint = request.query.get("explain")
+    if fingerprint:
+        try:
+            report["explain"] = {"fingerprint": fingerprint, "plan": await explain_statement(fingerprint)}
+        except KeyError as e:
+            return web.json_response({"error": str(e.args[0])}, status=404)
+        except Exception as e:
+            logger.warning(f"EXPLAIN failed for statement {fingerprint}: {e}")
+            report["explain"] = {"fingerprint": fingerprint, "error": str(e)}
+    return web.json_response(report)
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
 
 
 async def safe_reply_text(update: Update, text: str, reply_markup=None, parse_mode=None, retry_count=3):
@@ -925,63 +2992,64 @@ async def safe_reply_text(update: Update, text: str, reply_markup=None, parse_mo
                 raise
 
 
+@instrumented("job:update_ton_price")
 async def update_ton_price(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await is_price_leader():
+        logger.debug("Another replica fetches TON prices, skipping")
+        return
     logger.debug("Starting TON price update...")
     max_retries = 3
     base_delay = 60  # 60 seconds for retries
-    api_url = "https://tonapi.io/v2/rates"
+    api_url = f"{TONAPI_BASE_URL}/rates"
 
     try:
         async with asyncio.timeout(30.0):  # Reduced timeout to 30 seconds
-            async with aiohttp.ClientSession() as session:
-                for attempt in range(max_retries):
-                    try:
-                        async with session.get(
-                            api_url,
-                            params={"tokens": "ton", "currencies": "usd"},
-                            headers={"User-Agent": "TelegramBot/1.0"}
-                        ) as response:
-                            if response.status == 429:
-                                delay = base_delay * (2 ** attempt)
-                                logger.warning(
-                                    f"Rate limit hit on attempt {attempt + 1}/{max_retries}, waiting {delay}s")
-                                await asyncio.sleep(delay)
-                                continue
-                            if response.status != 200:
-                                logger.error(
-                                    f"Failed to fetch TON price: HTTP {response.status}")
-                                break
-                            data = await response.json()
-                            price = float(data.get("rates", {}).get("TON", {}).get("prices", {}).get("USD", 0.0))
-                            if price == 0.0:
-                                logger.error("Invalid TON price received from TonAPI")
-                                break
-                            context.bot_data["ton_price_info"] = {
-                                "price": price,
-                                "diff_24h": 0.0,  # TonAPI may not provide diff_24h; adjust if available
-                                "updated_at": datetime.now(pytz.UTC)
-                            }
-                            logger.debug(f"TON price updated: price={price}")
-                            try:
-                                async with asyncio.timeout(5.0):
-                                    async with get_db_connection() as conn:
-                                        await conn.execute(
-                                            "INSERT INTO ton_price (price, updated_at) VALUES ($1, $2)",
-                                            price, datetime.now(pytz.UTC)
-                                        )
-                                        logger.debug("Stored TON price in database")
-                                return
-                            except asyncio.TimeoutError:
-                                logger.warning("Timeout storing TON price in database")
-                            except Exception as e:
-                                logger.warning(f"Failed to store TON price in database: {e}")
+            for attempt in range(max_retries):
+                try:
+                    async with http_request(
+                        "tonapi_rates", "GET", api_url,
+                        params={"tokens": "ton", "currencies": "usd"}
+                    ) as response:
+                        if response.status == 429:
+                            delay = base_delay * (2 ** attempt)
+                            logger.warning(
+                                f"Rate limit hit on attempt {attempt + 1}/{max_retries}, waiting {delay}s")
+                            await asyncio.sleep(delay)
+                            continue
+                        if response.status != 200:
+                            logger.error(
+                                f"Failed to fetch TON price: HTTP {response.status}")
+                            break
+                        data = await response.json()
+                        price = float(data.get("rates", {}).get("TON", {}).get("prices", {}).get("USD", 0.0))
+                        if price == 0.0:
+                            logger.error("Invalid TON price received from TonAPI")
+                            break
+                        # TonAPI may not provide diff_24h; adjust if available
+                        await publish_cluster_state("ton_price_info", {
+                            "price": price, "diff_24h": 0.0, "updated_at": datetime.now(pytz.UTC)
+                        })
+                        logger.debug(f"TON price updated: price={price}")
+                        try:
+                            async with asyncio.timeout(5.0):
+                                async with get_db_connection() as conn:
+                                    await conn.execute(
+                                        "INSERT INTO ton_price (price, updated_at) VALUES ($1, $2)",
+                                        price, datetime.now(pytz.UTC)
+                                    )
+                                    logger.debug("Stored TON price in database")
                             return
-                    except Exception as e:
-                        logger.error(
-                            f"Error in update_ton_price (attempt {attempt + 1}/{max_retries}): {e}", exc_info=True)
-                        if attempt + 1 < max_retries:
-                            await asyncio.sleep(base_delay * (2 ** attempt))
-                        continue
+                        except asyncio.TimeoutError:
+                            logger.warning("Timeout storing TON price in database")
+                        except Exception as e:
+                            logger.warning(f"Failed to store TON price in database: {e}")
+                        return
+                except Exception as e:
+                    logger.error(
+                        f"Error in update_ton_price (attempt {attempt + 1}/{max_retries}): {e}", exc_info=True)
+                    if attempt + 1 < max_retries:
+                        await asyncio.sleep(base_delay * (2 ** attempt))
+                    continue
     except asyncio.TimeoutError:
         logger.error("Timeout in update_ton_price")
     except Exception as e:
@@ -995,11 +3063,7 @@ async def update_ton_price(context: ContextTypes.DEFAULT_TYPE) -> None:
                     "SELECT price, updated_at FROM ton_price ORDER BY updated_at DESC LIMIT 1"
                 )
                 if price_record and (datetime.now(pytz.UTC) - price_record["updated_at"]).total_seconds() < 3600:
-                    context.bot_data["ton_price_info"] = {
-                        "price": price_record["price"],
-                        "diff_24h": 0.0,
-                        "updated_at": price_record["updated_at"]
-                    }
+                    set_ton_price(context.bot_data, price_record["price"], price_record["updated_at"])
                     logger.info(f"Using database TON price: {price_record['price']}")
                     return
     except asyncio.TimeoutError:
@@ -1007,27 +3071,575 @@ async def update_ton_price(context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         logger.error(f"Failed to fetch TON price from database: {e}")
 
-    # Ultimate fallback
-    context.bot_data["ton_price_info"] = {
-        "price": 3.32,
-        "diff_24h": 0.0,
-        "updated_at": datetime.now(pytz.UTC)
-    }
-    logger.warning("Using fallback TON price: 3.32")
+    # Ultimate fallback: keep quoting from the last known rate if there is one
+    if _quote_book["ton_price"]:
+        logger.warning(f"TON price refresh failed, keeping last known price: {_quote_book['ton_price']}")
+        return
+    set_ton_price(context.bot_data, FALLBACK_TON_PRICE)
+    logger.warning(f"Using fallback TON price: {FALLBACK_TON_PRICE}")
+
+
+# Settings snapshot
+#
+# Pricing and bonus settings are served from an in-memory snapshot that is
+# replaced as a whole, never mutated in place. load_settings() fills it at
+# startup and after a listener reconnect; the bot-settings edit flow publishes
+# each change on SETTINGS_CHANNEL so every replica applies it within
+# milliseconds without reading the settings table.
+SETTINGS_CHANNEL = "settings_changed"
+DEFAULT_SETTINGS = {
+    "price_usd": 0.81,
+    "markup": 10.0,
+    "ref_bonus": 30.0
+}
+_settings_snapshot = MappingProxyType({
+    "price_usd": PRICE_USD_PER_50,
+    "markup": MARKUP_PERCENTAGE,
+    "ref_bonus": REFERRAL_BONUS_PERCENTAGE
+})
+_settings_version = 0
 
 
-async def load_settings():
+def get_setting(key: str) -> float:
+    return _settings_snapshot.get(key, DEFAULT_SETTINGS.get(key, 0.0))
+
+
+def _swap_settings(snapshot: dict) -> None:
+    global _settings_snapshot, _settings_version
     global PRICE_USD_PER_50, MARKUP_PERCENTAGE, REFERRAL_BONUS_PERCENTAGE
-    async with (await ensure_db_pool()) as conn:
+    if snapshot == dict(_settings_snapshot):
+        return
+    _settings_snapshot = MappingProxyType(snapshot)
+    _settings_version += 1
+    PRICE_USD_PER_50 = snapshot["price_usd"]
+    MARKUP_PERCENTAGE = snapshot["markup"]
+    REFERRAL_BONUS_PERCENTAGE = snapshot["ref_bonus"]
+    logger.info(f"Settings snapshot v{_settings_version}: {snapshot}")
+    rebuild_quotes()
+
+
+def apply_setting_change(key: str, value: float) -> None:
+    _swap_settings({**_settings_snapshot, key: float(value)})
+
+
+def _on_settings_notify(payload: str) -> None:
+    change = json.loads(payload)
+    apply_setting_change(change["key"], change["value"])
+
+
+async def load_settings():
+    async with get_db_connection() as conn:
         settings = await conn.fetch("SELECT key, value FROM settings")
-        for setting in settings:
-            if setting["key"] == "price_usd":
-                PRICE_USD_PER_50 = float(setting["value"])
-            elif setting["key"] == "markup":
-                MARKUP_PERCENTAGE = float(setting["value"])
-            elif setting["key"] == "ref_bonus":
-                REFERRAL_BONUS_PERCENTAGE = float(setting["value"])
-        logger.info("Settings loaded from database")
+    snapshot = dict(DEFAULT_SETTINGS)
+    snapshot.update({s["key"]: float(s["value"]) for s in settings if s["value"] is not None})
+    _swap_settings(snapshot)
+    logger.info("Settings loaded from database")
+
+
+register_pg_channel(SETTINGS_CHANNEL, _on_settings_notify, load_settings)
+
+
+# Cluster state
+#
+# Process-wide state that every replica must agree on (the TON rate and the
+# tech break) lives in cluster_state and is pushed on CLUSTER_STATE_CHANNEL;
+# each replica mirrors it into its bot_data. publish_cluster_state() writes
+# and notifies in one statement and applies the value locally right away.
+# Only one replica fetches prices: the one holding PRICE_LEADER_LOCK_ID, a
+# session advisory lock taken on the listener connection, so leadership is
+# released by Postgres as soon as that replica's connection dies.
+CLUSTER_STATE_CHANNEL = "cluster_state_changed"
+PRICE_LEADER_LOCK_ID = 7451002302
+_cluster_bot_data = None
+_price_leader_conn = None
+
+
+def _apply_ton_price(bot_data, value: dict) -> None:
+    set_ton_price(
+        bot_data, value["price"], datetime.fromisoformat(value["updated_at"]), value.get("diff_24h", 0.0)
+    )
+
+
+def _apply_tech_break(bot_data, value: dict) -> None:
+    bot_data["tech_break_info"] = {
+        "end_time": datetime.fromisoformat(value["end_time"]),
+        "reason": value.get("reason", "")
+    }
+
+
+CLUSTER_STATE_APPLIERS = {
+    "ton_price_info": _apply_ton_price,
+    "tech_break_info": _apply_tech_break
+}
+
+
+def _apply_cluster_state(key: str, value: dict) -> None:
+    applier = CLUSTER_STATE_APPLIERS.get(key)
+    if applier is None:
+        logger.warning(f"Ignoring unknown cluster state key: {key}")
+        return
+    if _cluster_bot_data is not None:
+        applier(_cluster_bot_data, value)
+
+
+def _on_cluster_state_notify(payload: str) -> None:
+    change = json.loads(payload)
+    _apply_cluster_state(change["key"], change["value"])
+
+
+async def load_cluster_state() -> None:
+    if _cluster_bot_data is None:
+        return
+    async with get_db_connection() as conn:
+        rows = await conn.fetch("SELECT key, value FROM cluster_state")
+    for row in rows:
+        _apply_cluster_state(row["key"], json.loads(row["value"]))
+    logger.info(f"Cluster state loaded: {', '.join(row['key'] for row in rows) or 'empty'}")
+
+
+register_pg_channel(CLUSTER_STATE_CHANNEL, _on_cluster_state_notify, load_cluster_state)
+
+
+async def init_cluster_state(bot_data) -> None:
+    global _cluster_bot_data
+    _cluster_bot_data = bot_data
+    try:
+        await load_cluster_state()
+    except Exception as e:
+        logger.warning(f"Failed to load cluster state, keeping local defaults: {e}")
+
+
+async def publish_cluster_state(key: str, value: dict) -> None:
+    value = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in value.items()}
+    try:
+        async with get_db_connection() as conn:
+            await conn.execute(
+                "WITH upserted AS ("
+                "INSERT INTO cluster_state (key, value, updated_at) VALUES ($1, $2::jsonb, NOW()) "
+                "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW() RETURNING key, value) "
+                "SELECT pg_notify($3, json_build_object('key', key, 'value', value)::text) FROM upserted",
+                key, json.dumps(value), CLUSTER_STATE_CHANNEL
+            )
+    except Exception as e:
+        logger.warning(f"Failed to publish cluster state {key}, applying locally only: {e}")
+    _apply_cluster_state(key, value)
+
+
+async def is_price_leader() -> bool:
+    global _price_leader_conn
+    conn = _pg_listener_conn
+    if conn is None or conn.is_closed():
+        # No listener means no way to coordinate; keep this replica's prices fresh on its own
+        _price_leader_conn = None
+        return True
+    if _price_leader_conn is conn:
+        return True
+    async with _pg_listener_lock:
+        acquired = await conn.fetchval("SELECT pg_try_advisory_lock($1)", PRICE_LEADER_LOCK_ID)
+    if acquired:
+        _price_leader_conn = conn
+        logger.info(f"{INSTANCE_ID} is now the TON price fetcher")
+    return acquired
+
+
+# Pending invoices
+#
+# Live TON invoices are held in memory so the webhook and the wallet watcher
+# can tell whether a comment is an open invoice, and what amount it expects,
+# without a DB read. load_pending_invoices() fills the registry at startup and
+# after a listener reconnect, and proceed_to_payment publishes every new
+# invoice on INVOICES_CHANNEL. Settled invoices are only dropped locally;
+# settle_payment() stays authoritative, so a stale entry on another replica
+# costs the webhook or the watcher one no-op UPDATE. The check-payment button
+# always reads checked_status, one indexed lookup, since only the DB knows
+# whether another replica settled the invoice. sweep_expired_invoices() marks
+# pending rows older than INVOICE_TTL as expired in batches.
+INVOICES_CHANNEL = "invoices_created"
+_pending_invoices = {}
+_invoice_stats = {"registered": 0, "settled": 0, "expired": 0, "last_sweep": None}
+
+
+def register_invoice(invoice_id: str, user_id: int, price_ton: float, created_at: datetime) -> None:
+    if invoice_id not in _pending_invoices:
+        _invoice_stats["registered"] += 1
+    _pending_invoices[invoice_id] = {
+        "user_id": user_id,
+        "expected_nano": int(price_ton * 1_000_000_000),
+        "created_at": created_at
+    }
+
+
+def lookup_invoice(invoice_id: str):
+    invoice = _pending_invoices.get(invoice_id)
+    if invoice and invoice["created_at"] < datetime.now(pytz.UTC) - timedelta(seconds=INVOICE_TTL):
+        return None
+    return invoice
+
+
+def forget_invoice(invoice_id: str) -> None:
+    if _pending_invoices.pop(invoice_id, None) is not None:
+        _invoice_stats["settled"] += 1
+
+
+def _on_invoice_notify(payload: str) -> None:
+    invoice = json.loads(payload)
+    register_invoice(
+        invoice["invoice_id"], invoice["user_id"], invoice["price_ton"],
+        datetime.fromisoformat(invoice["created_at"])
+    )
+
+
+async def load_pending_invoices() -> None:
+    async with get_db_connection() as conn:
+        rows = await conn.fetch(
+            "SELECT invoice_id, user_id, price_ton, purchase_time FROM transactions "
+            "WHERE checked_status = 'pending' AND purchase_time > NOW() - make_interval(secs => $1)",
+            INVOICE_TTL
+        )
+    # Merge rather than replace: invoices registered while the query ran must stay
+    for row in rows:
+        _pending_invoices.setdefault(row["invoice_id"], {
+            "user_id": row["user_id"],
+            "expected_nano": int(row["price_ton"] * 1_000_000_000),
+            "created_at": row["purchase_time"]
+        })
+    logger.info(f"Loaded {len(_pending_invoices)} pending invoices")
+
+
+register_pg_channel(INVOICES_CHANNEL, _on_invoice_notify, load_pending_invoices)
+
+
+@instrumented("job:sweep_expired_invoices")
+async def sweep_expired_invoices() -> None:
+    expired = 0
+    try:
+        while True:
+            async with get_db_connection() as conn:
+                rows = await conn.fetch(
+                    """
+                    UPDATE transactions SET checked_status = 'expired'
+                    WHERE id IN (
+                        SELECT id FROM transactions
+                        WHERE checked_status = 'pending' AND purchase_time < NOW() - make_interval(secs => $1)
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING invoice_id
+                    """,
+                    INVOICE_TTL, INVOICE_SWEEP_BATCH
+                )
+            for row in rows:
+                _pending_invoices.pop(row["invoice_id"], None)
+            expired += len(rows)
+            if len(rows) < INVOICE_SWEEP_BATCH:
+                break
+            await asyncio.sleep(INVOICE_SWEEP_PAUSE)
+    except Exception as e:
+        logger.error(f"Invoice sweep failed: {e}", exc_info=True)
+    cutoff = datetime.now(pytz.UTC) - timedelta(seconds=INVOICE_TTL)
+    for invoice_id in [i for i, invoice in _pending_invoices.items() if invoice["created_at"] < cutoff]:
+        del _pending_invoices[invoice_id]
+    _invoice_stats["expired"] += expired
+    _invoice_stats["last_sweep"] = datetime.now(pytz.UTC).isoformat()
+    if expired:
+        logger.info(f"Expired {expired} stale pending invoices")
+
+
+def get_invoice_stats() -> dict:
+    return {"pending": len(_pending_invoices), **_invoice_stats}
+
+
+# Payment settlement
+#
+# settle_payment() credits a paid invoice in a single statement: it flips the
+# transaction from pending to completed, adds the stars to the buyer and the
+# referral bonus to the referrer, and returns what it credited. Counters and
+# the prefix follow through their triggers in the same transaction. Only a
+# pending row can be settled, so concurrent confirmations of one invoice
+# credit it once; the unique index on tx_hash stops one on-chain transfer from
+# settling two invoices. That case raises DuplicateTxHash instead of returning
+# None, so callers can answer it as a replay rather than a bad amount.
+class DuplicateTxHash(Exception):
+    """The on-chain transfer has already settled another invoice."""
+
+
+SETTLE_PAYMENT_QUERY = """
+    WITH settled AS (
+        UPDATE transactions
+        SET checked_status = 'completed', purchase_time = NOW(), tx_hash = COALESCE($2, tx_hash)
+        WHERE invoice_id = $1 AND checked_status = 'pending'
+          AND ($3::bigint IS NULL OR abs($3::bigint - (price_ton * 1000000000)::bigint) <= $5)
+        RETURNING user_id, stars_amount, price_ton, recipient_username
+    ), buyer AS (
+        UPDATE users u SET stars_bought = COALESCE(u.stars_bought, 0) + s.stars_amount
+        FROM settled s
+        WHERE u.user_id = s.user_id
+        RETURNING u.user_id, u.referrer_id
+    ), referrer AS (
+        UPDATE users r SET ref_bonus_ton = COALESCE(r.ref_bonus_ton, 0) + s.price_ton * $4 / 100
+        FROM settled s, buyer b
+        WHERE r.user_id = b.referrer_id AND r.user_id <> b.user_id
+        RETURNING r.user_id, s.price_ton * $4 / 100 AS bonus_ton
+    )
+    SELECT s.user_id, s.stars_amount, s.price_ton, s.recipient_username,
+           (SELECT user_id FROM referrer) AS referrer_id,
+           (SELECT bonus_ton FROM referrer) AS bonus_ton
+    FROM settled s
+"""
+
+
+async def settle_payment(invoice_id: str, tx_hash: str = None, amount_nano: int = None, conn=None):
+    """Credit a pending invoice; returns the credited row, or None if nothing was settled.
+
+    Raises DuplicateTxHash when tx_hash has already settled another invoice.
+    """
+    args = (invoice_id, tx_hash, amount_nano, get_setting("ref_bonus"), PAYMENT_AMOUNT_TOLERANCE_NANO)
+    try:
+        if conn is None:
+            async with get_db_connection() as conn:
+                settled = await conn.fetchrow(SETTLE_PAYMENT_QUERY, *args)
+        else:
+            settled = await conn.fetchrow(SETTLE_PAYMENT_QUERY, *args)
+    except asyncpg.UniqueViolationError as e:
+        logger.warning(f"tx_hash {tx_hash} already settled another invoice, ignoring for invoice_id={invoice_id}")
+        raise DuplicateTxHash(tx_hash) from e
+    if settled is None:
+        return None
+    settled = dict(settled)
+    forget_invoice(invoice_id)
+    invalidate_user_profile(settled["user_id"], settled["referrer_id"])
+    invalidate_stats_counters()
+    logger.info(f"Settled invoice_id={invoice_id}: {settled['stars_amount']} stars to user_id={settled['user_id']}")
+    if settled["referrer_id"]:
+        await log_analytics(settled["user_id"], "referral_bonus_added", {
+            "referrer_id": settled["referrer_id"],
+            "bonus_ton": settled["bonus_ton"],
+            "invoice_id": invoice_id
+        })
+    return settled
+
+
+async def notify_admins(app, text: str) -> None:
+    if app is None:
+        return
+    try:
+        async with get_db_connection() as conn:
+            rows = await conn.fetch("SELECT user_id FROM users WHERE is_admin = TRUE")
+    except Exception as e:
+        logger.error(f"Failed to load admins to notify: {e}")
+        return
+    for row in rows:
+        try:
+            await app.bot.send_message(chat_id=row["user_id"], text=text)
+        except TelegramError as e:
+            logger.error(f"Failed to notify admin {row['user_id']}: {e}")
+
+
+async def notify_payment_settled(bot, invoice_id: str, settled: dict) -> None:
+    try:
+        await bot.send_message(
+            chat_id=settled["user_id"],
+            text=f"Платеж подтвержден! {settled['stars_amount']} звезд добавлены для {settled['recipient_username']}.",
+            parse_mode="HTML"
+        )
+    except TelegramError as e:
+        logger.error(f"Failed to notify user {settled['user_id']}: {e}")
+    await log_analytics(settled["user_id"], "payment_confirmed", {
+        "stars": settled["stars_amount"],
+        "recipient": settled["recipient_username"],
+        "invoice_id": invoice_id
+    })
+
+
+# Wallet watcher
+#
+# Payments are detected by polling the OWNER_WALLET transaction stream rather
+# than when a buyer presses "check payment". watch_wallet() runs on the
+# scheduler, fetches only transfers newer than the logical time persisted in
+# wallet_cursors, checks each commented transfer against the pending-invoice
+# registry and hands it to settle_payment(), so tonapi traffic stays at one
+# call per WALLET_POLL_INTERVAL however many buyers are waiting.
+_wallet_watch_stats = {
+    "polls": 0, "transfers": 0, "settled": 0, "unmatched": 0, "errors": 0, "last_lt": None, "last_poll": None
+}
+
+
+def _incoming_transfer(tx: dict):
+    # A failed or bounced transfer carries a comment and a value but left the
+    # funds with the sender
+    in_msg = tx.get("in_msg") or {}
+    if not tx.get("success") or tx.get("aborted") or in_msg.get("bounced"):
+        return None
+    comment = (in_msg.get("decoded_body") or {}).get("text")
+    if not comment or not in_msg.get("value"):
+        return None
+    return comment.strip(), tx["hash"], int(in_msg["value"])
+
+
+async def _settle_transfers(bot, transfers: list) -> None:
+    for comment, tx_hash, amount in transfers:
+        invoice = lookup_invoice(comment)
+        # A registry miss (invoice created on another replica, missed NOTIFY)
+        # still goes to settle_payment(): the cursor moves past this transfer
+        # for good, and the SQL checks pending status and amount itself
+        if invoice and abs(amount - invoice["expected_nano"]) > PAYMENT_AMOUNT_TOLERANCE_NANO:
+            _wallet_watch_stats["unmatched"] += 1
+            logger.warning(f"Transfer {tx_hash} pays {amount} nanoton, invoice_id={comment} expects {invoice['expected_nano']}")
+            continue
+        try:
+            settled = await settle_payment(comment, tx_hash=tx_hash, amount_nano=amount)
+        except DuplicateTxHash:
+            _wallet_watch_stats["unmatched"] += 1
+            continue
+        if not settled:
+            # The cursor moves past this transfer for good, so leave a trace
+            _wallet_watch_stats["unmatched"] += 1
+            async with get_db_connection() as conn:
+                status = await conn.fetchval(
+                    "SELECT checked_status FROM transactions WHERE invoice_id = $1", comment
+                )
+            logger.warning(f"Transfer {tx_hash} of {amount} nanoton with comment {comment!r} settled nothing (invoice status: {status})")
+            if status == "expired":
+                await notify_admins(
+                    telegram_app,
+                    f"Transfer {tx_hash} paid expired invoice {comment}: {amount / 1_000_000_000} TON"
+                )
+            continue
+        _wallet_watch_stats["settled"] += 1
+        await notify_payment_settled(bot, comment, settled)
+
+
+@instrumented("job:watch_wallet")
+async def watch_wallet(bot) -> None:
+    if not OWNER_WALLET:
+        return
+    url = f"{TONAPI_BASE_URL}/blockchain/accounts/{OWNER_WALLET}/transactions"
+    try:
+        async with get_db_connection() as conn:
+            after_lt = await conn.fetchval("SELECT last_lt FROM wallet_cursors WHERE account = $1", OWNER_WALLET)
+        while True:
+            if after_lt is None:
+                # No cursor yet: take the latest page and follow the stream from there
+                params = {"limit": WALLET_POLL_LIMIT, "sort_order": "desc"}
+            else:
+                params = {"limit": WALLET_POLL_LIMIT, "sort_order": "asc", "after_lt": after_lt}
+            async with http_request("tonapi_wallet", "GET", url, params=params, headers=tonapi_headers()) as response:
+                if response.status != 200:
+                    _wallet_watch_stats["errors"] += 1
+                    logger.warning(f"Wallet poll failed: HTTP {response.status}")
+                    return
+                txs = (await response.json()).get("transactions", [])
+            _wallet_watch_stats["polls"] += 1
+            _wallet_watch_stats["last_poll"] = datetime.now(pytz.UTC).isoformat()
+            if not txs:
+                return
+
+            transfers = [transfer for transfer in map(_incoming_transfer, txs) if transfer]
+            _wallet_watch_stats["transfers"] += len(transfers)
+            if transfers:
+                await _settle_transfers(bot, transfers)
+
+            first_page = after_lt is None
+            after_lt = max(int(tx["lt"]) for tx in txs)
+            async with get_db_connection() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO wallet_cursors (account, last_lt, updated_at) VALUES ($1, $2, NOW())
+                    ON CONFLICT (account) DO UPDATE
+                    SET last_lt = GREATEST(wallet_cursors.last_lt, EXCLUDED.last_lt), updated_at = NOW()
+                    """,
+                    OWNER_WALLET, after_lt
+                )
+            _wallet_watch_stats["last_lt"] = after_lt
+            if first_page or len(txs) < WALLET_POLL_LIMIT:
+                return
+    except Exception as e:
+        _wallet_watch_stats["errors"] += 1
+        logger.error(f"Wallet watcher failed: {e}", exc_info=True)
+
+
+def get_wallet_watch_stats() -> dict:
+    return dict(_wallet_watch_stats)
+
+
+# Price quotes
+#
+# The buy screens never price on demand. The quote book holds the current
+# TON/USD rate, the per-star price derived from the settings snapshot and
+# ready-made quotes for the preset packs; it is rebuilt whenever either input
+# changes (set_ton_price() / _swap_settings()), so any amount prices in O(1)
+# without touching the DB or the network. Each quote carries the book version
+# and build time so a stale price can be traced back to its inputs.
+PRESET_STAR_AMOUNTS = (100, 250, 500, 1000)
+FALLBACK_TON_PRICE = 3.32
+_quote_book = {
+    "version": 0,
+    "computed_at": None,
+    "ton_price": 0.0,
+    "ton_price_updated_at": None,
+    "ton_per_star": 0.0,
+    "quotes": {}
+}
+
+
+def rebuild_quotes() -> None:
+    global _quote_book
+    ton_price = _quote_book["ton_price"] or FALLBACK_TON_PRICE
+    usd_per_star = get_setting("price_usd") / 50 * (1 + get_setting("markup") / 100)
+    ton_per_star = usd_per_star / ton_price
+    _quote_book = {
+        **_quote_book,
+        "version": _quote_book["version"] + 1,
+        "computed_at": datetime.now(pytz.UTC),
+        "ton_per_star": ton_per_star,
+        "quotes": {stars: round(stars * ton_per_star, 4) for stars in PRESET_STAR_AMOUNTS}
+    }
+    logger.debug(f"Quote book v{_quote_book['version']}: ton_price={ton_price}, quotes={_quote_book['quotes']}")
+
+
+def set_ton_price(bot_data, price: float, updated_at: datetime = None, diff_24h: float = 0.0) -> None:
+    global _quote_book
+    updated_at = updated_at or datetime.now(pytz.UTC)
+    bot_data["ton_price_info"] = {
+        "price": price,
+        "diff_24h": diff_24h,
+        "updated_at": updated_at
+    }
+    changed = price != _quote_book["ton_price"]
+    _quote_book = {**_quote_book, "ton_price": price, "ton_price_updated_at": updated_at}
+    if changed:
+        rebuild_quotes()
+
+
+def get_quote(stars: int) -> dict:
+    book = _quote_book
+    price_ton = book["quotes"].get(stars)
+    if price_ton is None:
+        price_ton = round(stars * book["ton_per_star"], 4)
+    return {
+        "stars": stars,
+        "price_ton": price_ton,
+        "version": book["version"],
+        "computed_at": book["computed_at"],
+        "ton_price": book["ton_price"]
+    }
+
+
+async def seed_ton_price(bot_data) -> None:
+    try:
+        async with get_db_connection() as conn:
+            price_record = await conn.fetchrow(
+                "SELECT price, updated_at FROM ton_price ORDER BY updated_at DESC LIMIT 1"
+            )
+    except Exception as e:
+        logger.warning(f"Failed to load last TON price from database: {e}")
+        price_record = None
+    if price_record:
+        set_ton_price(bot_data, price_record["price"], price_record["updated_at"])
+        logger.info(f"Seeded TON price from database: {price_record['price']}")
+    else:
+        set_ton_price(bot_data, FALLBACK_TON_PRICE)
+        logger.warning(f"No TON price in database, seeding quotes with fallback: {FALLBACK_TON_PRICE}")
 
 
 async def generate_payload(user_id):
@@ -1084,6 +3696,7 @@ async def format_time_remaining(end_time):
     return html.escape(" ".join(parts) if parts else "менее минуты")
 
 
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     username = update.effective_user.username
@@ -1093,7 +3706,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     try:
         async with asyncio.timeout(10.0):
-            async with (await ensure_db_pool()) as conn:
+            async with get_db_connection() as conn:
                 # Reset state
                 context.user_data.clear()
                 context.user_data["state"] = 0
@@ -1103,21 +3716,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 if args and args[0].isdigit():
                     referrer_id = int(args[0])
                     if referrer_id != user_id:
-                        existing_user = await conn.fetchrow("SELECT user_id FROM users WHERE user_id = $1", user_id)
-                        if not existing_user:
-                            await conn.execute(
-                                "INSERT INTO users (user_id, username, stars_bought, referrals, ref_bonus_ton, referrer_id, is_admin) "
-                                "VALUES ($1, $2, 0, '[]', 0.0, $3, FALSE) ON CONFLICT (user_id) DO NOTHING",
-                                user_id, username, referrer_id
-                            )
-                            await conn.execute(
-                                "UPDATE users SET referrals = jsonb_set(referrals, $1, referrals || $2) "
-                                "WHERE user_id = $3 AND NOT ($4 = ANY(referrals->>'[]')::jsonb)",
-                                [str(len(await conn.fetchval("SELECT referrals FROM users WHERE user_id = $1", referrer_id)))],
-                                json.dumps([str(user_id)]),
-                                referrer_id,
-                                str(user_id)
-                            )
+                        referred = await conn.fetchval(
+                            "WITH new_user AS ("
+                            "INSERT INTO users (user_id, username, stars_bought, ref_bonus_ton, referrer_id, is_admin) "
+                            "VALUES ($1, $2, 0, 0.0, $3, FALSE) ON CONFLICT (user_id) DO NOTHING RETURNING user_id) "
+                            "INSERT INTO referrals (referred_id, referrer_id) "
+                            "SELECT user_id, $3 FROM new_user WHERE EXISTS (SELECT 1 FROM users WHERE user_id = $3) "
+                            "ON CONFLICT (referred_id) DO NOTHING RETURNING referred_id",
+                            user_id, username, referrer_id
+                        )
+                        if referred:
+                            invalidate_user_profile(referrer_id)
                             logger.debug(
                                 f"Added referral: user_id={user_id} referred by {referrer_id}")
 
@@ -1128,15 +3737,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                         "VALUES ($1, $2, 0, '[]', 0.0, FALSE) ON CONFLICT (user_id) DO UPDATE SET username = $2",
                         user_id, username
                     )
+                    remember_username(user_id, username)
                     logger.debug(f"Updated username for user_id={user_id}")
+                invalidate_user_profile(user_id)
 
                 # Check admin status
-                is_admin = await conn.fetchval("SELECT is_admin FROM users WHERE user_id = $1", user_id) or False
+                profile = await get_user_profile(user_id, conn)
+                is_admin = profile["is_admin"]
                 logger.debug(f"User admin status: is_admin={is_admin}")
 
                 # Fetch stats
-                total_stars = await conn.fetchval("SELECT SUM(stars_bought) FROM users") or 0
-                user_stars = await conn.fetchval("SELECT stars_bought FROM users WHERE user_id = $1", user_id) or 0
+                total_stars = (await get_stats_counters(conn))["total_stars"]
+                user_stars = profile["stars_bought"]
 
                 # Send welcome message
                 text = await get_text("welcome", total_stars=total_stars, stars_bought=user_stars)
@@ -1201,7 +3813,7 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = query.from_user.id
     logger.info(f"Showing admin panel for user_id={user_id}")
     try:
-        async with (await ensure_db_pool()) as conn:
+        async with get_db_connection() as conn:
             reminder = await conn.fetchrow("SELECT reminder_date FROM reminders WHERE reminder_type = 'db' ORDER BY created_at DESC LIMIT 1")
             reminder_date = reminder["reminder_date"].strftime(
                 "%Y-%m-%d") if reminder else "Не установлено"
@@ -1252,28 +3864,9 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 async def calculate_price_ton(context: ContextTypes.DEFAULT_TYPE, stars: int) -> float:
-    try:
-        async with (await ensure_db_pool()) as conn:
-            price_usd = await conn.fetchval("SELECT value FROM settings WHERE key = 'price_usd'") or 0.81
-            markup = await conn.fetchval("SELECT value FROM settings WHERE key = 'markup'") or 10.0
-            price_usd = (stars / 50) * price_usd * (1 + markup / 100)
-            ton_price_info = context.bot_data.get("ton_price_info", {})
-            last_updated = ton_price_info.get(
-                "last_updated", datetime.min.replace(tzinfo=pytz.UTC))
-            if (datetime.now(pytz.UTC) - last_updated).total_seconds() > 180 or not ton_price_info.get("price"):
-                await update_ton_price(context)
-            ton_price = context.bot_data["ton_price_info"].get("price", 3.32)
-            if ton_price == 0.0:
-                logger.warning("TON price is zero, fetching from database")
-                price_record = await conn.fetchrow(
-                    "SELECT price FROM ton_price ORDER BY updated_at DESC LIMIT 1"
-                )
-                ton_price = price_record["price"] if price_record else 3.32
-            price_ton = price_usd / ton_price
-            return round(price_ton, 4)
-    except Exception as e:
-        logger.error(f"Ошибка в calculate_price_ton: {e}", exc_info=True)
-        return 0.0
+    quote = get_quote(stars)
+    context.user_data["quote_version"] = quote["version"]
+    return quote["price_ton"]
 
 
 
@@ -1282,7 +3875,7 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = query.from_user.id
     logger.info(f"Showing admin panel for user_id={user_id}")
     try:
-        async with (await ensure_db_pool()) as conn:
+        async with get_db_connection() as conn:
             reminder = await conn.fetchrow("SELECT reminder_date FROM reminders WHERE reminder_type = 'db' ORDER BY created_at DESC LIMIT 1")
             reminder_date = reminder["reminder_date"].strftime(
                 "%Y-%m-%d") if reminder else "Не установлено"
@@ -1345,6 +3938,7 @@ def are_reply_markups_equal(current, new):
     return True
 
 
+@instrumented("message_handler")
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     username = update.effective_user.username or str(user_id)
@@ -1353,9 +3947,9 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     logger.info(f"Message received: user_id={user_id}, state={state}, text={text}")
 
     try:
-        pool = await ensure_db_pool()
-        async with pool.acquire() as conn:
-            is_admin = await conn.fetchval("SELECT is_admin FROM users WHERE user_id = $1", user_id) or False
+        async with get_db_connection() as conn:
+            profile = await get_user_profile(user_id, conn)
+            is_admin = profile["is_admin"]
 
             # Tech break check
             if context.bot_data.get("tech_break_info", {}).get("end_time", datetime.min.replace(tzinfo=pytz.UTC)) > datetime.now(pytz.UTC) and not is_admin:
@@ -1439,42 +4033,6 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await log_analytics(user_id, "set_broadcast_text", {"text_length": len(text)})
                 return 10
 
-            elif state == STATES["admin_edit_profile"] and is_admin:
-                if not text.isdigit():
-                    await update.message.reply_text(
-                        "Пожалуйста, введите корректный ID пользователя.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]])
-                    )
-                    await log_analytics(user_id, "invalid_edit_user_id", {"input": text})
-                    return 11
-                edit_user_id = int(text)
-                user = await conn.fetchrow("SELECT username, stars_bought, ref_bonus_ton, referrals FROM users WHERE user_id = $1", edit_user_id)
-                if not user:
-                    await update.message.reply_text(
-                        "Пользователь не найден.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]])
-                    )
-                    await log_analytics(user_id, "edit_user_not_found", {"edit_user_id": edit_user_id})
-                    return 11
-                context.user_data["edit_user_id"] = edit_user_id
-                username = f"@{user['username']}" if user['username'] else f"ID {edit_user_id}"
-                reply_text = (
-                    f"Редактирование пользователя {username}:\n"
-                    f"Звезды: {user['stars_bought']}\n"
-                    f"Реф. бонус: {user['ref_bonus_ton']} TON\n"
-                    f"Рефералы: {len(json.loads(user['referrals']) if user['referrals'] else [])}"
-                )
-                keyboard = [
-                    [InlineKeyboardButton("Изменить звезды", callback_data="edit_profile_stars")],
-                    [InlineKeyboardButton("Изменить рефералов", callback_data="edit_profile_referrals")],
-                    [InlineKeyboardButton("Изменить реф. бонус", callback_data="edit_profile_ref_bonus")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]
-                ]
-                await update.message.reply_text(reply_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
-                context.user_data["state"] = 11
-                await log_analytics(user_id, "view_edit_profile", {"edit_user_id": edit_user_id})
-                return 11
-
             elif state == STATES["admin_edit_profile"] and is_admin and "edit_profile_field" in context.user_data:
                 edit_user_id = context.user_data.get("edit_user_id")
                 field = context.user_data["edit_profile_field"]
@@ -1494,10 +4052,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 elif field == "referrals":
                     try:
                         referral_ids = [int(r) for r in text.split(",") if r.strip().isdigit()]
-                        await conn.execute(
-                            "UPDATE users SET referrals = $1 WHERE user_id = $2",
-                            json.dumps(referral_ids), edit_user_id
-                        )
+                        async with conn.transaction():
+                            await conn.execute(
+                                "DELETE FROM referrals WHERE referrer_id = $1 AND NOT (referred_id = ANY($2::bigint[]))",
+                                edit_user_id, referral_ids
+                            )
+                            await conn.execute(
+                                "INSERT INTO referrals (referred_id, referrer_id) "
+                                "SELECT DISTINCT unnest($2::bigint[]), $1 "
+                                "ON CONFLICT (referred_id) DO UPDATE SET referrer_id = EXCLUDED.referrer_id "
+                                "WHERE referrals.referrer_id <> EXCLUDED.referrer_id",
+                                edit_user_id, referral_ids
+                            )
                         reply_text = f"Рефералы для пользователя ID {edit_user_id} обновлены."
                     except ValueError:
                         await update.message.reply_text(
@@ -1523,16 +4089,8 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         )
                         await log_analytics(user_id, "invalid_ref_bonus_input", {"input": text})
                         return 11
-                await conn.execute(
-                    "UPDATE users SET prefix = CASE "
-                    "WHEN is_admin THEN 'Verified' "
-                    "WHEN stars_bought >= 50000 THEN 'Verified' "
-                    "WHEN stars_bought >= 10000 THEN 'Regular Buyer' "
-                    "WHEN stars_bought >= 5000 THEN 'Buyer' "
-                    "WHEN stars_bought >= 1000 THEN 'Newbie' "
-                    "ELSE 'Beginner' END WHERE user_id = $1",
-                    edit_user_id
-                )
+                invalidate_user_profile(edit_user_id)
+                invalidate_stats_counters()
                 await update.message.reply_text(
                     reply_text,
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]])
@@ -1542,6 +4100,42 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await log_analytics(user_id, f"edit_{field}", {"edit_user_id": edit_user_id, "value": text})
                 return 11
 
+            elif state == STATES["admin_edit_profile"] and is_admin:
+                if not text.isdigit():
+                    await update.message.reply_text(
+                        "Пожалуйста, введите корректный ID пользователя.",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]])
+                    )
+                    await log_analytics(user_id, "invalid_edit_user_id", {"input": text})
+                    return 11
+                edit_user_id = int(text)
+                user = await conn.fetchrow("SELECT username, stars_bought, ref_bonus_ton, ref_count FROM users WHERE user_id = $1", edit_user_id)
+                if not user:
+                    await update.message.reply_text(
+                        "Пользователь не найден.",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]])
+                    )
+                    await log_analytics(user_id, "edit_user_not_found", {"edit_user_id": edit_user_id})
+                    return 11
+                context.user_data["edit_user_id"] = edit_user_id
+                username = f"@{user['username']}" if user['username'] else f"ID {edit_user_id}"
+                reply_text = (
+                    f"Редактирование пользователя {username}:\n"
+                    f"Звезды: {user['stars_bought']}\n"
+                    f"Реф. бонус: {user['ref_bonus_ton']} TON\n"
+                    f"Рефералы: {user['ref_count']}"
+                )
+                keyboard = [
+                    [InlineKeyboardButton("Изменить звезды", callback_data="edit_profile_stars")],
+                    [InlineKeyboardButton("Изменить рефералов", callback_data="edit_profile_referrals")],
+                    [InlineKeyboardButton("Изменить реф. бонус", callback_data="edit_profile_ref_bonus")],
+                    [InlineKeyboardButton("🔙 Назад", callback_data="admin_edit_profile")]
+                ]
+                await update.message.reply_text(reply_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+                context.user_data["state"] = 11
+                await log_analytics(user_id, "view_edit_profile", {"edit_user_id": edit_user_id})
+                return 11
+
             elif state == STATES["set_db_reminder"] and is_admin:
                 try:
                     reminder_date = datetime.strptime(text, "%Y-%m-%d").date()
@@ -1583,10 +4177,10 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     minutes = int(minutes)
                     if minutes <= 0:
                         raise ValueError("Minutes must be positive")
-                    context.bot_data["tech_break_info"] = {
+                    await publish_cluster_state("tech_break_info", {
                         "end_time": datetime.now(pytz.UTC) + timedelta(minutes=minutes),
                         "reason": html.escape(reason)
-                    }
+                    })
                     reply_text = await get_text(
                         "tech_break_active",
                         end_time=html.escape(context.bot_data["tech_break_info"]["end_time"].strftime("%Y-%m-%d %H:%M:%S UTC")),
@@ -1616,10 +4210,13 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     if value < 0:
                         raise ValueError("Value must be non-negative")
                     await conn.execute(
-                        "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
-                        setting, value
+                        "WITH upserted AS ("
+                        "INSERT INTO settings (key, value) VALUES ($1, $2) "
+                        "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value RETURNING key, value) "
+                        "SELECT pg_notify($3, json_build_object('key', key, 'value', value)::text) FROM upserted",
+                        setting, value, SETTINGS_CHANNEL
                     )
-                    await load_settings()
+                    apply_setting_change(setting, value)
                     reply_text = f"Настройка '{setting}' обновлена: {value}"
                     await update.message.reply_text(
                         reply_text,
@@ -1647,6 +4244,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 return 0
 
     except asyncpg.exceptions.InterfaceError as e:
+        record_error("message_handler", e)
         logger.error(f"Database pool error in message_handler: {e}", exc_info=True)
         await update.message.reply_text(
             "Ошибка: не удалось подключиться к базе данных. Попробуйте позже.",
@@ -1656,6 +4254,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await log_analytics(user_id, "message_handler_db_error", {"error": str(e)})
         return 0
     except Exception as e:
+        record_error("message_handler", e)
         logger.error(f"Unexpected error in message_handler: {e}", exc_info=True)
         await update.message.reply_text(
             "Произошла ошибка. Попробуйте позже или обратитесь в поддержку.",
@@ -1665,829 +4264,954 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await log_analytics(user_id, "message_handler_error", {"error": str(e)})
         return 0
 
-async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
-    start_time = time.time()
-    logger.info(f"Callback query received: user_id={user_id}, data={data}, user_data={context.user_data}")
-
+# Callback routing
+#
+# Inline-button callbacks are dispatched through a route table instead of an
+# if/elif chain. @callback_route registers a handler under exact keys or a
+# prefix; resolve_callback_route() tries the exact key, then the data cut at
+# each "_" from the right, so lookup cost does not grow with the number of
+# screens. Handlers declare only the request fields they use (update,
+# context, query, user_id, data, conn, profile, is_admin, start_time) and the
+# router passes those. The shared preamble (answering the query, the DB
+# connection, the user profile, the tech break) runs once as
+# CALLBACK_MIDDLEWARE; latency and errors are recorded per route.
+_callback_exact_routes = {}
+_callback_prefix_routes = {}
+_callback_route_stats = {}
+
+
+def callback_route(*keys: str, prefix: bool = False, admin: bool = False):
+    def register(handler):
+        route = {
+            "name": handler.__name__,
+            "handler": handler,
+            "params": tuple(inspect.signature(handler).parameters),
+            "admin": admin
+        }
+        table = _callback_prefix_routes if prefix else _callback_exact_routes
+        for key in keys:
+            table[key] = route
+        return handler
+    return register
+
+
+def resolve_callback_route(data: str):
+    route = _callback_exact_routes.get(data) or _callback_prefix_routes.get(data)
+    cut = data.rfind("_")
+    while route is None and cut > 0:
+        route = _callback_prefix_routes.get(data[:cut + 1]) or _callback_prefix_routes.get(data[:cut])
+        cut = data.rfind("_", 0, cut)
+    return route
+
+
+async def answer_callback_query(call: dict, call_next) -> int:
+    query = call["query"]
     try:
         await asyncio.wait_for(query.answer(), timeout=5.0)
-        logger.debug(f"Answered callback query in {time.time() - start_time:.2f}s")
+        logger.debug(f"Answered callback query in {time.time() - call['start_time']:.2f}s")
     except asyncio.TimeoutError:
-        logger.warning(f"Timeout answering callback query for user_id={user_id}, data={data}")
+        logger.warning(f"Timeout answering callback query for user_id={call['user_id']}, data={call['data']}")
     except TelegramError as e:
         logger.warning(f"Failed to answer callback query: {e}")
+    return await call_next(call)
 
-    # Initialize tech_break_info
-    if "tech_break_info" not in context.bot_data:
-        context.bot_data["tech_break_info"] = {"end_time": datetime.min.replace(tzinfo=pytz.UTC), "reason": ""}
 
-    try:
-        pool = await ensure_db_pool()
-        async with pool.acquire() as conn:
-            is_admin = await conn.fetchval("SELECT is_admin FROM users WHERE user_id = $1", user_id) or False
-            logger.debug(f"Fetched admin status in {time.time() - start_time:.2f}s, is_admin={is_admin}")
+async def with_db_connection(call: dict, call_next) -> int:
+    async with get_db_connection() as conn:
+        call["conn"] = conn
+        return await call_next(call)
 
-            # Tech break check
-            if context.bot_data["tech_break_info"].get("end_time", datetime.min.replace(tzinfo=pytz.UTC)) > datetime.now(pytz.UTC) and not is_admin:
-                time_remaining = await format_time_remaining(context.bot_data["tech_break_info"]["end_time"])
-                text = await get_text(
-                    "tech_break_active",
-                    end_time=html.escape(context.bot_data["tech_break_info"]["end_time"].strftime("%Y-%m-%d %H:%M:%S UTC")),
-                    minutes_left=time_remaining,
-                    reason=html.escape(context.bot_data["tech_break_info"].get("reason", "Не указана"))
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 0
-                await log_analytics(user_id, "callback_tech_break", {})
-                logger.debug(f"Processed tech break check in {time.time() - start_time:.2f}s")
-                return 0
 
-            # Admin transactions
-            if data.startswith("admin_transactions") and is_admin:
-                page = int(data.split("_")[-1]) if "_" in data else 0
-                transactions_per_page = 10
-                offset = page * transactions_per_page
-                transactions = await conn.fetch(
-                    "SELECT user_id, recipient_username, stars_amount, price_ton, purchase_time, checked_status "
-                    "FROM transactions ORDER BY purchase_time DESC LIMIT $1 OFFSET $2",
-                    transactions_per_page, offset
-                )
-                total_transactions = await conn.fetchval("SELECT COUNT(*) FROM transactions")
-                if not transactions:
-                    text = "Транзакции отсутствуют."
-                else:
-                    text = f"Все транзакции (страница {page + 1}):\n\n"
-                    for idx, t in enumerate(transactions, start=1 + offset):
-                        utc_time = t['purchase_time']
-                        eest_time = utc_time.astimezone(pytz.timezone('Europe/Tallinn')).strftime('%Y-%m-%d %H:%M:%S EEST')
-                        text += (
-                            f"{idx}. Пользователь ID {t['user_id']} купил {t['stars_amount']} звезд "
-                            f"для {t['recipient_username']} за {t['price_ton']:.4f} TON в {eest_time} "
-                            f"({t['checked_status']})\n\n"
-                        )
-                keyboard = []
-                if total_transactions > (page + 1) * transactions_per_page:
-                    keyboard.append([InlineKeyboardButton("➡️ Далее", callback_data=f"admin_transactions_{page + 1}")])
-                if page > 0:
-                    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_transactions_{page - 1}")])
-                keyboard.append([InlineKeyboardButton("🔙 В админ-панель", callback_data="admin_panel")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 24
-                await log_analytics(user_id, "view_admin_transactions", {"page": page})
-                logger.debug(f"Processed admin transactions in {time.time() - start_time:.2f}s")
-                return 24
-
-            # Profile
-            elif data == "profile":
-                user = await conn.fetchrow(
-                    "SELECT stars_bought, referrals, ref_bonus_ton FROM users WHERE user_id = $1", user_id
-                )
-                stars_bought = user["stars_bought"] if user else 0
-                referrals = json.loads(user["referrals"]) if user and user["referrals"] else []
-                ref_bonus_ton = user["ref_bonus_ton"] if user else 0.0
-                text = await get_text(
-                    "profile",
-                    stars_bought=stars_bought,
-                    ref_count=len(referrals),
-                    ref_bonus_ton=ref_bonus_ton
-                )
-                keyboard = [
-                    [InlineKeyboardButton("📜 Мои транзакции", callback_data="profile_transactions_0")],
-                    [InlineKeyboardButton("🏆 Топ рефералов", callback_data="referral_leaderboard")],
-                    [InlineKeyboardButton("🏅 Топ покупок", callback_data="top_purchases")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 1
-                await log_analytics(user_id, "view_profile", {})
-                logger.debug(f"Processed profile callback in {time.time() - start_time:.2f}s")
-                return 1
-
-            # Profile Transactions
-            elif data.startswith("profile_transactions"):
-                page = int(data.split("_")[-1]) if "_" in data else 0
-                transactions_per_page = 10
-                offset = page * transactions_per_page
-                transactions = await conn.fetch(
-                    "SELECT recipient_username, stars_amount, price_ton, purchase_time "
-                    "FROM transactions WHERE user_id = $1 ORDER BY purchase_time DESC LIMIT $2 OFFSET $3",
-                    user_id, transactions_per_page, offset
-                )
-                total_transactions = await conn.fetchval("SELECT COUNT(*) FROM transactions WHERE user_id = $1", user_id)
-                if not transactions:
-                    text = "Транзакции отсутствуют."
-                else:
-                    text = f"Ваши транзакции (страница {page + 1}):\n\n"
-                    for idx, t in enumerate(transactions, start=1 + offset):
-                        utc_time = t['purchase_time']
-                        eest_time = utc_time.astimezone(pytz.timezone('Europe/Tallinn')).strftime('%Y-%m-%d %H:%M:%S EEST')
-                        text += (
-                            f"{idx}. Куплено {t['stars_amount']} звезд для {t['recipient_username']} "
-                            f"за {t['price_ton']:.4f} TON в {eest_time}\n\n"
-                        )
-                keyboard = []
-                if total_transactions > (page + 1) * transactions_per_page:
-                    keyboard.append([InlineKeyboardButton("➡️ Далее", callback_data=f"profile_transactions_{page + 1}")])
-                if page > 0:
-                    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"profile_transactions_{page - 1}")])
-                keyboard.append([InlineKeyboardButton("🔙 В профиль", callback_data="profile")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 26
-                await log_analytics(user_id, "view_profile_transactions", {"page": page})
-                logger.debug(f"Processed profile transactions in {time.time() - start_time:.2f}s")
-                return 26
-
-            # Referrals
-            elif data == "referrals":
-                user = await conn.fetchrow(
-                    "SELECT referrals, ref_bonus_ton FROM users WHERE user_id = $1", user_id
-                )
-                referrals = json.loads(user["referrals"]) if user and user["referrals"] else []
-                ref_bonus_ton = user["ref_bonus_ton"] if user else 0.0
-                ref_link = f"https://t.me/{context.bot.username}?start={user_id}"
-                text = await get_text(
-                    "referrals",
-                    ref_link=ref_link,
-                    ref_count=len(referrals),
-                    ref_bonus_ton=ref_bonus_ton
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 2
-                await log_analytics(user_id, "view_referrals", {})
-                logger.debug(f"Processed referrals callback in {time.time() - start_time:.2f}s")
-                return 2
-
-            # Referral Leaderboard
-            elif data == "referral_leaderboard":
-                users = await conn.fetch(
-                    "SELECT user_id, username, jsonb_array_length(referrals) as ref_count "
-                    "FROM users WHERE jsonb_array_length(referrals) > 0 "
-                    "ORDER BY ref_count DESC LIMIT 10"
-                )
-                text_lines = []
-                for user in users:
-                    try:
-                        tg_user = await context.bot.get_chat(user['user_id'])
-                        username = f"@{tg_user.username}" if tg_user.username else f"ID <code>{user['user_id']}</code>"
-                    except TelegramError:
-                        username = f"@{user['username']}" if user['username'] else f"ID <code>{user['user_id']}</code>"
-                    text_lines.append(f"{username}, Рефералов: {user['ref_count']}")
-                text = await get_text(
-                    "referral_leaderboard",
-                    users_list="\n".join(text_lines) if text_lines else "Рефералов пока нет."
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 12
-                await log_analytics(user_id, "view_referral_leaderboard", {})
-                logger.debug(f"Processed referral leaderboard in {time.time() - start_time:.2f}s")
-                return 12
-
-            # Top Purchases
-            elif data == "top_purchases":
-                users = await conn.fetch(
-                    "SELECT user_id, username, stars_bought FROM users "
-                    "WHERE stars_bought > 0 ORDER BY stars_bought DESC LIMIT 10"
-                )
-                text_lines = []
-                for user in users:
-                    try:
-                        tg_user = await context.bot.get_chat(user['user_id'])
-                        username = f"@{tg_user.username}" if tg_user.username else f"ID <code>{user['user_id']}</code>"
-                    except TelegramError:
-                        username = f"@{user['username']}" if user['username'] else f"ID <code>{user['user_id']}</code>"
-                    text_lines.append(f"{username}, Звезды: {user['stars_bought']}")
-                text = await get_text(
-                    "top_purchases",
-                    users_list="\n".join(text_lines) if text_lines else "Покупок пока нет."
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 13
-                await log_analytics(user_id, "view_top_purchases", {})
-                logger.debug(f"Processed top purchases in {time.time() - start_time:.2f}s")
-                return 13
-
-            # Buy Stars
-            elif data == "buy_stars":
-                recipient = context.user_data.get("recipient", "Не выбран")
-                stars = context.user_data.get("stars_amount", "Не выбрано")
-                price_ton = await calculate_price_ton(context, int(stars)) if stars and isinstance(stars, str) and stars.isdigit() else None
-                price_text = f"~{price_ton:.4f} TON" if price_ton is not None else "Цена"
-                text = (
-                    f"Пользователь: {recipient}\n"
-                    f"Количество звезд: {stars}"
-                )
-                keyboard = [
-                    [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
-                    [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
-                    [InlineKeyboardButton(price_text, callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 5
-                await log_analytics(user_id, "open_buy_stars_payment_method", {})
-                logger.debug(f"Processed buy stars in {time.time() - start_time:.2f}s")
-                return 5
+async def with_user_profile(call: dict, call_next) -> int:
+    call["profile"] = await get_user_profile(call["user_id"], call["conn"])
+    call["is_admin"] = call["profile"]["is_admin"]
+    logger.debug(f"Fetched admin status in {time.time() - call['start_time']:.2f}s, is_admin={call['is_admin']}")
+    return await call_next(call)
 
-            # Show Price
-            elif data == "show_price":
-                stars = context.user_data.get("stars_amount", "Не выбрано")
-                price_ton = await calculate_price_ton(context, int(stars)) if stars and isinstance(stars, str) and stars.isdigit() else None
-                price_text = f"~{price_ton:.4f} TON" if price_ton is not None else "Цена не определена"
-                await query.answer(text=price_text, show_alert=True)
-                logger.debug(f"Processed show price in {time.time() - start_time:.2f}s")
-                return context.user_data.get("state", 0)
-
-            # Select Recipient
-            elif data == "select_recipient":
-                text = "Введите имя пользователя (например, @username):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 3
-                await log_analytics(user_id, "start_select_recipient", {})
-                logger.debug(f"Processed select recipient in {time.time() - start_time:.2f}s")
-                return 3
-
-            # Select Stars Menu
-            elif data == "select_stars_menu":
-                recipient = context.user_data.get("recipient", "Не выбран")
-                text = f"Пользователь: {recipient}\nВыберите количество звезд:"
-                keyboard = [
-                    [
-                        InlineKeyboardButton("100", callback_data="select_stars_100"),
-                        InlineKeyboardButton("250", callback_data="select_stars_250"),
-                        InlineKeyboardButton("500", callback_data="select_stars_500"),
-                        InlineKeyboardButton("1000", callback_data="select_stars_1000")
-                    ],
-                    [InlineKeyboardButton("Другое", callback_data="select_stars_custom")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 22
-                await log_analytics(user_id, "open_select_stars_menu", {})
-                logger.debug(f"Processed select stars menu in {time.time() - start_time:.2f}s")
-                return 22
-
-            # Select Stars
-            elif data in ["select_stars_100", "select_stars_250", "select_stars_500", "select_stars_1000"]:
-                stars = data.split("_")[-1]
-                context.user_data["stars_amount"] = stars
-                recipient = context.user_data.get("recipient", "Не выбран")
-                price_ton = await calculate_price_ton(context, int(stars))
-                text = (
-                    f"Пользователь: {recipient}\n"
-                    f"Количество звезд: {stars}"
-                )
-                keyboard = [
-                    [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
-                    [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
-                    [InlineKeyboardButton(f"~{price_ton:.4f} TON", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 5
-                await log_analytics(user_id, f"select_stars_{stars}", {"stars": stars})
-                logger.debug(f"Processed select stars {stars} in {time.time() - start_time:.2f}s")
-                return 5
 
-            # Select Custom Stars
-            elif data == "select_stars_custom":
-                text = "Введите количество звезд (положительное число):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="select_stars_menu")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 23
-                await log_analytics(user_id, "start_select_stars_custom", {})
-                logger.debug(f"Processed select custom stars in {time.time() - start_time:.2f}s")
-                return 23
-
-            # Proceed to Payment
-            elif data in ["proceed_to_payment", "pay_stars_menu"]:
-                stars = context.user_data.get("stars_amount")
-                recipient = context.user_data.get("recipient")
-                if not stars:
-                    text = "Ошибка: количество звезд не выбрано."
-                    keyboard = [
-                        [InlineKeyboardButton(f"Пользователь: {context.user_data.get('recipient', 'Не выбран')}", callback_data="select_recipient")],
-                        [InlineKeyboardButton("Количество: Не выбрано", callback_data="select_stars_menu")],
-                        [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
-                        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "proceed_to_payment_error", {"error": "missing_stars", "recipient": recipient})
-                    logger.debug(f"Processed proceed to payment error (missing stars) in {time.time() - start_time:.2f}s")
-                    return 5
-                if not recipient:
-                    text = "Ошибка: пользователь не выбран."
-                    keyboard = [
-                        [InlineKeyboardButton("Пользователь: Не выбран", callback_data="select_recipient")],
-                        [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
-                        [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
-                        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "proceed_to_payment_error", {"error": "missing_recipient", "stars": stars})
-                    logger.debug(f"Processed proceed to payment error (missing recipient) in {time.time() - start_time:.2f}s")
-                    return 5
-                if not isinstance(stars, str) or not stars.isdigit():
-                    text = "Ошибка: количество звезд должно быть числом."
-                    keyboard = [
-                        [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
-                        [InlineKeyboardButton("Количество: Не выбрано", callback_data="select_stars_menu")],
-                        [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
-                        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "proceed_to_payment_error", {"error": "invalid_stars", "stars": stars, "recipient": recipient})
-                    logger.debug(f"Processed proceed to payment error (invalid stars) in {time.time() - start_time:.2f}s")
-                    return 5
-
-                stars = int(stars)
-                price_ton = await calculate_price_ton(context, stars)
-                if price_ton == 0.0:
-                    text = "Ошибка: не удалось рассчитать цену. Попробуйте позже."
-                    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "proceed_to_payment_price_error", {"stars": stars})
-                    logger.debug(f"Processed proceed to payment price error in {time.time() - start_time:.2f}s")
-                    return 5
-
-                owner_wallet = os.getenv("OWNER_WALLET")
-                if not owner_wallet:
-                    logger.error("OWNER_WALLET environment variable not set")
-                    text = "Ошибка: кошелек для оплаты не настроен. Обратитесь в поддержку."
-                    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "proceed_to_payment_wallet_error", {"stars": stars})
-                    return 5
-
-                for attempt in range(3):
-                    try:
-                        async with pool.acquire() as conn:
-                            invoice_id = str(uuid.uuid4())[:8]
-                            amount_nano = int(price_ton * 1_000_000_000)
-                            payment_link = f"ton://transfer/{owner_wallet}?amount={amount_nano}&text={invoice_id}"
+async def tech_break_guard(call: dict, call_next) -> int:
+    context = call["context"]
+    tech_break_info = context.bot_data.setdefault(
+        "tech_break_info", {"end_time": datetime.min.replace(tzinfo=pytz.UTC), "reason": ""}
+    )
+    if tech_break_info.get("end_time", datetime.min.replace(tzinfo=pytz.UTC)) <= datetime.now(pytz.UTC) or call["is_admin"]:
+        return await call_next(call)
+    time_remaining = await format_time_remaining(tech_break_info["end_time"])
+    text = await get_text(
+        "tech_break_active",
+        end_time=html.escape(tech_break_info["end_time"].strftime("%Y-%m-%d %H:%M:%S UTC")),
+        minutes_left=time_remaining,
+        reason=html.escape(tech_break_info.get("reason", "Не указана"))
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(call["query"], text, reply_markup)
+    context.user_data["state"] = 0
+    await log_analytics(call["user_id"], "callback_tech_break", {})
+    logger.debug(f"Processed tech break check in {time.time() - call['start_time']:.2f}s")
+    return 0
+
+
+CALLBACK_MIDDLEWARE = [answer_callback_query, with_db_connection, with_user_profile, tech_break_guard]
+
+
+async def _invoke_callback_route(call: dict) -> int:
+    route = resolve_callback_route(call["data"])
+    if route is None or (route["admin"] and not call["is_admin"]):
+        route = _unknown_callback_route
+    stats = _callback_route_stats.setdefault(route["name"], {
+        "calls": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0
+    })
+    started = time.perf_counter()
+    try:
+        return await route["handler"](**{param: call[param] for param in route["params"]})
+    except Exception:
+        # Counted per route here; bot_errors_total is recorded once, by
+        # callback_query_handler, which sees every failure the router raises
+        stats["errors"] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe_request(f"callback:{route['name']}", elapsed)
+        stats["calls"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+
+
+async def dispatch_callback(call: dict) -> int:
+    async def run(index: int, call: dict) -> int:
+        if index == len(CALLBACK_MIDDLEWARE):
+            return await _invoke_callback_route(call)
+        return await CALLBACK_MIDDLEWARE[index](call, lambda call: run(index + 1, call))
+    return await run(0, call)
+
+
+def get_callback_route_stats() -> dict:
+    return {
+        name: {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "avg_ms": round(stats["total_time"] / stats["calls"] * 1000, 3) if stats["calls"] else 0.0,
+            "max_ms": round(stats["max_time"] * 1000, 3)
+        }
+        for name, stats in _callback_route_stats.items()
+    }
 
-                            await conn.execute(
-                                "INSERT INTO transactions (user_id, recipient_username, stars_amount, price_ton, invoice_id, purchase_time, checked_status) "
-                                "VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                                user_id, recipient, stars, price_ton, invoice_id, datetime.now(pytz.UTC), "pending"
-                            )
 
-                            text = (
-                                f"Оплата за {stars} звезд:\n"
-                                f"Тип кошелька: TON\n"
-                                f"Цена: {price_ton:.4f} TON\n"
-                                f"Комментарий: {invoice_id}\n"
-                                f"Ссылка для оплаты: <a href='{payment_link}'>Оплатить через Tonkeeper</a>"
-                            )
-                            keyboard = [
-                                [InlineKeyboardButton("✅ Проверить оплату", callback_data=f"check_payment_{invoice_id}")],
-                                [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
-                            ]
-                            reply_markup = InlineKeyboardMarkup(keyboard)
-                            await send_or_edit_message(query, text, reply_markup, disable_web_page_preview=True)
-                            context.user_data["state"] = 25
-                            context.user_data["invoice_id"] = invoice_id
-                            context.user_data["price_ton"] = price_ton
-                            await log_analytics(user_id, "proceed_to_payment", {"stars": stars, "recipient": recipient, "invoice_id": invoice_id})
-                            logger.debug(f"Processed proceed to payment in {time.time() - start_time:.2f}s")
-                            return 25
-                    except asyncpg.exceptions.InterfaceError as e:
-                        logger.error(f"Database pool error in proceed_to_payment (attempt {attempt + 1}/3): {e}")
-                        if attempt + 1 < 3:
-                            await asyncio.sleep(1)
-                            continue
-                        text = "Ошибка: не удалось подключиться к базе данных. Попробуйте позже."
-                        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await send_or_edit_message(query, text, reply_markup)
-                        context.user_data["state"] = 5
-                        await log_analytics(user_id, "proceed_to_payment_db_error", {"error": str(e)})
-                        logger.debug(f"Processed proceed to payment db error in {time.time() - start_time:.2f}s")
-                        return 5
-
-            # Check Payment
-            elif data.startswith("check_payment_"):
-                invoice_id = data.split("_")[-1]
-                stars = context.user_data.get("stars_amount")
-                recipient = context.user_data.get("recipient")
-                price_ton = context.user_data.get("price_ton")
-                if not stars or not recipient or not price_ton or not invoice_id:
-                    text = "Ошибка: данные о покупке отсутствуют. Начните заново."
-                    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 5
-                    await log_analytics(user_id, "check_payment_error", {"invoice_id": invoice_id})
-                    logger.debug(f"Processed check payment error in {time.time() - start_time:.2f}s")
-                    return 5
-
-                async with pool.acquire() as conn:
-                    transaction = await conn.fetchrow(
-                        "SELECT checked_status FROM transactions WHERE invoice_id = $1", invoice_id
-                    )
-                    if transaction and transaction["checked_status"] == "completed":
-                        text = f"Платеж подтвержден!\n{stars} звезд добавлены для {recipient}."
-                        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await send_or_edit_message(query, text, reply_markup)
-                        context.user_data["state"] = 0
-                        context.user_data.pop("stars_amount", None)
-                        context.user_data.pop("recipient", None)
-                        context.user_data.pop("price_ton", None)
-                        context.user_data.pop("invoice_id", None)
-                        await log_analytics(user_id, "payment_confirmed", {"stars": stars, "recipient": recipient, "invoice_id": invoice_id})
-                        logger.debug(f"Processed payment confirmed in {time.time() - start_time:.2f}s")
-                        return 0
-
-                    owner_wallet = os.getenv("OWNER_WALLET")
-                    if not owner_wallet:
-                        logger.error("OWNER_WALLET environment variable not set")
-                        text = "Ошибка: кошелек для оплаты не настроен. Обратитесь в поддержку."
-                        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await send_or_edit_message(query, text, reply_markup)
-                        context.user_data["state"] = 5
-                        await log_analytics(user_id, "check_payment_wallet_error", {"invoice_id": invoice_id})
-                        return 5
-
-                    payment_verified = False
-                    for attempt in range(3):
-                        try:
-                            async with aiohttp.ClientSession() as session:
-                                async with session.get(
-                                    f"https://tonapi.io/v2/transactions?to={owner_wallet}&comment={invoice_id}",
-                                    headers={"Authorization": f"Bearer {API_KEY}"} if API_KEY else {}
-                                ) as response:
-                                    if response.status == 200:
-                                        data = await response.json()
-                                        expected_amount = int(price_ton * 1_000_000_000)
-                                        payment_verified = any(
-                                            abs(tx["amount"] - expected_amount) <= 100_000_000
-                                            for tx in data.get("transactions", [])
-                                        )
-                                        break
-                                    else:
-                                        logger.warning(f"TON API returned status {response.status} (attempt {attempt + 1}/3)")
-                                        if attempt + 1 < 3:
-                                            await asyncio.sleep(2 ** attempt)
-                        except Exception as e:
-                            logger.error(f"Failed to verify payment with TON API (attempt {attempt + 1}/3): {e}")
-                            if attempt + 1 < 3:
-                                await asyncio.sleep(2 ** attempt)
-                            continue
+async def unknown_callback(query, context, start_time) -> int:
+    await query.answer("Неизвестная команда.")
+    logger.debug(f"Processed unknown command in {time.time() - start_time:.2f}s")
+    return context.user_data.get("state", 0)
 
-                    if payment_verified:
-                        await conn.execute(
-                            "UPDATE transactions SET checked_status = 'completed', purchase_time = $1 WHERE invoice_id = $2",
-                            datetime.now(pytz.UTC), invoice_id
-                        )
-                        await conn.execute(
-                            "UPDATE users SET stars_bought = stars_bought + $1 WHERE user_id = $2",
-                            int(stars), user_id
-                        )
-                        ref_bonus_percentage = await conn.fetchval("SELECT value FROM settings WHERE key = 'ref_bonus'") or 30.0
-                        referrer_id = await conn.fetchval("SELECT referrer_id FROM users WHERE user_id = $1", user_id)
-                        if referrer_id:
-                            ref_bonus_ton = price_ton * (ref_bonus_percentage / 100)
-                            await conn.execute(
-                                "UPDATE users SET ref_bonus_ton = ref_bonus_ton + $1 WHERE user_id = $2",
-                                ref_bonus_ton, referrer_id
-                            )
-                            await log_analytics(user_id, "referral_bonus_added", {"referrer_id": referrer_id, "bonus_ton": ref_bonus_ton})
-                        text = f"Платеж подтвержден!\n{stars} звезд добавлены для {recipient}."
-                        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await send_or_edit_message(query, text, reply_markup)
-                        context.user_data["state"] = 0
-                        context.user_data.pop("stars_amount", None)
-                        context.user_data.pop("recipient", None)
-                        context.user_data.pop("price_ton", None)
-                        context.user_data.pop("invoice_id", None)
-                        await log_analytics(user_id, "payment_confirmed", {"stars": stars, "recipient": recipient, "invoice_id": invoice_id})
-                        logger.debug(f"Processed payment verified in {time.time() - start_time:.2f}s")
-                        return 0
-                    else:
-                        text = "Оплата еще не подтверждена. Попробуйте снова через несколько минут."
-                        keyboard = [
-                            [InlineKeyboardButton("✅ Проверить снова", callback_data=f"check_payment_{invoice_id}")],
-                            [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        await send_or_edit_message(query, text, reply_markup)
-                        context.user_data["state"] = 25
-                        await log_analytics(user_id, "payment_check_failed", {"invoice_id": invoice_id})
-                        logger.debug(f"Processed payment check failed in {time.time() - start_time:.2f}s")
-                        return 25
-
-            # Admin Panel
-            elif data == "admin_panel" and is_admin:
-                return await show_admin_panel(update, context)
-
-            # Admin Stats
-            elif data == "admin_stats" and is_admin:
-                total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-                total_stars = await conn.fetchval("SELECT SUM(stars_bought) FROM users") or 0
-                total_referrals = await conn.fetchval("SELECT SUM(jsonb_array_length(referrals)) FROM users") or 0
-                text = await get_text(
-                    "stats",
-                    total_users=total_users,
-                    total_stars=total_stars,
-                    total_referrals=total_referrals
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 9
-                await log_analytics(user_id, "view_admin_stats", {})
-                logger.debug(f"Processed admin stats in {time.time() - start_time:.2f}s")
-                return 9
-
-            # Broadcast Message
-            elif data == "broadcast_message" and is_admin:
-                text = "Введите текст для рассылки:"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 10
-                await log_analytics(user_id, "start_broadcast", {})
-                logger.debug(f"Processed broadcast message in {time.time() - start_time:.2f}s")
-                return 10
 
-            # Confirm Broadcast
-            elif data == "confirm_broadcast" and is_admin:
-                broadcast_text = context.user_data.get("broadcast_text", "")
-                if not broadcast_text:
-                    text = "Текст рассылки пуст. Введите текст заново."
-                    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await send_or_edit_message(query, text, reply_markup)
-                    context.user_data["state"] = 10
-                    await log_analytics(user_id, "empty_broadcast", {})
-                    logger.debug(f"Processed empty broadcast in {time.time() - start_time:.2f}s")
-                    return 10
-                users = await conn.fetch("SELECT user_id FROM users")
-                success_count = 0
-                for user in users:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=user["user_id"],
-                            text=broadcast_text,
-                            parse_mode="HTML"
-                        )
-                        success_count += 1
-                        await asyncio.sleep(0.1)
-                    except TelegramError as e:
-                        logger.error(f"Failed to send broadcast to {user['user_id']}: {e}")
-                text = f"Рассылка завершена. Отправлено {success_count} из {len(users)} пользователям."
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data.pop("broadcast_text", None)
-                context.user_data["state"] = 8
-                await log_analytics(user_id, "complete_broadcast", {"success_count": success_count, "total_users": len(users)})
-                logger.debug(f"Processed confirm broadcast in {time.time() - start_time:.2f}s")
-                return 8
-
-            # Cancel Broadcast
-            elif data == "cancel_broadcast" and is_admin:
-                text = "Рассылка отменена."
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data.pop("broadcast_text", None)
-                context.user_data["state"] = 8
-                await log_analytics(user_id, "cancel_broadcast", {})
-                logger.debug(f"Processed cancel broadcast in {time.time() - start_time:.2f}s")
-                return await show_admin_panel(update, context)
-
-            # Admin Edit Profile
-            elif data == "admin_edit_profile" and is_admin:
-                text = "Введите ID пользователя для редактирования:"
-                keyboard = [
-                    [InlineKeyboardButton("📋 Все пользователи", callback_data="all_users")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 11
-                await log_analytics(user_id, "start_edit_profile", {})
-                logger.debug(f"Processed admin edit profile in {time.time() - start_time:.2f}s")
-                return 11
+_unknown_callback_route = {
+    "name": "unknown_callback",
+    "handler": unknown_callback,
+    "params": ("query", "context", "start_time"),
+    "admin": False
+}
 
-            # All Users
-            elif data == "all_users" and is_admin:
-                users = await conn.fetch(
-                    "SELECT user_id, username, stars_bought FROM users ORDER BY stars_bought DESC LIMIT 10"
-                )
-                text_lines = []
-                for user in users:
-                    try:
-                        tg_user = await context.bot.get_chat(user['user_id'])
-                        username = f"@{tg_user.username}" if tg_user.username else f"ID <code>{user['user_id']}</code>"
-                        if tg_user.username and tg_user.username != user['username']:
-                            await conn.execute(
-                                "UPDATE users SET username = $1 WHERE user_id = $2",
-                                tg_user.username, user['user_id']
-                            )
-                            logger.info(f"Updated username for user_id={user['user_id']} to {tg_user.username}")
-                    except TelegramError:
-                        username = f"@{user['username']}" if user['username'] else f"ID <code>{user['user_id']}</code>"
-                    text_lines.append(f"{username}, ID <code>{user['user_id']}</code> Звезды: {user['stars_bought']}")
-                text = await get_text(
-                    "all_users",
-                    users_list="\n".join(text_lines) if text_lines else "Пользователи не найдены."
-                )
-                keyboard = [[InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 15
-                await log_analytics(user_id, "view_all_users", {"users_count": len(users)})
-                logger.debug(f"Processed all users in {time.time() - start_time:.2f}s")
-                return 15
-
-            # Edit Profile Stars
-            elif data == "edit_profile_stars" and is_admin:
-                context.user_data["edit_profile_field"] = "stars_bought"
-                text = "Введите новое количество звезд:"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 11
-                await log_analytics(user_id, "start_edit_stars", {})
-                logger.debug(f"Processed edit profile stars in {time.time() - start_time:.2f}s")
-                return 11
 
-            # Edit Profile Referrals
-            elif data == "edit_profile_referrals" and is_admin:
-                context.user_data["edit_profile_field"] = "referrals"
-                text = "Введите ID рефералов через запятую:"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 11
-                await log_analytics(user_id, "start_edit_referrals", {})
-                logger.debug(f"Processed edit profile referrals in {time.time() - start_time:.2f}s")
-                return 11
+# Admin transactions
+@callback_route("admin_transactions", prefix=True, admin=True)
+async def admin_transactions_callback(context, query, user_id, data, conn, start_time) -> int:
+    page, direction, cursor = parse_page_callback(data, "admin_transactions")
+    transactions_per_page = 10
+    offset = page * transactions_per_page
+    transactions, has_prev, has_next = await fetch_transactions_page(
+        conn, direction, cursor, transactions_per_page
+    )
+    if not transactions:
+        text = "Транзакции отсутствуют."
+    else:
+        text = f"Все транзакции (страница {page + 1}):\n\n"
+        for idx, t in enumerate(transactions, start=1 + offset):
+            utc_time = t['purchase_time']
+            eest_time = utc_time.astimezone(pytz.timezone('Europe/Tallinn')).strftime('%Y-%m-%d %H:%M:%S EEST') if utc_time else "—"
+            text += (
+                f"{idx}. Пользователь ID {t['user_id']} купил {t['stars_amount']} звезд "
+                f"для {t['recipient_username']} за {t['price_ton']:.4f} TON в {eest_time} "
+                f"({t['checked_status']})\n\n"
+            )
+    keyboard = []
+    if transactions and has_next:
+        last = transactions[-1]
+        keyboard.append([InlineKeyboardButton("➡️ Далее", callback_data=page_callback(
+            "admin_transactions", "n", page + 1, last["purchase_time"], last["id"]))])
+    if transactions and has_prev and page > 0:
+        first = transactions[0]
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=page_callback(
+            "admin_transactions", "p", page - 1, first["purchase_time"], first["id"]))])
+    keyboard.append([InlineKeyboardButton("🔙 В админ-панель", callback_data="admin_panel")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 24
+    await log_analytics(user_id, "view_admin_transactions", {"page": page})
+    logger.debug(f"Processed admin transactions in {time.time() - start_time:.2f}s")
+    return 24
+
+
+# Profile
+@callback_route("profile")
+async def profile_callback(context, query, user_id, profile, start_time) -> int:
+    text = await get_text(
+        "profile",
+        stars_bought=profile["stars_bought"],
+        ref_count=profile["ref_count"],
+        ref_bonus_ton=profile["ref_bonus_ton"]
+    )
+    keyboard = [
+        [InlineKeyboardButton("📜 Мои транзакции", callback_data="profile_transactions_0")],
+        [InlineKeyboardButton("🏆 Топ рефералов", callback_data="referral_leaderboard")],
+        [InlineKeyboardButton("🏅 Топ покупок", callback_data="top_purchases")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 1
+    await log_analytics(user_id, "view_profile", {})
+    logger.debug(f"Processed profile callback in {time.time() - start_time:.2f}s")
+    return 1
+
+
+# Profile Transactions
+@callback_route("profile_transactions", prefix=True)
+async def profile_transactions_callback(context, query, user_id, data, conn, start_time) -> int:
+    page, direction, cursor = parse_page_callback(data, "profile_transactions")
+    transactions_per_page = 10
+    offset = page * transactions_per_page
+    transactions, has_prev, has_next = await fetch_transactions_page(
+        conn, direction, cursor, transactions_per_page, user_id=user_id
+    )
+    if not transactions:
+        text = "Транзакции отсутствуют."
+    else:
+        text = f"Ваши транзакции (страница {page + 1}):\n\n"
+        for idx, t in enumerate(transactions, start=1 + offset):
+            utc_time = t['purchase_time']
+            eest_time = utc_time.astimezone(pytz.timezone('Europe/Tallinn')).strftime('%Y-%m-%d %H:%M:%S EEST') if utc_time else "—"
+            text += (
+                f"{idx}. Куплено {t['stars_amount']} звезд для {t['recipient_username']} "
+                f"за {t['price_ton']:.4f} TON в {eest_time}\n\n"
+            )
+    keyboard = []
+    if transactions and has_next:
+        last = transactions[-1]
+        keyboard.append([InlineKeyboardButton("➡️ Далее", callback_data=page_callback(
+            "profile_transactions", "n", page + 1, last["purchase_time"], last["id"]))])
+    if transactions and has_prev and page > 0:
+        first = transactions[0]
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=page_callback(
+            "profile_transactions", "p", page - 1, first["purchase_time"], first["id"]))])
+    keyboard.append([InlineKeyboardButton("🔙 В профиль", callback_data="profile")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 26
+    await log_analytics(user_id, "view_profile_transactions", {"page": page})
+    logger.debug(f"Processed profile transactions in {time.time() - start_time:.2f}s")
+    return 26
+
+
+# Referrals
+@callback_route("referrals")
+async def referrals_callback(context, query, user_id, profile, start_time) -> int:
+    ref_link = f"https://t.me/{context.bot.username}?start={user_id}"
+    text = await get_text(
+        "referrals",
+        ref_link=ref_link,
+        ref_count=profile["ref_count"],
+        ref_bonus_ton=profile["ref_bonus_ton"]
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 2
+    await log_analytics(user_id, "view_referrals", {})
+    logger.debug(f"Processed referrals callback in {time.time() - start_time:.2f}s")
+    return 2
+
+
+# Referral Leaderboard
+@callback_route("referral_leaderboard")
+async def referral_leaderboard_callback(context, query, user_id, start_time) -> int:
+    text_lines = leaderboard_lines("referrals", "Рефералов")
+    text = await get_text(
+        "referral_leaderboard",
+        users_list="\n".join(text_lines) if text_lines else "Рефералов пока нет."
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 12
+    await log_analytics(user_id, "view_referral_leaderboard", {})
+    logger.debug(f"Processed referral leaderboard in {time.time() - start_time:.2f}s")
+    return 12
+
+
+# Top Purchases
+@callback_route("top_purchases")
+async def top_purchases_callback(context, query, user_id, start_time) -> int:
+    text_lines = leaderboard_lines("stars", "Звезды")
+    text = await get_text(
+        "top_purchases",
+        users_list="\n".join(text_lines) if text_lines else "Покупок пока нет."
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 13
+    await log_analytics(user_id, "view_top_purchases", {})
+    logger.debug(f"Processed top purchases in {time.time() - start_time:.2f}s")
+    return 13
+
+
+# Buy Stars
+@callback_route("buy_stars")
+async def buy_stars_callback(context, query, user_id, start_time) -> int:
+    recipient = context.user_data.get("recipient", "Не выбран")
+    stars = context.user_data.get("stars_amount", "Не выбрано")
+    price_ton = await calculate_price_ton(context, int(stars)) if stars and isinstance(stars, str) and stars.isdigit() else None
+    price_text = f"~{price_ton:.4f} TON" if price_ton is not None else "Цена"
+    text = (
+        f"Пользователь: {recipient}\n"
+        f"Количество звезд: {stars}"
+    )
+    keyboard = [
+        [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
+        [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
+        [InlineKeyboardButton(price_text, callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 5
+    await log_analytics(user_id, "open_buy_stars_payment_method", {})
+    logger.debug(f"Processed buy stars in {time.time() - start_time:.2f}s")
+    return 5
+
+
+# Show Price
+@callback_route("show_price")
+async def show_price_callback(context, query, start_time) -> int:
+    stars = context.user_data.get("stars_amount", "Не выбрано")
+    price_ton = await calculate_price_ton(context, int(stars)) if stars and isinstance(stars, str) and stars.isdigit() else None
+    price_text = f"~{price_ton:.4f} TON" if price_ton is not None else "Цена не определена"
+    await query.answer(text=price_text, show_alert=True)
+    logger.debug(f"Processed show price in {time.time() - start_time:.2f}s")
+    return context.user_data.get("state", 0)
+
+
+# Select Recipient
+@callback_route("select_recipient")
+async def select_recipient_callback(context, query, user_id, start_time) -> int:
+    text = "Введите имя пользователя (например, @username):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 3
+    await log_analytics(user_id, "start_select_recipient", {})
+    logger.debug(f"Processed select recipient in {time.time() - start_time:.2f}s")
+    return 3
+
+
+# Select Stars Menu
+@callback_route("select_stars_menu")
+async def select_stars_menu_callback(context, query, user_id, start_time) -> int:
+    recipient = context.user_data.get("recipient", "Не выбран")
+    text = f"Пользователь: {recipient}\nВыберите количество звезд:"
+    keyboard = [
+        [
+            InlineKeyboardButton("100", callback_data="select_stars_100"),
+            InlineKeyboardButton("250", callback_data="select_stars_250"),
+            InlineKeyboardButton("500", callback_data="select_stars_500"),
+            InlineKeyboardButton("1000", callback_data="select_stars_1000")
+        ],
+        [InlineKeyboardButton("Другое", callback_data="select_stars_custom")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 22
+    await log_analytics(user_id, "open_select_stars_menu", {})
+    logger.debug(f"Processed select stars menu in {time.time() - start_time:.2f}s")
+    return 22
+
+
+# Select Stars
+@callback_route("select_stars_100", "select_stars_250", "select_stars_500", "select_stars_1000")
+async def select_stars_callback(context, query, user_id, data, start_time) -> int:
+    stars = data.split("_")[-1]
+    context.user_data["stars_amount"] = stars
+    recipient = context.user_data.get("recipient", "Не выбран")
+    price_ton = await calculate_price_ton(context, int(stars))
+    text = (
+        f"Пользователь: {recipient}\n"
+        f"Количество звезд: {stars}"
+    )
+    keyboard = [
+        [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
+        [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
+        [InlineKeyboardButton(f"~{price_ton:.4f} TON", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 5
+    await log_analytics(user_id, f"select_stars_{stars}", {"stars": stars})
+    logger.debug(f"Processed select stars {stars} in {time.time() - start_time:.2f}s")
+    return 5
+
+
+# Select Custom Stars
+@callback_route("select_stars_custom")
+async def select_custom_stars_callback(context, query, user_id, start_time) -> int:
+    text = "Введите количество звезд (положительное число):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="select_stars_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 23
+    await log_analytics(user_id, "start_select_stars_custom", {})
+    logger.debug(f"Processed select custom stars in {time.time() - start_time:.2f}s")
+    return 23
+
+
+# Proceed to Payment
+@callback_route("proceed_to_payment", "pay_stars_menu")
+async def proceed_to_payment_callback(context, query, user_id, conn, start_time) -> int:
+    stars = context.user_data.get("stars_amount")
+    recipient = context.user_data.get("recipient")
+    if not stars:
+        text = "Ошибка: количество звезд не выбрано."
+        keyboard = [
+            [InlineKeyboardButton(f"Пользователь: {context.user_data.get('recipient', 'Не выбран')}", callback_data="select_recipient")],
+            [InlineKeyboardButton("Количество: Не выбрано", callback_data="select_stars_menu")],
+            [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "proceed_to_payment_error", {"error": "missing_stars", "recipient": recipient})
+        logger.debug(f"Processed proceed to payment error (missing stars) in {time.time() - start_time:.2f}s")
+        return 5
+    if not recipient:
+        text = "Ошибка: пользователь не выбран."
+        keyboard = [
+            [InlineKeyboardButton("Пользователь: Не выбран", callback_data="select_recipient")],
+            [InlineKeyboardButton(f"Количество: {stars}", callback_data="select_stars_menu")],
+            [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "proceed_to_payment_error", {"error": "missing_recipient", "stars": stars})
+        logger.debug(f"Processed proceed to payment error (missing recipient) in {time.time() - start_time:.2f}s")
+        return 5
+    if not isinstance(stars, str) or not stars.isdigit():
+        text = "Ошибка: количество звезд должно быть числом."
+        keyboard = [
+            [InlineKeyboardButton(f"Пользователь: {recipient}", callback_data="select_recipient")],
+            [InlineKeyboardButton("Количество: Не выбрано", callback_data="select_stars_menu")],
+            [InlineKeyboardButton("Цена", callback_data="show_price"), InlineKeyboardButton("Оплатить", callback_data="proceed_to_payment")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "proceed_to_payment_error", {"error": "invalid_stars", "stars": stars, "recipient": recipient})
+        logger.debug(f"Processed proceed to payment error (invalid stars) in {time.time() - start_time:.2f}s")
+        return 5
+
+    stars = int(stars)
+    price_ton = await calculate_price_ton(context, stars)
+    if price_ton == 0.0:
+        text = "Ошибка: не удалось рассчитать цену. Попробуйте позже."
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "proceed_to_payment_price_error", {"stars": stars, "quote_version": context.user_data.get("quote_version")})
+        logger.debug(f"Processed proceed to payment price error in {time.time() - start_time:.2f}s")
+        return 5
+
+    owner_wallet = os.getenv("OWNER_WALLET")
+    if not owner_wallet:
+        logger.error("OWNER_WALLET environment variable not set")
+        text = "Ошибка: кошелек для оплаты не настроен. Обратитесь в поддержку."
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "proceed_to_payment_wallet_error", {"stars": stars})
+        return 5
 
-            # Edit Profile Referral Bonus
-            elif data == "edit_profile_ref_bonus" and is_admin:
-                context.user_data["edit_profile_field"] = "ref_bonus_ton"
-                text = "Введите новый реферальный бонус (TON):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 11
-                await log_analytics(user_id, "start_edit_ref_bonus", {})
-                logger.debug(f"Processed edit profile ref bonus in {time.time() - start_time:.2f}s")
-                return 11
+    for attempt in range(3):
+        try:
+            async with get_db_connection() as conn:
+                invoice_id = str(uuid.uuid4())[:8]
+                amount_nano = int(price_ton * 1_000_000_000)
+                payment_link = f"ton://transfer/{owner_wallet}?amount={amount_nano}&text={invoice_id}"
 
-            # Set DB Reminder
-            elif data == "set_db_reminder" and is_admin:
-                text = "Введите дату напоминания в формате гггг-мм-дд:"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 14
-                await log_analytics(user_id, "start_set_db_reminder", {})
-                logger.debug(f"Processed set db reminder in {time.time() - start_time:.2f}s")
-                return 14
-
-            # Tech Break
-            elif data == "tech_break" and is_admin:
-                text = "Введите длительность тех. перерыва (в минутах) и причину (формат: <минуты> <причина>):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 16
-                await log_analytics(user_id, "start_tech_break", {})
-                logger.debug(f"Processed tech break in {time.time() - start_time:.2f}s")
-                return 16
-
-            # Bot Settings
-            elif data == "bot_settings" and is_admin:
-                price_usd = await conn.fetchval("SELECT value FROM settings WHERE key = 'price_usd'") or 0.81
-                markup = await conn.fetchval("SELECT value FROM settings WHERE key = 'markup'") or 10.0
-                ref_bonus = await conn.fetchval("SELECT value FROM settings WHERE key = 'ref_bonus'") or 30.0
-                text = await get_text(
-                    "bot_settings",
-                    price_usd=price_usd,
-                    markup=markup,
-                    ref_bonus=ref_bonus
+                created_at = datetime.now(pytz.UTC)
+                await conn.execute(
+                    "WITH created AS ("
+                    "INSERT INTO transactions (user_id, recipient_username, stars_amount, price_ton, invoice_id, purchase_time, checked_status) "
+                    "VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING user_id, price_ton, invoice_id, purchase_time) "
+                    "SELECT pg_notify($8, json_build_object("
+                    "'invoice_id', invoice_id, 'user_id', user_id, 'price_ton', price_ton, 'created_at', purchase_time)::text) "
+                    "FROM created",
+                    user_id, recipient, stars, price_ton, invoice_id, created_at, "pending", INVOICES_CHANNEL
+                )
+                register_invoice(invoice_id, user_id, price_ton, created_at)
+
+                text = (
+                    f"Оплата за {stars} звезд:\n"
+                    f"Тип кошелька: TON\n"
+                    f"Цена: {price_ton:.4f} TON\n"
+                    f"Комментарий: {invoice_id}\n"
+                    f"Ссылка для оплаты: <a href='{payment_link}'>Оплатить через Tonkeeper</a>"
                 )
                 keyboard = [
-                    [InlineKeyboardButton("Изменить цену за 50 звезд", callback_data="edit_price_usd")],
-                    [InlineKeyboardButton("Изменить накрутку", callback_data="edit_markup")],
-                    [InlineKeyboardButton("Изменить реф. бонус", callback_data="edit_ref_bonus")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 17
-                await log_analytics(user_id, "view_bot_settings", {})
-                logger.debug(f"Processed bot settings in {time.time() - start_time:.2f}s")
-                return 17
-
-            # Edit Price USD
-            elif data == "edit_price_usd" and is_admin:
-                text = "Введите новую цену за 50 звезд (USD):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 17
-                context.user_data["edit_setting"] = "price_usd"
-                await log_analytics(user_id, "start_edit_price_usd", {})
-                logger.debug(f"Processed edit price usd in {time.time() - start_time:.2f}s")
-                return 17
-
-            # Edit Markup
-            elif data == "edit_markup" and is_admin:
-                text = "Введите новую накрутку (%):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 17
-                context.user_data["edit_setting"] = "markup"
-                await log_analytics(user_id, "start_edit_markup", {})
-                logger.debug(f"Processed edit markup in {time.time() - start_time:.2f}s")
-                return 17
-
-            # Edit Referral Bonus
-            elif data == "edit_ref_bonus" and is_admin:
-                text = "Введите новый реферальный бонус (%):"
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data["state"] = 17
-                context.user_data["edit_setting"] = "ref_bonus"
-                await log_analytics(user_id, "start_edit_ref_bonus", {})
-                logger.debug(f"Processed edit ref bonus in {time.time() - start_time:.2f}s")
-                return 17
-
-            # Back to Admin
-            elif data == "back_to_admin" and is_admin:
-                return await show_admin_panel(update, context)
-
-            # Back to Menu
-            elif data == "back_to_menu":
-                total_stars = await conn.fetchval("SELECT SUM(stars_bought) FROM users") or 0
-                user_stars = await conn.fetchval("SELECT stars_bought FROM users WHERE user_id = $1", user_id) or 0
-                text = await get_text("welcome", total_stars=total_stars, stars_bought=user_stars)
-                keyboard = [
-                    [
-                        InlineKeyboardButton("📰 Новости", url="https://t.me/CheapStarsShop_support"),
-                        InlineKeyboardButton("📞 Поддержка и Отзывы", url="https://t.me/cheapstarshop_news")
-                    ],
-                    [
-                        InlineKeyboardButton("👤 Профиль", callback_data="profile"),
-                        InlineKeyboardButton("🤝 Рефералы", callback_data="referrals")
-                    ],
-                    [InlineKeyboardButton("🛒 Купить звезды", callback_data="buy_stars")]
+                    [InlineKeyboardButton("✅ Проверить оплату", callback_data=f"check_payment_{invoice_id}")],
+                    [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
                 ]
-                if is_admin:
-                    keyboard.append([InlineKeyboardButton("🔧 Админ-панель", callback_data="admin_panel")])
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await send_or_edit_message(query, text, reply_markup)
-                context.user_data.clear()
-                context.user_data["state"] = 0
-                await log_analytics(user_id, "back_to_menu", {})
-                logger.debug(f"Processed back to menu in {time.time() - start_time:.2f}s")
-                return 0
+                await send_or_edit_message(query, text, reply_markup, disable_web_page_preview=True)
+                context.user_data["state"] = 25
+                context.user_data["invoice_id"] = invoice_id
+                context.user_data["price_ton"] = price_ton
+                await log_analytics(user_id, "proceed_to_payment", {"stars": stars, "recipient": recipient, "invoice_id": invoice_id})
+                logger.debug(f"Processed proceed to payment in {time.time() - start_time:.2f}s")
+                return 25
+        except asyncpg.exceptions.InterfaceError as e:
+            logger.error(f"Database pool error in proceed_to_payment (attempt {attempt + 1}/3): {e}")
+            if attempt + 1 < 3:
+                await asyncio.sleep(1)
+                continue
+            text = "Ошибка: не удалось подключиться к базе данных. Попробуйте позже."
+            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await send_or_edit_message(query, text, reply_markup)
+            context.user_data["state"] = 5
+            await log_analytics(user_id, "proceed_to_payment_db_error", {"error": str(e)})
+            logger.debug(f"Processed proceed to payment db error in {time.time() - start_time:.2f}s")
+            return 5
+
+
+# Check Payment
+@callback_route("check_payment_", prefix=True)
+async def check_payment_callback(context, query, user_id, data, conn, start_time) -> int:
+    invoice_id = data.split("_")[-1]
+    stars = context.user_data.get("stars_amount")
+    recipient = context.user_data.get("recipient")
+    price_ton = context.user_data.get("price_ton")
+    if not stars or not recipient or not price_ton or not invoice_id:
+        text = "Ошибка: данные о покупке отсутствуют. Начните заново."
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 5
+        await log_analytics(user_id, "check_payment_error", {"invoice_id": invoice_id})
+        logger.debug(f"Processed check payment error in {time.time() - start_time:.2f}s")
+        return 5
+
+    # Read the DB, not the registry: another replica may have settled it
+    status = await conn.fetchval(
+        "SELECT checked_status FROM transactions WHERE invoice_id = $1", invoice_id
+    )
+    if status == "completed":
+        text = f"Платеж подтвержден!\n{stars} звезд добавлены для {recipient}."
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 0
+        context.user_data.pop("stars_amount", None)
+        context.user_data.pop("recipient", None)
+        context.user_data.pop("price_ton", None)
+        context.user_data.pop("invoice_id", None)
+        await log_analytics(user_id, "payment_confirmed", {"stars": stars, "recipient": recipient, "invoice_id": invoice_id})
+        logger.debug(f"Processed payment confirmed in {time.time() - start_time:.2f}s")
+        return 0
 
-            else:
-                await query.answer("Неизвестная команда.")
-                logger.debug(f"Processed unknown command in {time.time() - start_time:.2f}s")
-                return context.user_data.get("state", 0)
+    # The wallet watcher settles the invoice as soon as the transfer lands
+    text = "Оплата еще не подтверждена. Попробуйте снова через несколько минут."
+    keyboard = [
+        [InlineKeyboardButton("✅ Проверить снова", callback_data=f"check_payment_{invoice_id}")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 25
+    await log_analytics(user_id, "payment_check_failed", {"invoice_id": invoice_id})
+    logger.debug(f"Processed payment check failed in {time.time() - start_time:.2f}s")
+    return 25
+
+
+# Admin Panel
+@callback_route("admin_panel", admin=True)
+async def admin_panel_callback(update, context) -> int:
+    return await show_admin_panel(update, context)
+
+
+# Admin Stats
+@callback_route("admin_stats", admin=True)
+async def admin_stats_callback(context, query, user_id, conn, start_time) -> int:
+    counters = await get_stats_counters(conn)
+    text = await get_text(
+        "stats",
+        total_users=counters["total_users"],
+        total_stars=counters["total_stars"],
+        total_referrals=counters["total_referrals"]
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 9
+    await log_analytics(user_id, "view_admin_stats", {})
+    logger.debug(f"Processed admin stats in {time.time() - start_time:.2f}s")
+    return 9
+
+
+# Broadcast Message
+@callback_route("broadcast_message", admin=True)
+async def broadcast_message_callback(context, query, user_id, start_time) -> int:
+    text = "Введите текст для рассылки:"
+    keyboard = [
+        [InlineKeyboardButton("📊 Рассылки", callback_data="broadcast_jobs")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 10
+    await log_analytics(user_id, "start_broadcast", {})
+    logger.debug(f"Processed broadcast message in {time.time() - start_time:.2f}s")
+    return 10
+
+
+# Confirm Broadcast
+@callback_route("confirm_broadcast", admin=True)
+async def confirm_broadcast_callback(context, query, user_id, conn, start_time) -> int:
+    broadcast_text = context.user_data.get("broadcast_text", "")
+    if not broadcast_text:
+        text = "Текст рассылки пуст. Введите текст заново."
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await send_or_edit_message(query, text, reply_markup)
+        context.user_data["state"] = 10
+        await log_analytics(user_id, "empty_broadcast", {})
+        logger.debug(f"Processed empty broadcast in {time.time() - start_time:.2f}s")
+        return 10
+    total_users = (await get_stats_counters(conn))["total_users"]
+    job_id = await conn.fetchval(
+        "INSERT INTO broadcast_jobs (created_by, text, total_users) VALUES ($1, $2, $3) RETURNING id",
+        user_id, broadcast_text, total_users
+    )
+    start_broadcast_job(context.bot, job_id)
+    text = f"Рассылка #{job_id} запущена для ~{total_users} пользователей."
+    keyboard = [
+        [InlineKeyboardButton("📊 Статус", callback_data=f"broadcast_status_{job_id}")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data.pop("broadcast_text", None)
+    context.user_data["state"] = 8
+    await log_analytics(user_id, "complete_broadcast", {"job_id": job_id, "total_users": total_users})
+    logger.debug(f"Processed confirm broadcast in {time.time() - start_time:.2f}s")
+    return 8
+
+
+# Broadcast Jobs
+@callback_route("broadcast_jobs", admin=True)
+async def broadcast_jobs_callback(context, query, user_id, conn) -> int:
+    jobs = await conn.fetch(
+        "SELECT id, status, sent_count, total_users, created_at FROM broadcast_jobs ORDER BY id DESC LIMIT 5"
+    )
+    text = "Последние рассылки:" if jobs else "Рассылок пока не было."
+    keyboard = [
+        [InlineKeyboardButton(
+            f"#{j['id']} {j['status']} {j['sent_count']}/{j['total_users']}",
+            callback_data=f"broadcast_status_{j['id']}")]
+        for j in jobs
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="broadcast_message")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 8
+    await log_analytics(user_id, "view_broadcast_jobs", {})
+    return 8
+
+
+# Broadcast Status / Stop
+@callback_route("broadcast_status_", "broadcast_stop_", prefix=True, admin=True)
+async def broadcast_status_stop_callback(context, query, user_id, data, conn, start_time) -> int:
+    job_id = int(data.rsplit("_", 1)[-1])
+    if data.startswith("broadcast_stop_"):
+        await conn.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = NOW(), updated_at = NOW() "
+            "WHERE id = $1 AND status = ANY($2::text[])",
+            job_id, list(BROADCAST_ACTIVE_STATUSES)
+        )
+        await log_analytics(user_id, "cancel_broadcast_job", {"job_id": job_id})
+    job = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1", job_id)
+    text = format_broadcast_status(job) if job else f"Рассылка #{job_id} не найдена."
+    keyboard = []
+    if job and job["status"] in BROADCAST_ACTIVE_STATUSES:
+        keyboard.append([
+            InlineKeyboardButton("🔄 Обновить", callback_data=f"broadcast_status_{job_id}"),
+            InlineKeyboardButton("⛔ Остановить", callback_data=f"broadcast_stop_{job_id}")
+        ])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="broadcast_jobs")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 8
+    logger.debug(f"Processed broadcast status in {time.time() - start_time:.2f}s")
+    return 8
+
+
+# Cancel Broadcast
+@callback_route("cancel_broadcast", admin=True)
+async def cancel_broadcast_callback(update, context, query, user_id, start_time) -> int:
+    text = "Рассылка отменена."
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data.pop("broadcast_text", None)
+    context.user_data["state"] = 8
+    await log_analytics(user_id, "cancel_broadcast", {})
+    logger.debug(f"Processed cancel broadcast in {time.time() - start_time:.2f}s")
+    return await show_admin_panel(update, context)
+
+
+# Admin Edit Profile
+@callback_route("admin_edit_profile", admin=True)
+async def admin_edit_profile_callback(context, query, user_id, start_time) -> int:
+    text = "Введите ID пользователя для редактирования:"
+    keyboard = [
+        [InlineKeyboardButton("📋 Все пользователи", callback_data="all_users")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 11
+    await log_analytics(user_id, "start_edit_profile", {})
+    logger.debug(f"Processed admin edit profile in {time.time() - start_time:.2f}s")
+    return 11
+
+
+# All Users
+@callback_route("all_users", admin=True)
+async def all_users_callback(context, query, user_id, conn, start_time) -> int:
+    users = await conn.fetch(
+        "SELECT user_id, username, stars_bought FROM users ORDER BY stars_bought DESC LIMIT 10"
+    )
+    names = await resolve_usernames(
+        context.bot, [(user['user_id'], user['username']) for user in users]
+    )
+    text_lines = [
+        f"{format_user_handle(user['user_id'], names.get(user['user_id']))}, "
+        f"ID <code>{user['user_id']}</code> Звезды: {user['stars_bought']}"
+        for user in users
+    ]
+    text = await get_text(
+        "all_users",
+        users_list="\n".join(text_lines) if text_lines else "Пользователи не найдены."
+    )
+    keyboard = [[InlineKeyboardButton("🔙 Назад в админ-панель", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 15
+    await log_analytics(user_id, "view_all_users", {"users_count": len(users)})
+    logger.debug(f"Processed all users in {time.time() - start_time:.2f}s")
+    return 15
+
+
+# Edit Profile Stars
+@callback_route("edit_profile_stars", admin=True)
+async def edit_profile_stars_callback(context, query, user_id, start_time) -> int:
+    context.user_data["edit_profile_field"] = "stars_bought"
+    text = "Введите новое количество звезд:"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 11
+    await log_analytics(user_id, "start_edit_stars", {})
+    logger.debug(f"Processed edit profile stars in {time.time() - start_time:.2f}s")
+    return 11
+
+
+# Edit Profile Referrals
+@callback_route("edit_profile_referrals", admin=True)
+async def edit_profile_referrals_callback(context, query, user_id, start_time) -> int:
+    context.user_data["edit_profile_field"] = "referrals"
+    text = "Введите ID рефералов через запятую:"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 11
+    await log_analytics(user_id, "start_edit_referrals", {})
+    logger.debug(f"Processed edit profile referrals in {time.time() - start_time:.2f}s")
+    return 11
+
+
+# Edit Profile Referral Bonus
+@callback_route("edit_profile_ref_bonus", admin=True)
+async def edit_profile_referral_bonus_callback(context, query, user_id, start_time) -> int:
+    context.user_data["edit_profile_field"] = "ref_bonus_ton"
+    text = "Введите новый реферальный бонус (TON):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 11
+    await log_analytics(user_id, "start_edit_ref_bonus", {})
+    logger.debug(f"Processed edit profile ref bonus in {time.time() - start_time:.2f}s")
+    return 11
+
+
+# Set DB Reminder
+@callback_route("set_db_reminder", admin=True)
+async def set_db_reminder_callback(context, query, user_id, start_time) -> int:
+    text = "Введите дату напоминания в формате гггг-мм-дд:"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 14
+    await log_analytics(user_id, "start_set_db_reminder", {})
+    logger.debug(f"Processed set db reminder in {time.time() - start_time:.2f}s")
+    return 14
+
+
+# Tech Break
+@callback_route("tech_break", admin=True)
+async def tech_break_callback(context, query, user_id, start_time) -> int:
+    text = "Введите длительность тех. перерыва (в минутах) и причину (формат: <минуты> <причина>):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 16
+    await log_analytics(user_id, "start_tech_break", {})
+    logger.debug(f"Processed tech break in {time.time() - start_time:.2f}s")
+    return 16
+
+
+# Bot Settings
+@callback_route("bot_settings", admin=True)
+async def bot_settings_callback(context, query, user_id, start_time) -> int:
+    text = await get_text(
+        "bot_settings",
+        price_usd=get_setting("price_usd"),
+        markup=get_setting("markup"),
+        ref_bonus=get_setting("ref_bonus")
+    )
+    keyboard = [
+        [InlineKeyboardButton("Изменить цену за 50 звезд", callback_data="edit_price_usd")],
+        [InlineKeyboardButton("Изменить накрутку", callback_data="edit_markup")],
+        [InlineKeyboardButton("Изменить реф. бонус", callback_data="edit_ref_bonus")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 17
+    await log_analytics(user_id, "view_bot_settings", {})
+    logger.debug(f"Processed bot settings in {time.time() - start_time:.2f}s")
+    return 17
+
+
+# Edit Price USD
+@callback_route("edit_price_usd", admin=True)
+async def edit_price_usd_callback(context, query, user_id, start_time) -> int:
+    text = "Введите новую цену за 50 звезд (USD):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 17
+    context.user_data["edit_setting"] = "price_usd"
+    await log_analytics(user_id, "start_edit_price_usd", {})
+    logger.debug(f"Processed edit price usd in {time.time() - start_time:.2f}s")
+    return 17
+
+
+# Edit Markup
+@callback_route("edit_markup", admin=True)
+async def edit_markup_callback(context, query, user_id, start_time) -> int:
+    text = "Введите новую накрутку (%):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 17
+    context.user_data["edit_setting"] = "markup"
+    await log_analytics(user_id, "start_edit_markup", {})
+    logger.debug(f"Processed edit markup in {time.time() - start_time:.2f}s")
+    return 17
+
+
+# Edit Referral Bonus
+@callback_route("edit_ref_bonus", admin=True)
+async def edit_referral_bonus_callback(context, query, user_id, start_time) -> int:
+    text = "Введите новый реферальный бонус (%):"
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="bot_settings")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data["state"] = 17
+    context.user_data["edit_setting"] = "ref_bonus"
+    await log_analytics(user_id, "start_edit_ref_bonus", {})
+    logger.debug(f"Processed edit ref bonus in {time.time() - start_time:.2f}s")
+    return 17
+
+
+# Back to Admin
+@callback_route("back_to_admin", admin=True)
+async def back_to_admin_callback(update, context) -> int:
+    return await show_admin_panel(update, context)
+
+
+# Back to Menu
+@callback_route("back_to_menu")
+async def back_to_menu_callback(context, query, user_id, conn, profile, is_admin, start_time) -> int:
+    total_stars = (await get_stats_counters(conn))["total_stars"]
+    text = await get_text("welcome", total_stars=total_stars, stars_bought=profile["stars_bought"])
+    keyboard = [
+        [
+            InlineKeyboardButton("📰 Новости", url="https://t.me/CheapStarsShop_support"),
+            InlineKeyboardButton("📞 Поддержка и Отзывы", url="https://t.me/cheapstarshop_news")
+        ],
+        [
+            InlineKeyboardButton("👤 Профиль", callback_data="profile"),
+            InlineKeyboardButton("🤝 Рефералы", callback_data="referrals")
+        ],
+        [InlineKeyboardButton("🛒 Купить звезды", callback_data="buy_stars")]
+    ]
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("🔧 Админ-панель", callback_data="admin_panel")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await send_or_edit_message(query, text, reply_markup)
+    context.user_data.clear()
+    context.user_data["state"] = 0
+    await log_analytics(user_id, "back_to_menu", {})
+    logger.debug(f"Processed back to menu in {time.time() - start_time:.2f}s")
+    return 0
 
+
+@instrumented("callback_query_handler")
+async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    user_id = query.from_user.id
+    data = query.data
+    start_time = time.time()
+    logger.info(f"Callback query received: user_id={user_id}, data={data}, user_data={context.user_data}")
+
+    try:
+        return await dispatch_callback({
+            "update": update,
+            "context": context,
+            "query": query,
+            "user_id": user_id,
+            "data": data,
+            "start_time": start_time
+        })
     except asyncpg.exceptions.InterfaceError as e:
+        record_error("callback_query_handler", e)
         logger.error(f"Database pool error in callback_query_handler: {e}", exc_info=True)
         text = "Ошибка: не удалось подключиться к базе данных. Попробуйте позже."
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
@@ -2497,6 +5221,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         await log_analytics(user_id, "database_error", {"error": str(e)})
         return 0
     except TelegramError as e:
+        record_error("callback_query_handler", e)
         logger.error(f"Telegram API error in callback_query_handler: {e}", exc_info=True)
         text = "Ошибка Telegram API. Пожалуйста, попробуйте снова или обратитесь в поддержку."
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
@@ -2506,6 +5231,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         await log_analytics(user_id, "telegram_error", {"error": str(e)})
         return 0
     except Exception as e:
+        record_error("callback_query_handler", e)
         logger.error(f"Unexpected error in callback_query_handler: {e}", exc_info=True)
         text = "Произошла ошибка. Попробуйте снова или обратитесь в поддержку."
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
@@ -2538,6 +5264,7 @@ async def lifespan(app):
     await telegram_app.shutdown()
 
 
+@instrumented("webhook")
 async def webhook(request: web.Request) -> web.Response:
     logger.info(f"Webhook received: {request.method} {request.path}")
     start_time = time.time()
@@ -2551,122 +5278,30 @@ async def webhook(request: web.Request) -> web.Response:
             return await handle_ton_webhook(data)
 
         # Handle Telegram webhook
+        if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+            logger.warning("Telegram webhook rejected: bad secret token")
+            return web.json_response({"error": "Forbidden"}, status=403)
         update = Update.de_json(data, telegram_app.bot)
         if update:
-            await telegram_app.process_update(update)
-            logger.debug(f"Processed Telegram update in {time.time() - start_time:.2f}s")
+            if not enqueue_update(update):
+                return web.json_response({"error": "Busy"}, status=503)
+            logger.debug(f"Queued Telegram update in {time.time() - start_time:.2f}s")
             return web.json_response({"status": "ok"})
         else:
             logger.warning("Invalid Telegram update received")
             return web.json_response({"error": "Invalid update"}, status=400)
 
     except json.JSONDecodeError as e:
+        record_error("webhook", e)
         logger.error(f"Failed to decode webhook JSON: {e}", exc_info=True)
         return web.json_response({"error": "Invalid JSON"}, status=400)
     except Exception as e:
+        record_error("webhook", e)
         logger.error(f"Error processing webhook: {e}", exc_info=True)
         await notify_admins(telegram_app, f"Webhook error: {str(e)}")
         return web.json_response({"error": str(e)}, status=500)
 
 
-async def health_check(request: web.Request) -> web.Response:
-    logger.info("Health check called: %s %s", request.method, request.path)
-    try:
-        pool = await ensure_db_pool()
-        async with pool.acquire() as conn:
-            await conn.execute("SELECT 1")
-        return web.json_response({"status": "healthy", "database": "connected"})
-    except Exception as e:
-        logger.error(f"Health check failed: {e}", exc_info=True)
-        return web.json_response(
-            {"status": "running", "database": "unavailable", "error": str(e)},
-            status=200  # Return 200 to avoid UptimeRobot alerts
-        )
-
-async def handle_ton_webhook(data: dict) -> web.Response:
-    logger.info(f"Handling TON webhook: {data}")
-    try:
-        account_id = data.get("account_id")
-        tx_hash = data.get("tx_hash")
-        amount = data.get("amount")  # Amount in nanoton
-        comment = data.get("comment")  # Invoice ID
-
-        if not all([account_id, tx_hash, amount, comment]):
-            logger.warning(f"Incomplete TON webhook data: {data}")
-            return web.json_response({"error": "Missing required fields"}, status=400)
-
-        owner_wallet = os.getenv("OWNER_WALLET")
-        if not owner_wallet:
-            logger.error("OWNER_WALLET not set")
-            return web.json_response({"error": "Server configuration error"}, status=500)
-
-        if account_id != owner_wallet:
-            logger.warning(f"Received TON webhook for unknown wallet: {account_id}")
-            return web.json_response({"error": "Invalid wallet"}, status=400)
-
-        async with (await ensure_db_pool()).acquire() as conn:
-            transaction = await conn.fetchrow(
-                "SELECT user_id, stars_amount, price_ton, recipient_username FROM transactions WHERE invoice_id = $1 AND checked_status = 'pending'",
-                comment
-            )
-            if not transaction:
-                logger.warning(f"No pending transaction found for invoice_id: {comment}")
-                return web.json_response({"error": "Transaction not found"}, status=404)
-
-            expected_amount = int(transaction["price_ton"] * 1_000_000_000)
-            if abs(amount - expected_amount) > 100_000_000:  # Allow 0.1 TON tolerance
-                logger.warning(f"Amount mismatch: expected {expected_amount}, received {amount}")
-                return web.json_response({"error": "Amount mismatch"}, status=400)
-
-            # Update transaction and user
-            await conn.execute(
-                "UPDATE transactions SET checked_status = 'completed', purchase_time = $1, tx_hash = $2 WHERE invoice_id = $3",
-                datetime.now(pytz.UTC), tx_hash, comment
-            )
-            await conn.execute(
-                "UPDATE users SET stars_bought = stars_bought + $1 WHERE user_id = $2",
-                transaction["stars_amount"], transaction["user_id"]
-            )
-
-            # Award referral bonus
-            ref_bonus_percentage = await conn.fetchval("SELECT value FROM settings WHERE key = 'ref_bonus'") or 30.0
-            referrer_id = await conn.fetchval("SELECT referrer_id FROM users WHERE user_id = $1", transaction["user_id"])
-            if referrer_id:
-                ref_bonus_ton = transaction["price_ton"] * (ref_bonus_percentage / 100)
-                await conn.execute(
-                    "UPDATE users SET ref_bonus_ton = ref_bonus_ton + $1 WHERE user_id = $2",
-                    ref_bonus_ton, referrer_id
-                )
-                await log_analytics(transaction["user_id"], "referral_bonus_added", {
-                    "referrer_id": referrer_id,
-                    "bonus_ton": ref_bonus_ton,
-                    "invoice_id": comment
-                })
-
-            # Notify user
-            try:
-                await telegram_app.bot.send_message(
-                    chat_id=transaction["user_id"],
-                    text=f"Платеж подтвержден! {transaction['stars_amount']} звезд добавлены для {transaction['recipient_username']}.",
-                    parse_mode="HTML"
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {transaction['user_id']}: {e}")
-
-            logger.info(f"Processed TON transaction: invoice_id={comment}, stars={transaction['stars_amount']}")
-            await log_analytics(transaction["user_id"], "payment_confirmed", {
-                "stars": transaction["stars_amount"],
-                "recipient": transaction["recipient_username"],
-                "invoice_id": comment
-            })
-            return web.json_response({"status": "ok"})
-
-    except Exception as e:
-        logger.error(f"Error in handle_ton_webhook: {e}", exc_info=True)
-        await notify_admins(telegram_app, f"TON webhook error: {str(e)}")
-        return web.json_response({"error": str(e)}, status=500)
-
-
 async def setup_handlers(app: Application) -> None:
     logger.info("Setting up handlers")
     app.add_handler(CommandHandler("start", start))
@@ -2686,10 +5321,16 @@ async def test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 # aiohttp Handlers
 async def health_check(request: web.Request) -> web.Response:
+    # Answered from the background health monitor's state; never touches the DB
     logger.info(f"Health check called: {request.method} {request.path}")
-    async with (await ensure_db_pool()).acquire() as conn:
-        await conn.execute("SELECT 1")
-    return web.json_response({"status": "ok"})
+    pool_stats = get_db_pool_stats()
+    healthy = pool_stats["usable"] and not pool_stats["circuit_open"]
+    return web.json_response({
+        "status": "ok" if healthy else "degraded",
+        "database": "connected" if healthy else "unavailable",
+        "last_check": pool_stats["last_check"],
+        "last_error": pool_stats["last_error"]
+    })
 
 async def favicon_handler(request: web.Request) -> web.Response:
     logger.info("Favicon requested")
@@ -2717,62 +5358,39 @@ async def handle_ton_webhook(data: dict) -> web.Response:
             logger.warning(f"Received TON webhook for unknown wallet: {account_id}")
             return web.json_response({"error": "Invalid wallet"}, status=400)
 
-        async with (await ensure_db_pool()).acquire() as conn:
-            transaction = await conn.fetchrow(
-                "SELECT user_id, stars_amount, price_ton, recipient_username FROM transactions WHERE invoice_id = $1 AND checked_status = 'pending'",
-                comment
-            )
-            if not transaction:
-                logger.warning(f"No pending transaction found for invoice_id: {comment}")
-                return web.json_response({"error": "Transaction not found"}, status=404)
-
-            expected_amount = int(transaction["price_ton"] * 1_000_000_000)
-            if abs(amount - expected_amount) > 100_000_000:  # Allow 0.1 TON tolerance
-                logger.warning(f"Amount mismatch: expected {expected_amount}, received {amount}")
-                return web.json_response({"error": "Amount mismatch"}, status=400)
-
-            # Update transaction and user
-            await conn.execute(
-                "UPDATE transactions SET checked_status = 'completed', purchase_time = $1, tx_hash = $2 WHERE invoice_id = $3",
-                datetime.now(pytz.UTC), tx_hash, comment
-            )
-            await conn.execute(
-                "UPDATE users SET stars_bought = stars_bought + $1 WHERE user_id = $2",
-                transaction["stars_amount"], transaction["user_id"]
-            )
+        invoice = lookup_invoice(comment)
+        if invoice and abs(int(amount) - invoice["expected_nano"]) > PAYMENT_AMOUNT_TOLERANCE_NANO:
+            logger.warning(f"Amount mismatch: expected {invoice['expected_nano']}, received {amount}")
+            return web.json_response({"error": "Amount mismatch"}, status=400)
 
-            # Award referral bonus
-            ref_bonus_percentage = await conn.fetchval("SELECT value FROM settings WHERE key = 'ref_bonus'") or 30.0
-            referrer_id = await conn.fetchval("SELECT referrer_id FROM users WHERE user_id = $1", transaction["user_id"])
-            if referrer_id:
-                ref_bonus_ton = transaction["price_ton"] * (ref_bonus_percentage / 100)
-                await conn.execute(
-                    "UPDATE users SET ref_bonus_ton = ref_bonus_ton + $1 WHERE user_id = $2",
-                    ref_bonus_ton, referrer_id
+        try:
+            transaction = await settle_payment(comment, tx_hash=tx_hash, amount_nano=int(amount)) if invoice else None
+        except DuplicateTxHash:
+            return web.json_response({"status": "already_processed"})
+        if not transaction:
+            async with get_db_connection() as conn:
+                existing = await conn.fetchrow(
+                    "SELECT checked_status, price_ton FROM transactions WHERE invoice_id = $1", comment
                 )
-                await log_analytics(transaction["user_id"], "referral_bonus_added", {
-                    "referrer_id": referrer_id,
-                    "bonus_ton": ref_bonus_ton,
-                    "invoice_id": comment
-                })
+            if not existing:
+                logger.warning(f"No transaction found for invoice_id: {comment}")
+                return web.json_response({"error": "Transaction not found"}, status=404)
+            if existing["checked_status"] != "pending":
+                logger.info(f"Duplicate TON webhook for invoice_id={comment} ({existing['checked_status']})")
+                return web.json_response({"status": "already_processed"})
+            if not invoice:
+                # Pending in the DB but missing from this replica's registry
+                try:
+                    transaction = await settle_payment(comment, tx_hash=tx_hash, amount_nano=int(amount))
+                except DuplicateTxHash:
+                    return web.json_response({"status": "already_processed"})
+            if not transaction:
+                logger.warning(f"Amount mismatch: expected {int(existing['price_ton'] * 1_000_000_000)}, received {amount}")
+                return web.json_response({"error": "Amount mismatch"}, status=400)
 
-            # Notify user
-            try:
-                await telegram_app.bot.send_message(
-                    chat_id=transaction["user_id"],
-                    text=f"Платеж подтвержден! {transaction['stars_amount']} звезд добавлены для {transaction['recipient_username']}.",
-                    parse_mode="HTML"
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {transaction['user_id']}: {e}")
-
-            logger.info(f"Processed TON transaction: invoice_id={comment}, stars={transaction['stars_amount']}")
-            await log_analytics(transaction["user_id"], "payment_confirmed", {
-                "stars": transaction["stars_amount"],
-                "recipient": transaction["recipient_username"],
-                "invoice_id": comment
-            })
-            return web.json_response({"status": "ok"})
+        await notify_payment_settled(telegram_app.bot, comment, transaction)
+        logger.info(f"Processed TON transaction: invoice_id={comment}, stars={transaction['stars_amount']}")
+        return web.json_response({"status": "ok"})
 
     except Exception as e:
         logger.error(f"Error in handle_ton_webhook: {e}", exc_info=True)
@@ -2797,17 +5415,33 @@ async def main():
 
     # Initialize Telegram application
     try:
-        telegram_app = Application.builder().token(os.getenv("BOT_TOKEN")).build()
+        telegram_app = (
+            Application.builder()
+            .token(os.getenv("BOT_TOKEN"))
+            .concurrent_updates(update_processor)
+            .persistence(state_persistence)
+            .build()
+        )
         logger.info("Telegram application created successfully")
     except Exception as e:
         logger.error(f"Failed to create Telegram application: {e}", exc_info=True)
         raise
 
+    # Shared HTTP client for all outbound API calls
+    await init_http_client()
+
     # Initialize database pool
     try:
         _db_pool = await ensure_db_pool()
         await init_db()
         logger.info("Database pool initialized and schema created")
+        start_analytics_writer()
+        start_referrals_backfill()
+        await load_settings()
+        try:
+            await ensure_pg_listener()
+        except Exception as e:
+            logger.warning(f"Postgres listener unavailable, will retry from health check: {e}")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}", exc_info=True)
         await notify_admins(telegram_app, f"Database initialization failed: {e}")
@@ -2818,27 +5452,32 @@ async def main():
         "end_time": datetime.min.replace(tzinfo=pytz.UTC),
         "reason": ""
     }
-    telegram_app.bot_data["ton_price_info"] = {
-        "price": 3.32,
-        "diff_24h": 0.0,
-        "updated_at": datetime.now(pytz.UTC)
-    }
+    await seed_ton_price(telegram_app.bot_data)
+    await init_cluster_state(telegram_app.bot_data)
+    await load_leaderboards()
+    await load_pending_invoices()
     logger.debug("Initialized bot_data")
 
     # Register Telegram handlers
     await setup_handlers(telegram_app)
+    await telegram_app.initialize()
+    await telegram_app.start()
+    start_update_workers(telegram_app)
 
     # Set up aiohttp server with Flask integration
     app = web.Application()
     app.router.add_route('GET', '/', health_check)  # Handle both GET and HEAD with one route
     app.router.add_post('/webhook', webhook)
     app.router.add_get('/debug_pool', debug_pool)
+    app.router.add_get('/debug/db', debug_db)
+    app.router.add_get('/metrics', metrics)
     app.router.add_get('/favicon.ico', favicon_handler)
 
     # Add Flask routes via aiohttp_wsgi
-    wsgi = WSGIHandler(app_flask)
+    wsgi = WSGIHandler(app_flask, executor=admin_executor)
     app.router.add_route('*', '/{path:.*}', wsgi.handle_request)
 
+    scheduler = None
     try:
         runner = web.AppRunner(app)
         await runner.setup()
@@ -2850,7 +5489,7 @@ async def main():
         webhook_url = os.getenv("WEBHOOK_URL", f"https://{os.getenv('HOSTNAME', 'stars-ejwz.onrender.com')}/webhook")
         logger.info(f"Setting webhook to {webhook_url}...")
         await telegram_app.bot.delete_webhook(drop_pending_updates=True)
-        await telegram_app.bot.set_webhook(webhook_url, drop_pending_updates=True)
+        await telegram_app.bot.set_webhook(webhook_url, drop_pending_updates=True, secret_token=WEBHOOK_SECRET_TOKEN)
         logger.info("Webhook set successfully")
 
         # Schedule TON price updates
@@ -2860,11 +5499,61 @@ async def main():
             'interval',
             minutes=5,
             args=[telegram_app],
+            next_run_time=datetime.now(pytz.UTC),
             max_instances=1,
             misfire_grace_time=30
         )
+        scheduler.add_job(
+            watch_wallet,
+            'interval',
+            seconds=WALLET_POLL_INTERVAL,
+            args=[telegram_app.bot],
+            next_run_time=datetime.now(pytz.UTC),
+            max_instances=1,
+            misfire_grace_time=WALLET_POLL_INTERVAL
+        )
+        scheduler.add_job(
+            sweep_expired_invoices,
+            'interval',
+            seconds=INVOICE_SWEEP_INTERVAL,
+            max_instances=1,
+            misfire_grace_time=INVOICE_SWEEP_INTERVAL
+        )
+        scheduler.add_job(
+            check_db_health,
+            'interval',
+            seconds=DB_HEALTH_CHECK_INTERVAL,
+            max_instances=1,
+            misfire_grace_time=DB_HEALTH_CHECK_INTERVAL
+        )
+        scheduler.add_job(
+            resume_broadcast_jobs,
+            'interval',
+            seconds=60,
+            args=[telegram_app.bot],
+            next_run_time=datetime.now(pytz.UTC),
+            max_instances=1,
+            misfire_grace_time=60
+        )
+        scheduler.add_job(
+            refresh_leaderboards,
+            'interval',
+            seconds=LEADERBOARD_REFRESH_INTERVAL,
+            args=[telegram_app.bot],
+            next_run_time=datetime.now(pytz.UTC),
+            max_instances=1,
+            misfire_grace_time=LEADERBOARD_REFRESH_INTERVAL
+        )
+        scheduler.add_job(
+            reconcile_stats_counters,
+            'cron',
+            hour=4,
+            minute=0,
+            max_instances=1,
+            misfire_grace_time=3600
+        )
         scheduler.start()
-        logger.info("TON price update scheduler started")
+        logger.info("TON price update and database health scheduler started")
 
         # Keep the application running
         await asyncio.Event().wait()
@@ -2874,12 +5563,52 @@ async def main():
         raise
     finally:
         logger.info("Shutting down bot...")
+        # Scheduled jobs and broadcasts go first, while the bot, the HTTP
+        # client and the pool they use are still open
+        try:
+            if scheduler is not None and scheduler.running:
+                scheduler.shutdown(wait=False)
+        except Exception as e:
+            logger.error(f"Failed to shut down scheduler: {e}", exc_info=True)
+        try:
+            await stop_broadcast_jobs()
+        except Exception as e:
+            logger.error(f"Failed to stop broadcast jobs: {e}", exc_info=True)
+        try:
+            await drain_update_queue()
+        except Exception as e:
+            logger.error(f"Failed to drain update queue: {e}", exc_info=True)
+        try:
+            if telegram_app and telegram_app.running:
+                await telegram_app.stop()
+        except Exception as e:
+            logger.error(f"Failed to stop Telegram application: {e}", exc_info=True)
         try:
             if telegram_app:
                 await telegram_app.shutdown()
                 logger.info("Telegram application shut down successfully")
         except Exception as e:
             logger.error(f"Failed to shut down Telegram application: {e}", exc_info=True)
+        try:
+            await close_http_client()
+        except Exception as e:
+            logger.error(f"Failed to close HTTP client: {e}", exc_info=True)
+        try:
+            await stop_referrals_backfill()
+        except Exception as e:
+            logger.error(f"Failed to stop referrals backfill: {e}", exc_info=True)
+        try:
+            close_admin_db()
+        except Exception as e:
+            logger.error(f"Failed to close admin DB pool: {e}", exc_info=True)
+        try:
+            await close_pg_listener()
+        except Exception as e:
+            logger.error(f"Failed to close Postgres listener: {e}", exc_info=True)
+        try:
+            await flush_analytics()
+        except Exception as e:
+            logger.error(f"Failed to flush analytics: {e}", exc_info=True)
         if _db_pool is not None:
             try:
                 async with _db_pool.acquire() as conn:
@@ -2897,9 +5626,21 @@ async def main():
         await runner.cleanup()
         logger.info("aiohttp server shut down")
 
+async def run_backfill_prefixes():
+    await ensure_db_pool()
+    try:
+        await run_migrations()
+        await backfill_prefixes()
+    finally:
+        await _close_db_pool(_db_pool)
+
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if sys.argv[1:] == ["backfill-prefixes"]:
+            asyncio.run(run_backfill_prefixes())
+        else:
+            asyncio.run(main())
     except Exception as e:
         logger.error(f"Fatal error in main: {e}", exc_info=True)
         raise